@@ -0,0 +1,38 @@
+"""Benchmarks for the OpenID library and the stores it ships with.
+
+Run them from the top of the source tree, for example::
+
+    python -m bench.login --iterations 200 --save before.json
+    (make a change)
+    python -m bench.login --iterations 200 --compare before.json
+
+Every benchmark prints a table of its results.  With C{--save} the
+results are also written to a JSON file, and with C{--compare} they
+are checked against a file saved earlier, on the same machine, so that
+regressions between two revisions stand out.
+
+Modules:
+
+  - C{L{bench.login}}: the full C{Consumer.begin}/C{complete} cycle
+    against an in-process OpenID provider, per store.
+  - C{L{bench.dh}}: the Diffie-Hellman session code.
+  - C{L{bench.cryptutil}}: converting between longs and strings, and
+    random strings.
+  - C{L{bench.kvform}}: the key-value form codec, and serializing
+    associations.
+  - C{L{bench.message}}: parsing, reading and rendering messages.
+  - C{L{bench.filestore}}: association lookups in C{FileOpenIDStore}
+    with many servers' associations.
+  - C{L{bench.memstore}}: C{MemoryStore} with many entries.
+  - C{L{bench.sqlstore}}: C{SQLiteStore} and C{SQLiteWALStore} calls
+    in transactions of their own and in batches, from readers and a
+    writer at once, and cleaning up.
+  - C{L{bench.threads}}: C{ConcurrentMemoryStore} used from many
+    threads.
+  - C{L{bench.memory}}: the memory taken by associations and service
+    endpoints.
+  - C{L{bench.provider}}: the OpenID provider stand-in that
+    C{bench.login} runs against.
+  - C{L{bench.stores}}: the stores that benchmarks run against.
+  - C{L{bench.report}}: timing, summaries and saved results.
+"""
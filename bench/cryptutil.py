@@ -0,0 +1,113 @@
+"""Benchmark C{openid.cryptutil}.
+
+C{openid.cryptutil} picks the quickest of its conversion backends when
+it is imported.  This times each of them, for numbers the size of SHA1
+and SHA256 digests and of 1024 and 2048 bit Diffie-Hellman keys:
+
+  - C{longToBinary/BITS}, C{binaryToLong/BITS}: one conversion
+  - C{base64ToLong/BITS}, C{longToBase64/BITS}: the conversions that
+    associate requests and responses make, with the chosen backend
+
+and random strings:
+
+  - C{randomString/N}: an N character string of letters and digits,
+    next to choosing each character with C{randrange} (C{perchar})
+  - C{mkNonce}: a response nonce
+
+Usage::
+
+    python -m bench.cryptutil [--save FILE] [--compare FILE]
+"""
+
+import optparse
+import sys
+
+from openid import cryptutil
+from openid.store.nonce import NONCE_CHARS, mkNonce
+
+from bench import report
+
+sizes = [160, 256, 1024, 2048]
+
+def getBackends():
+    """Return the conversion backends to compare, as (name,
+    longToBinary, binaryToLong)."""
+    backends = getattr(cryptutil, '_long_backends', None)
+    if backends is None:
+        # pycrypto is doing the conversions.
+        backends = [(cryptutil._long_backend, cryptutil.longToBinary,
+                     cryptutil.binaryToLong)]
+    return backends
+
+def benchConversions(results, options):
+    for bits in sizes:
+        l = (1L << (bits - 1)) + cryptutil.randrange(1L << (bits - 1))
+        s = cryptutil.longToBinary(l)
+        to_binary = results['longToBinary/%d' % (bits,)] = {}
+        to_long = results['binaryToLong/%d' % (bits,)] = {}
+        for name, long_to_binary, binary_to_long in getBackends():
+            assert long_to_binary(l) == s and binary_to_long(s) == l
+            to_binary[name] = report.summarize(report.timeCalls(
+                lambda: long_to_binary(l), options.batches, options.number))
+            to_long[name] = report.summarize(report.timeCalls(
+                lambda: binary_to_long(s), options.batches, options.number))
+
+        b64 = cryptutil.longToBase64(l)
+        results['longToBase64/%d' % (bits,)] = {
+            'current': report.summarize(report.timeCalls(
+                lambda: cryptutil.longToBase64(l), options.batches,
+                options.number)),
+            }
+        results['base64ToLong/%d' % (bits,)] = {
+            'current': report.summarize(report.timeCalls(
+                lambda: cryptutil.base64ToLong(b64), options.batches,
+                options.number)),
+            }
+
+def perCharRandomString(length, chrs):
+    """The character-at-a-time randomString, for comparison."""
+    n = len(chrs)
+    return ''.join([chrs[cryptutil.randrange(n)] for _ in xrange(length)])
+
+def benchRandomString(results, options):
+    # Nonce salts, and the session keys the example consumer makes
+    for length in [6, 16]:
+        results['randomString/%d' % (length,)] = {
+            'current': report.summarize(report.timeCalls(
+                lambda: cryptutil.randomString(length, NONCE_CHARS),
+                options.batches, options.number)),
+            'perchar': report.summarize(report.timeCalls(
+                lambda: perCharRandomString(length, NONCE_CHARS),
+                options.batches, options.number)),
+            }
+
+    results['mkNonce'] = {
+        'current': report.summarize(report.timeCalls(
+            mkNonce, options.batches, options.number)),
+        }
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--batches', type='int', default=20,
+                      help='batches of calls to time [default: %default]')
+    parser.add_option('--number', type='int', default=2000,
+                      help='calls per batch [default: %default]')
+    report.addOptions(parser)
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %r' % (args,))
+
+    sys.stdout.write('Using the %s backend\n\n' % (cryptutil._long_backend,))
+    results = {}
+    benchConversions(results, options)
+    benchRandomString(results, options)
+
+    settings = {
+        'batches': options.batches,
+        'number': options.number,
+        'backend': cryptutil._long_backend,
+        }
+    return report.finish(options, 'cryptutil', results, settings)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""Benchmark the Diffie-Hellman session code in C{openid.dh}.
+
+Cases:
+
+  - C{strxor/N}: C{L{strxor<openid.dh.strxor>}} of two N byte strings,
+    next to the byte-at-a-time XOR it replaced (C{bytewise})
+  - C{xorSecret/HASH}: recovering a MAC key in a C{DH-SHA1} or
+    C{DH-SHA256} session, once the provider's public key is known
+  - C{keypair}: making a key pair with the default modulus, with the
+    fixed-base table (C{current}), with C{pow}, and taking one from a
+    full C{L{KeyPairPool<openid.dh.KeyPairPool>}} (C{pool})
+  - C{sharedSecret}: computing the shared secret from a public key
+
+Usage::
+
+    python -m bench.dh [--save FILE] [--compare FILE]
+"""
+
+import optparse
+import sys
+
+from openid import cryptutil
+from openid.dh import DiffieHellman, KeyPairPool, setDefaultKeyPairPool, \
+     strxor
+
+from bench import report
+
+xor_sizes = [20, 32, 64, 256, 4096]
+
+def bytewiseStrxor(x, y):
+    """The byte-at-a-time XOR, for comparison."""
+    if len(x) != len(y):
+        raise ValueError('Inputs to strxor must have the same length')
+
+    xor = lambda (a, b): chr(ord(a) ^ ord(b))
+    return "".join(map(xor, zip(x, y)))
+
+def benchStrxor(results, options):
+    for size in xor_sizes:
+        x = cryptutil.getBytes(size)
+        y = cryptutil.getBytes(size)
+        results['strxor/%d' % (size,)] = {
+            'current': report.summarize(report.timeCalls(
+                lambda: strxor(x, y), options.batches, options.number)),
+            'bytewise': report.summarize(report.timeCalls(
+                lambda: bytewiseStrxor(x, y), options.batches,
+                options.number)),
+            }
+
+def benchXorSecret(results, options):
+    consumer = DiffieHellman.fromDefaults()
+    server = DiffieHellman.fromDefaults()
+    for hash_name, hash_func, size in [('sha1', cryptutil.sha1, 20),
+                                       ('sha256', cryptutil.sha256, 32)]:
+        secret = cryptutil.getBytes(size)
+        enc_mac_key = server.xorSecret(consumer.public, secret, hash_func)
+        func = lambda: consumer.xorSecret(server.public, enc_mac_key,
+                                          hash_func)
+        assert func() == secret
+        results['xorSecret/%s' % (hash_name,)] = {
+            'current': report.summarize(report.timeCalls(
+                func, options.batches, max(1, options.number // 100))),
+            }
+
+def benchKeys(results, options):
+    number = max(1, options.number // 100)
+    results['keypair'] = {
+        'current': report.summarize(report.timeCalls(
+            DiffieHellman.fromDefaults, options.batches, number)),
+        }
+
+    window = DiffieHellman.fixed_base_window
+    DiffieHellman.fixed_base_window = None
+    try:
+        results['keypair']['pow'] = report.summarize(report.timeCalls(
+            DiffieHellman.fromDefaults, options.batches, number))
+    finally:
+        DiffieHellman.fixed_base_window = window
+
+    pool = KeyPairPool(depth=options.batches * number)
+    pool.fill()
+    setDefaultKeyPairPool(pool)
+    try:
+        results['keypair']['pool'] = report.summarize(report.timeCalls(
+            DiffieHellman.fromDefaults, options.batches, number))
+    finally:
+        setDefaultKeyPairPool(None)
+
+    consumer = DiffieHellman.fromDefaults()
+    server = DiffieHellman.fromDefaults()
+    results['sharedSecret'] = {
+        'current': report.summarize(report.timeCalls(
+            lambda: consumer.getSharedSecret(server.public),
+            options.batches, number)),
+        }
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--batches', type='int', default=20,
+                      help='batches of calls to time [default: %default]')
+    parser.add_option('--number', type='int', default=2000,
+                      help='calls per batch; the key operations make '
+                      'a hundredth as many [default: %default]')
+    report.addOptions(parser)
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %r' % (args,))
+
+    results = {}
+    benchStrxor(results, options)
+    benchXorSecret(results, options)
+    benchKeys(results, options)
+
+    settings = {'batches': options.batches, 'number': options.number}
+    return report.finish(options, 'dh', results, settings)
+
+if __name__ == '__main__':
+    sys.exit(main())
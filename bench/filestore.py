@@ -0,0 +1,171 @@
+"""Benchmark C{L{FileOpenIDStore}} with many entries.
+
+The store is filled with C{--servers} servers' associations, three per
+server, written straight to the files the store would use, and with
+C{--nonces} nonces still in use, and then:
+
+  - C{getAssociation/newest}: the newest association for one server,
+    as C{Consumer.begin} asks for, with the index file (C{current}) and
+    without it (C{noindex})
+  - C{getAssociation/handle}: one association by its handle, as
+    C{Consumer.complete} asks for
+  - C{getAssociation/missing}: a server with no associations
+  - C{useNonce}: a nonce that has not been used
+  - C{cleanupNonces}: cleaning up when no nonce has expired, as a
+    periodic cleanup mostly does
+  - C{storeAssociation}: storing a new association in each of the
+    C{L{durability modes<openid.store.filestore.durability_modes>}},
+    with the associations stored per second
+
+Usage::
+
+    python -m bench.filestore [--servers N] [--nonces N] [--save FILE]
+        [--compare FILE]
+"""
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from openid import oidutil
+from openid.association import Association
+from openid.store.filestore import FileOpenIDStore, durability_modes
+from openid.store.nonce import SKEW
+
+from bench import report
+
+def serverURL(i):
+    return 'https://op%d.example.com/openid' % (i,)
+
+def fillStore(store, servers, per_server=3):
+    """Write C{per_server} associations for each of C{servers} servers,
+    and return the newest association of the last server."""
+    for i in xrange(servers):
+        server_url = serverURL(i)
+        for j in xrange(per_server):
+            # Older associations were issued earlier.
+            assoc = Association(
+                '{HMAC-SHA1}{%08x}{%d}' % (i, j), 's' * 20,
+                int(time.time()) - per_server + j, 1209600 - j, 'HMAC-SHA1')
+            filename = store.getAssociationFilename(server_url, assoc.handle)
+            dirname = os.path.dirname(filename)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            f = file(filename, 'wb')
+            try:
+                f.write(assoc.serialize())
+            finally:
+                f.close()
+    return assoc
+
+def benchLookups(results, options, directory):
+    store = FileOpenIDStore(directory)
+    newest = fillStore(store, options.servers)
+    server_url = serverURL(options.servers - 1)
+    missing_url = serverURL(options.servers)
+
+    def timed(func):
+        return report.summarize(report.timeCalls(
+            func, options.batches, options.number))
+
+    lookup = lambda: store.getAssociation(server_url)
+    assert lookup().handle == newest.handle
+    results['getAssociation/newest'] = {'current': timed(lookup)}
+
+    if hasattr(store, 'association_index'):
+        store.association_index = False
+        assert lookup().handle == newest.handle
+        results['getAssociation/newest']['noindex'] = timed(lookup)
+        store.association_index = True
+
+    lookup = lambda: store.getAssociation(server_url, newest.handle)
+    assert lookup().handle == newest.handle
+    results['getAssociation/handle'] = {'current': timed(lookup)}
+
+    lookup = lambda: store.getAssociation(missing_url)
+    assert lookup() is None
+    results['getAssociation/missing'] = {'current': timed(lookup)}
+
+def benchNonces(results, options, directory):
+    store = FileOpenIDStore(directory)
+    server_url = serverURL(0)
+    now = int(time.time())
+    for i in xrange(options.nonces):
+        # Spread over the hours of timestamps that are still in use
+        timestamp = now - i % (SKEW - 60)
+        assert store.useNonce(server_url, timestamp, 'fill%d' % (i,))
+    assert store.cleanupNonces() == 0
+
+    def timed(func):
+        return report.summarize(report.timeCalls(
+            func, options.batches, options.number))
+
+    salts = iter(xrange(1 << 30))
+    use = lambda: store.useNonce(server_url, now, 'salt%d' % (salts.next(),))
+    assert use()
+    results['useNonce'] = {'current': timed(use)}
+    results['cleanupNonces'] = {'current': timed(store.cleanupNonces)}
+
+def benchDurability(results, options, directory):
+    results['storeAssociation'] = {}
+    for mode in durability_modes:
+        store = FileOpenIDStore(os.path.join(directory, mode), mode)
+        server_url = serverURL(0)
+        handles = iter(xrange(1 << 30))
+
+        def store_():
+            assoc = Association.fromExpiresIn(
+                1209600, '{HMAC-SHA1}{%s}{%d}' % (mode, handles.next()),
+                's' * 20, 'HMAC-SHA1')
+            store.storeAssociation(server_url, assoc)
+
+        store_()
+        stats = report.summarize(report.timeCalls(
+            store_, options.batches, options.number))
+        store.flush()
+        stats['per_sec'] = 1000 / stats['mean_ms']
+        results['storeAssociation'][mode] = stats
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--servers', type='int', default=2000,
+                      help='servers with associations in the store '
+                      '[default: %default]')
+    parser.add_option('--nonces', type='int', default=20000,
+                      help='nonces in use in the store [default: %default]')
+    parser.add_option('--batches', type='int', default=10,
+                      help='batches of calls to time [default: %default]')
+    parser.add_option('--number', type='int', default=50,
+                      help='calls per batch [default: %default]')
+    report.addOptions(parser)
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %r' % (args,))
+
+    # The store logs every file it looks at.
+    oidutil.log = lambda message, level=0: None
+
+    directory = tempfile.mkdtemp(prefix='bench-filestore-')
+    try:
+        results = {}
+        benchLookups(results, options, directory)
+        benchNonces(results, options, directory)
+        benchDurability(results, options, directory)
+    finally:
+        shutil.rmtree(directory)
+
+    report.printRates(results)
+
+    settings = {
+        'servers': options.servers,
+        'nonces': options.nonces,
+        'batches': options.batches,
+        'number': options.number,
+        }
+    return report.finish(options, 'filestore', results, settings)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""Benchmark the key-value form codec in C{openid.kvform}.
+
+Every case is checked first: the codec must round-trip the document
+and give the same result as the line-at-a-time code it replaced, which
+is still used for documents that need warnings (C{checked}).  Cases:
+
+  - C{seqToKV/DOC}, C{kvToSeq/DOC}: encoding and decoding an
+    associate response (C{associate}), a check_authentication
+    response (C{check_auth}) and a serialized association
+    (C{association}), and one with non-ASCII values (C{unicode})
+  - C{association/VERSION}: C{Association.serialize} and
+    C{deserialize}, in KV form (C{2}) and the binary form (C{3})
+
+Usage::
+
+    python -m bench.kvform [--save FILE] [--compare FILE]
+"""
+
+import optparse
+import sys
+import time
+
+from openid import cryptutil, kvform
+from openid.association import Association
+from openid.store.nonce import NONCE_CHARS
+
+from bench import report
+
+def makeAssociation(assoc_type, secret_size):
+    handle = '{%s}{%x}{%s}' % (assoc_type, int(time.time()),
+                               cryptutil.randomString(8, NONCE_CHARS))
+    return Association.fromExpiresIn(
+        1209600, handle, cryptutil.getBytes(secret_size), assoc_type)
+
+def makeDocuments():
+    """Return the pair sequences to encode and decode, by name."""
+    mac_key = cryptutil.toBase64(cryptutil.getBytes(20))
+    public = cryptutil.longToBase64(cryptutil.randrange(1L << 1023))
+    association = makeAssociation('HMAC-SHA1', 20)
+
+    return {
+        'associate': [
+            ('ns', 'http://specs.openid.net/auth/2.0'),
+            ('assoc_handle', association.handle),
+            ('session_type', 'DH-SHA1'),
+            ('assoc_type', 'HMAC-SHA1'),
+            ('expires_in', '1209600'),
+            ('dh_server_public', public),
+            ('enc_mac_key', mac_key),
+            ],
+        'check_auth': [
+            ('ns', 'http://specs.openid.net/auth/2.0'),
+            ('is_valid', 'true'),
+            ('invalidate_handle', association.handle),
+            ],
+        'association': kvform.kvToSeq(association.serialize()),
+        'unicode': [
+            (u'ns', u'http://specs.openid.net/auth/2.0'),
+            (u'fullname', u'Jos\xe9 Mar\xeda'),
+            (u'nickname', u'\u5c71\u7530'),
+            ],
+        }
+
+def checkDocument(seq):
+    kv = kvform.seqToKV(seq, strict=True)
+    assert kv == kvform._checkedSeqToKV(seq, True)
+
+    decoded = kvform.kvToSeq(kv, strict=True)
+    assert decoded == kvform._checkedKvToSeq(kv, True)
+    assert [(unicode(k), unicode(v)) for (k, v) in seq] == decoded
+    return kv
+
+def benchDocuments(results, options):
+    for name, seq in makeDocuments().iteritems():
+        kv = checkDocument(seq)
+        results['seqToKV/%s' % (name,)] = {
+            'current': report.summarize(report.timeCalls(
+                lambda: kvform.seqToKV(seq), options.batches,
+                options.number)),
+            'checked': report.summarize(report.timeCalls(
+                lambda: kvform._checkedSeqToKV(seq, False),
+                options.batches, options.number)),
+            }
+        results['kvToSeq/%s' % (name,)] = {
+            'current': report.summarize(report.timeCalls(
+                lambda: kvform.kvToSeq(kv), options.batches,
+                options.number)),
+            'checked': report.summarize(report.timeCalls(
+                lambda: kvform._checkedKvToSeq(kv, False),
+                options.batches, options.number)),
+            }
+
+def benchAssociation(results, options):
+    association = makeAssociation('HMAC-SHA256', 32)
+    for version in ['2', '3']:
+        assoc_s = association.serialize(version)
+        assert Association.deserialize(assoc_s) == association
+
+        results['association/%s' % (version,)] = {
+            'serialize': report.summarize(report.timeCalls(
+                lambda: association.serialize(version), options.batches,
+                options.number)),
+            'deserialize': report.summarize(report.timeCalls(
+                lambda: Association.deserialize(assoc_s), options.batches,
+                options.number)),
+            }
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--batches', type='int', default=20,
+                      help='batches of calls to time [default: %default]')
+    parser.add_option('--number', type='int', default=2000,
+                      help='calls per batch [default: %default]')
+    report.addOptions(parser)
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %r' % (args,))
+
+    results = {}
+    benchDocuments(results, options)
+    benchAssociation(results, options)
+
+    settings = {'batches': options.batches, 'number': options.number}
+    return report.finish(options, 'kvform', results, settings)
+
+if __name__ == '__main__':
+    sys.exit(main())
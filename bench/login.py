@@ -0,0 +1,263 @@
+"""Benchmark the whole OpenID login, C{Consumer.begin} to C{complete}.
+
+Each login discovers the provider, gets an association (from the store,
+or by negotiating one), builds the redirect, has the provider approve
+it, and completes the response, checking its signature and nonce.  The
+provider is a C{L{bench.provider.Provider}}, reached in-process by
+default or over loopback HTTP with C{--transport}.
+
+Phases are timed as they are called inside the consumer:
+
+  - C{discovery}: Yadis or HTML discovery of the identifier
+  - C{association}: finding or negotiating an association in C{begin}
+  - C{verify}: checking the assertion against the discovered
+    information in C{complete}
+  - C{signature}: checking the signature, by the association or with
+    C{check_authentication}
+  - C{nonce}: checking that the response nonce is unused
+  - C{begin}, C{complete}: the consumer calls, end to end
+
+With the in-process transport, the provider's share of a direct
+request (its half of a Diffie-Hellman exchange, for example) is timed
+as part of the phase that made the request.
+
+Every store runs these cases:
+
+  - C{login}: the association is negotiated once and then reused
+  - C{associate}: every login negotiates a new association
+  - C{stateless}: the provider signs with a private association, so
+    every login makes a C{check_authentication} request
+
+The C{stateless} case then checks that an assertion verified through a
+C{CheckAuthCache} cannot be replayed for another identifier with its
+signed fields changed: the changed assertion has to miss the cache and
+be refused by the provider.  Over HTTP, it also checks that a login
+fails,
+rather than raising, when the provider has stopped and the
+C{check_authentication} request made through a C{CheckAuthCache}'s
+fetcher cannot connect.
+
+Usage::
+
+    python -m bench.login [--iterations N] [--store NAME] [--save FILE]
+                          [--compare FILE]
+"""
+
+import gc
+import optparse
+import shutil
+import sys
+import tempfile
+
+from openid import fetchers
+from openid.consumer.checkauth import CheckAuthCache
+from openid.consumer.consumer import Consumer, FAILURE, SUCCESS
+from openid.store.nonce import mkNonce
+
+from bench import report
+from bench.provider import Provider, ProviderFetcher, ProviderServer
+from bench.stores import store_names, makeStore
+
+cases = ['login', 'associate', 'stateless']
+
+return_to = 'http://rp.bench.invalid/finish'
+realm = 'http://rp.bench.invalid/'
+
+class LoginBenchmark(object):
+    """Runs logins against one provider and store, recording the time
+    spent in each phase."""
+
+    def __init__(self, provider, store, discovery='xrds'):
+        self.provider = provider
+        self.store = store
+        self.identity_url = provider.getIdentityURL(discovery=discovery)
+        self.recorder = report.Recorder()
+
+    def makeConsumer(self, session):
+        consumer = Consumer(session, self.store)
+        record = self.recorder.wrap
+        consumer._discover = record('discovery', consumer._discover)
+
+        generic = consumer.consumer
+        generic._getAssociation = record('association',
+                                         generic._getAssociation)
+        generic._verifyDiscoveryResults = record(
+            'verify', generic._verifyDiscoveryResults)
+        generic._idResCheckSignature = record('signature',
+                                              generic._idResCheckSignature)
+        generic._idResCheckNonce = record('nonce', generic._idResCheckNonce)
+        return consumer
+
+    def login(self):
+        session = {}
+        consumer = self.makeConsumer(session)
+        record = self.recorder.call
+
+        auth_request = record('begin', consumer.begin, self.identity_url)
+        redirect_url = auth_request.redirectURL(realm, return_to)
+        query = self.provider.respond(redirect_url)
+
+        # A new request arrives at the return_to URL.
+        consumer = self.makeConsumer(session)
+        response = record('complete', consumer.complete, query,
+                          query['openid.return_to'])
+        if response.status != SUCCESS:
+            raise AssertionError('Login failed: %r' % (response,))
+
+        return auth_request
+
+    def checkChangedAssertion(self):
+        """Verify an assertion through a C{CheckAuthCache}, then check
+        that the same signature with other signed values misses the
+        cache and fails."""
+        cache = CheckAuthCache()
+        attacker = self.provider.getIdentityURL('attacker')
+        victim = self.provider.getIdentityURL('victim')
+
+        session = {}
+        consumer = Consumer(session, self.store)
+        consumer.setCheckAuthCache(cache)
+        auth_request = consumer.begin(attacker)
+        query = self.provider.respond(
+            auth_request.redirectURL(realm, return_to))
+        consumer = Consumer(session, self.store)
+        consumer.setCheckAuthCache(cache)
+        response = consumer.complete(query, query['openid.return_to'])
+        if response.status != SUCCESS or len(cache) != 1:
+            raise AssertionError('Login failed: %r' % (response,))
+
+        forged = dict(query)
+        forged['openid.claimed_id'] = victim
+        forged['openid.identity'] = victim
+        forged['openid.response_nonce'] = mkNonce()
+        checks = self.provider.requests.get('check_authentication', 0)
+        consumer = Consumer({}, self.store)
+        consumer.setCheckAuthCache(cache)
+        response = consumer.complete(forged, forged['openid.return_to'])
+        if response.status == SUCCESS:
+            raise AssertionError('Changed assertion accepted: %r'
+                                 % (response,))
+        if self.provider.requests.get('check_authentication', 0) != checks + 1:
+            raise AssertionError('Changed assertion was answered from '
+                                 'the cache')
+
+    def checkProviderDown(self, server):
+        """Stop the provider's server between C{begin} and
+        C{complete}, and check that the login fails."""
+        session = {}
+        cache = CheckAuthCache(fetchers.KeepAliveHTTPFetcher())
+        consumer = Consumer(session, self.store)
+        consumer.setCheckAuthCache(cache)
+        auth_request = consumer.begin(self.identity_url)
+        query = self.provider.respond(
+            auth_request.redirectURL(realm, return_to))
+
+        server.stop()
+        consumer = Consumer(session, self.store)
+        consumer.setCheckAuthCache(cache)
+        response = consumer.complete(query, query['openid.return_to'])
+        if response.status != FAILURE:
+            raise AssertionError('Login with the provider down: %r'
+                                 % (response,))
+
+    def forgetAssociation(self, auth_request):
+        if auth_request.assoc is not None:
+            self.store.removeAssociation(auth_request.endpoint.server_url,
+                                         auth_request.assoc.handle)
+
+    def run(self, iterations, case):
+        # The first login discovers the provider's association
+        # preferences and warms up the caches along the way.
+        auth_request = self.login()
+        self.recorder.samples.clear()
+
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for _ in xrange(iterations):
+                if case == 'associate':
+                    self.forgetAssociation(auth_request)
+                auth_request = self.login()
+                gc.collect()
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        return self.recorder.summarize()
+
+def runCase(store_name, case, options):
+    directory = tempfile.mkdtemp(prefix='bench-login-')
+    server = None
+    try:
+        stateless = case == 'stateless'
+        if options.transport == 'inprocess':
+            provider = Provider(stateless=stateless)
+            fetcher = ProviderFetcher(provider)
+        else:
+            server = ProviderServer(stateless=stateless)
+            server.start()
+            provider = server.provider
+            if options.transport == 'keepalive':
+                fetcher = fetchers.KeepAliveHTTPFetcher()
+            else:
+                fetcher = fetchers.Urllib2Fetcher()
+
+        fetchers.setDefaultFetcher(fetcher)
+        store = makeStore(store_name, directory)
+        benchmark = LoginBenchmark(provider, store, options.discovery)
+        results = benchmark.run(options.iterations, case)
+        if stateless:
+            benchmark.checkChangedAssertion()
+        if stateless and server is not None:
+            # The check stops the server itself.
+            stopping, server = server, None
+            benchmark.checkProviderDown(stopping)
+        return results
+    finally:
+        fetchers.setDefaultFetcher(None)
+        if server is not None:
+            server.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--iterations', type='int', default=100,
+                      help='logins per case [default: %default]')
+    parser.add_option('--store', action='append', dest='stores',
+                      choices=store_names, metavar='NAME',
+                      help='only run against this store; may be repeated '
+                      '(%s)' % (', '.join(store_names),))
+    parser.add_option('--case', action='append', dest='cases',
+                      choices=cases, metavar='CASE',
+                      help='only run this case; may be repeated (%s)' %
+                      (', '.join(cases),))
+    parser.add_option('--discovery', choices=['xrds', 'html'],
+                      default='xrds',
+                      help='how the identifier is discovered: xrds or html '
+                      '[default: %default]')
+    parser.add_option('--transport',
+                      choices=['inprocess', 'http', 'keepalive'],
+                      default='inprocess',
+                      help='how the provider is reached: inprocess, http '
+                      '(a new connection per request) or keepalive '
+                      '[default: %default]')
+    report.addOptions(parser)
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %r' % (args,))
+
+    results = {}
+    for store_name in options.stores or store_names:
+        for case in options.cases or cases:
+            name = '%s/%s' % (store_name, case)
+            results[name] = runCase(store_name, case, options)
+
+    settings = {
+        'iterations': options.iterations,
+        'discovery': options.discovery,
+        'transport': options.transport,
+        }
+    return report.finish(options, 'login', results, settings)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""Measure the memory taken by associations and service endpoints.
+
+Caches of C{L{Association<openid.association.Association>}},
+C{L{OpenIDServiceEndpoint<openid.consumer.discover.OpenIDServiceEndpoint>}}
+and C{L{BasicServiceEndpoint<openid.yadis.filters.BasicServiceEndpoint>}}
+objects are built, and the objects themselves are measured with
+C{sys.getsizeof}, not counting the attribute values, which are the same
+whatever the layout.  Each class is next to an otherwise identical
+class that keeps its attributes in a C{__dict__} (C{dict}), as they
+did before they had C{__slots__} (C{slots}).
+
+Cases:
+
+  - C{CLASS}: making one object, with the bytes per object and the
+    megabytes taken by a cache of C{--size} of them
+  - C{CLASS/pickle}: pickling one object with protocol 2 and loading
+    it again, with the size of the pickle
+
+Usage::
+
+    python -m bench.memory [--size N] [--save FILE] [--compare FILE]
+"""
+
+import optparse
+import pickle
+import sys
+
+from openid.association import Association
+from openid.consumer.discover import OpenIDServiceEndpoint, \
+     OPENID_2_0_TYPE
+from openid.yadis.filters import BasicServiceEndpoint
+
+from bench import report
+
+def makeDictClass(cls):
+    """Return a class with the methods of C{cls}, but with its
+    attributes in a C{__dict__}."""
+    skip = set(cls.__slots__)
+    skip.update(['__slots__', '__getstate__', '__setstate__'])
+    namespace = {}
+    for name, value in vars(cls).iteritems():
+        if name not in skip:
+            namespace[name] = value
+    return type(cls.__name__, (object,), namespace)
+
+def makeAssociation(cls, i):
+    return cls('{HMAC-SHA1}{%08x}{%08x}' % (i, i), 's' * 20, 1300000000,
+               1209600, 'HMAC-SHA1')
+
+def makeOpenIDServiceEndpoint(cls, i):
+    endpoint = cls()
+    endpoint.claimed_id = 'http://example.com/user/%d' % (i,)
+    endpoint.server_url = 'http://example.com/openid'
+    endpoint.type_uris = [OPENID_2_0_TYPE]
+    endpoint.used_yadis = True
+    return endpoint
+
+def makeBasicServiceEndpoint(cls, i):
+    return cls('http://example.com/user/%d' % (i,), [OPENID_2_0_TYPE],
+               'http://example.com/openid', None)
+
+cases = [
+    (Association, makeAssociation),
+    (OpenIDServiceEndpoint, makeOpenIDServiceEndpoint),
+    (BasicServiceEndpoint, makeBasicServiceEndpoint),
+    ]
+
+def objectSize(obj):
+    """The bytes taken by an object and its C{__dict__}, if any."""
+    size = sys.getsizeof(obj)
+    obj_dict = getattr(obj, '__dict__', None)
+    if obj_dict is not None:
+        size += sys.getsizeof(obj_dict)
+    return size
+
+def benchClass(results, options, cls, make):
+    name = cls.__name__
+    results[name] = {}
+    results[name + '/pickle'] = {}
+    for layout, layout_cls in [('slots', cls), ('dict', makeDictClass(cls))]:
+        cache = [make(layout_cls, i) for i in xrange(options.size)]
+        total = sum([objectSize(obj) for obj in cache])
+        del cache
+
+        stats = report.summarize(report.timeCalls(
+            lambda: make(layout_cls, 0), options.batches, options.number))
+        stats['bytes'] = float(total) / options.size
+        stats['cache_mb'] = total / 1048576.0
+        results[name][layout] = stats
+
+        if layout == 'slots':
+            obj = make(cls, 0)
+            pickled = pickle.dumps(obj, 2)
+            assert pickle.loads(pickled).__getstate__() == obj.__getstate__()
+            stats = report.summarize(report.timeCalls(
+                lambda: pickle.loads(pickle.dumps(obj, 2)),
+                options.batches, options.number))
+            stats['bytes'] = len(pickled)
+            results[name + '/pickle'][layout] = stats
+
+def printMemory(results, options, out=None):
+    if out is None:
+        out = sys.stdout
+
+    fmt = '%-32s %-16s %14s %14s\n'
+    out.write(fmt % ('case', 'layout', 'bytes/object',
+                     'MB per %d' % (options.size,)))
+    for case in sorted(results):
+        for layout in sorted(results[case]):
+            stats = results[case][layout]
+            cache_mb = stats.get('cache_mb')
+            if cache_mb is None:
+                cache_mb = ''
+            else:
+                cache_mb = '%.4g' % (cache_mb,)
+            out.write(fmt % (case, layout, '%.4g' % (stats['bytes'],),
+                             cache_mb))
+    out.write('\n')
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--size', type='int', default=100000,
+                      help='objects in each cache [default: %default]')
+    parser.add_option('--batches', type='int', default=20,
+                      help='batches of calls to time [default: %default]')
+    parser.add_option('--number', type='int', default=2000,
+                      help='calls per batch [default: %default]')
+    report.addOptions(parser)
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %r' % (args,))
+
+    results = {}
+    for cls, make in cases:
+        benchClass(results, options, cls, make)
+
+    printMemory(results, options)
+
+    settings = {
+        'size': options.size,
+        'batches': options.batches,
+        'number': options.number,
+        }
+    return report.finish(options, 'memory', results, settings)
+
+if __name__ == '__main__':
+    sys.exit(main())
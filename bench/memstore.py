@@ -0,0 +1,105 @@
+"""Benchmark C{L{MemoryStore<openid.store.memstore.MemoryStore>}}
+with many entries.
+
+The store is filled with C{--servers} servers with C{--assocs}
+associations each, and C{--nonces} nonces still in use, and then:
+
+  - C{getAssociation/newest}: the newest association for one server,
+    as C{Consumer.begin} asks for
+  - C{storeAssociation}: storing an association
+  - C{useNonce}: a nonce that has not been used
+  - C{cleanupNonces}, C{cleanupAssociations}: cleaning up when nothing
+    has expired, as a periodic cleanup mostly does
+
+Usage::
+
+    python -m bench.memstore [--servers N] [--assocs N] [--nonces N]
+        [--save FILE] [--compare FILE]
+"""
+
+import optparse
+import sys
+import time
+
+from openid.association import Association
+from openid.store.memstore import MemoryStore
+from openid.store.nonce import SKEW
+
+from bench import report
+
+def serverURL(i):
+    return 'https://op%d.example.com/openid' % (i,)
+
+def fillStore(store, options):
+    now = int(time.time())
+    for i in xrange(options.servers):
+        for j in xrange(options.assocs):
+            store.storeAssociation(serverURL(i), Association(
+                '{HMAC-SHA1}{%08x}{%d}' % (i, j), 's' * 20, now - j,
+                1209600, 'HMAC-SHA1'))
+
+    for i in xrange(options.nonces):
+        # Spread over the timestamps that are still in use
+        assert store.useNonce(serverURL(i % options.servers),
+                              now - i % (SKEW - 60), 'fill%d' % (i,))
+
+def benchStore(results, options):
+    store = MemoryStore()
+    fillStore(store, options)
+    server_url = serverURL(0)
+    now = int(time.time())
+
+    def timed(func):
+        return report.summarize(report.timeCalls(
+            func, options.batches, options.number))
+
+    lookup = lambda: store.getAssociation(server_url)
+    assert lookup().handle == '{HMAC-SHA1}{00000000}{0}'
+
+    assoc = Association.fromExpiresIn(1209600, '{HMAC-SHA1}{store}{0}',
+                                      's' * 20, 'HMAC-SHA1')
+    salts = iter(xrange(1 << 30))
+    use = lambda: store.useNonce(server_url, now, 'salt%d' % (salts.next(),))
+
+    results['getAssociation/newest'] = {'current': timed(lookup)}
+    results['storeAssociation'] = {
+        'current': timed(lambda: store.storeAssociation(serverURL(1), assoc)),
+        }
+    results['useNonce'] = {'current': timed(use)}
+    results['cleanupNonces'] = {'current': timed(store.cleanupNonces)}
+    results['cleanupAssociations'] = {
+        'current': timed(store.cleanupAssociations),
+        }
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--servers', type='int', default=100,
+                      help='servers with associations in the store '
+                      '[default: %default]')
+    parser.add_option('--assocs', type='int', default=50,
+                      help='associations per server [default: %default]')
+    parser.add_option('--nonces', type='int', default=100000,
+                      help='nonces in use in the store [default: %default]')
+    parser.add_option('--batches', type='int', default=10,
+                      help='batches of calls to time [default: %default]')
+    parser.add_option('--number', type='int', default=100,
+                      help='calls per batch [default: %default]')
+    report.addOptions(parser)
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %r' % (args,))
+
+    results = {}
+    benchStore(results, options)
+
+    settings = {
+        'servers': options.servers,
+        'assocs': options.assocs,
+        'nonces': options.nonces,
+        'batches': options.batches,
+        'number': options.number,
+        }
+    return report.finish(options, 'memstore', results, settings)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""Benchmark C{L{openid.message.Message}}.
+
+The message is a positive assertion like the ones C{bench.login}
+checks, with simple registration and attribute exchange fields.
+
+Cases:
+
+  - C{fromPostArgs/assertion}: parsing the query of the assertion
+  - C{fromPostArgs/ax50}: parsing an assertion with fifty attribute
+    exchange values
+  - C{fromPostArgs/openid1}: parsing an OpenID 1 assertion, whose
+    simple registration fields use the registered C{sreg} alias
+  - C{getArg}: looking up one field in the OpenID namespace, as
+    C{GenericConsumer} does several times per response
+  - C{hasKey}: checking for a field that is absent
+  - C{getArgs}: all of the fields in the simple registration namespace
+  - C{toPostArgs}: rendering the message back into a query
+  - C{copy}: copying the message
+  - C{copySetArg}: copying the message and changing one field of the
+    copy, as C{Association.signMessage} does
+  - C{setArg}: changing one field, then rendering the message again
+
+Usage::
+
+    python -m bench.message [--save FILE] [--compare FILE]
+"""
+
+import optparse
+import sys
+
+from openid.message import Message, OPENID_NS, OPENID1_NS, OPENID2_NS, \
+     SREG_URI
+# Registers the sreg alias for OpenID 1 messages
+from openid.extensions import sreg
+
+from bench import report
+
+AX_URI = 'http://openid.net/srv/ax/1.0'
+
+def makePostArgs():
+    """Return the query of a positive assertion."""
+    args = {
+        'openid.ns': OPENID2_NS,
+        'openid.mode': 'id_res',
+        'openid.op_endpoint': 'http://example.com/openid',
+        'openid.claimed_id': 'http://example.com/user/1',
+        'openid.identity': 'http://example.com/user/1',
+        'openid.return_to': 'http://consumer.example.com/finish?nonce=1',
+        'openid.response_nonce': '2010-01-01T00:00:00ZUNIQUE',
+        'openid.assoc_handle': '{HMAC-SHA1}{4b3c8a00}{q83Lkw==}',
+        'openid.sig': 'nKzKVzvWEcXq4JWhnr0o2nZEdJ0=',
+        'openid.ns.sreg': SREG_URI,
+        'openid.sreg.nickname': 'user1',
+        'openid.sreg.email': 'user1@example.com',
+        'openid.sreg.fullname': 'User One',
+        'openid.ns.ax': AX_URI,
+        'openid.ax.mode': 'fetch_response',
+        'openid.ax.type.email': 'http://axschema.org/contact/email',
+        'openid.ax.value.email': 'user1@example.com',
+        'nonce': '1',
+        }
+
+    signed = [key[7:] for key in args if key.startswith('openid.')]
+    signed.sort()
+    args['openid.signed'] = ','.join(signed)
+    return args
+
+def makeAXPostArgs(count):
+    """Return the query of a positive assertion with C{count} attribute
+    exchange values."""
+    args = makePostArgs()
+    for i in xrange(count):
+        args['openid.ax.type.attr%d' % (i,)] = \
+            'http://example.com/schema/attr%d' % (i,)
+        args['openid.ax.value.attr%d' % (i,)] = 'value %d' % (i,)
+    return args
+
+def makeOpenID1PostArgs():
+    """Return the query of an OpenID 1 positive assertion."""
+    args = {}
+    for key, value in makePostArgs().iteritems():
+        if key.startswith('openid.ns') or key.startswith('openid.ax.'):
+            continue
+        args[key] = value
+    return args
+
+def benchParse(results, options):
+    cases = [
+        ('assertion', makePostArgs()),
+        ('ax50', makeAXPostArgs(50)),
+        ('openid1', makeOpenID1PostArgs()),
+        ]
+
+    results['fromPostArgs'] = {}
+    for name, post_args in cases:
+        message = Message.fromPostArgs(post_args)
+        assert message.toPostArgs() == post_args
+        results['fromPostArgs'][name] = report.summarize(report.timeCalls(
+            lambda: Message.fromPostArgs(post_args), options.batches,
+            options.number))
+
+    message = Message.fromPostArgs(makeOpenID1PostArgs())
+    assert message.getOpenIDNamespace() == OPENID1_NS
+    assert message.getArg(sreg.ns_uri_1_1, 'nickname') == 'user1'
+
+def benchMessage(results, options):
+    post_args = makePostArgs()
+    message = Message.fromPostArgs(post_args)
+    assert message.toPostArgs() == post_args
+
+    def time(func):
+        return report.summarize(report.timeCalls(
+            func, options.batches, options.number))
+
+    def copySetArg():
+        message.copy().setArg(OPENID_NS, 'sig', 'x')
+
+    def setArg():
+        message.setArg(OPENID_NS, 'return_to', post_args['openid.return_to'])
+        message.toPostArgs()
+
+    results['message'] = {
+        'getArg': time(lambda: message.getArg(OPENID_NS, 'return_to')),
+        'hasKey': time(lambda: message.hasKey(OPENID2_NS, 'realm')),
+        'getArgs': time(lambda: message.getArgs(SREG_URI)),
+        'toPostArgs': time(message.toPostArgs),
+        'copy': time(message.copy),
+        'copySetArg': time(copySetArg),
+        'setArg': time(setArg),
+        }
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--batches', type='int', default=20,
+                      help='batches of calls to time [default: %default]')
+    parser.add_option('--number', type='int', default=2000,
+                      help='calls per batch [default: %default]')
+    report.addOptions(parser)
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %r' % (args,))
+
+    results = {}
+    benchParse(results, options)
+    benchMessage(results, options)
+
+    settings = {'batches': options.batches, 'number': options.number}
+    return report.finish(options, 'message', results, settings)
+
+if __name__ == '__main__':
+    sys.exit(main())
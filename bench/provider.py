@@ -0,0 +1,361 @@
+"""A minimal OpenID 2.0 provider for benchmarking consumers.
+
+C{L{Provider}} answers the requests that a relying party makes of a
+provider: Yadis (XRDS) and HTML discovery of an identifier,
+C{associate} and C{check_authentication}.  It also stands in for the
+user's browser at the provider, turning the redirect URL from
+C{L{AuthRequest.redirectURL
+<openid.consumer.consumer.AuthRequest.redirectURL>}} straight into the
+positive assertion that would arrive at the return_to URL.  Every
+request is approved.
+
+The provider can be reached without a network, through
+C{L{ProviderFetcher}}, or over real HTTP on the loopback interface
+with C{L{ProviderServer}}.
+"""
+
+__all__ = ['Provider', 'ProviderFetcher', 'ProviderServer']
+
+import BaseHTTPServer
+import SocketServer
+import cgi
+import threading
+import urlparse
+
+from openid import cryptutil
+from openid import fetchers
+from openid import kvform
+from openid import oidutil
+from openid.association import Association, getSecretSize
+from openid.consumer.consumer import DiffieHellmanSHA1ConsumerSession, \
+     DiffieHellmanSHA256ConsumerSession
+from openid.dh import DiffieHellman
+from openid.message import Message, OPENID2_NS, IDENTIFIER_SELECT
+from openid.store.nonce import mkNonce
+
+XRDS_TEMPLATE = '''\
+<?xml version="1.0" encoding="UTF-8"?>
+<xrds:XRDS xmlns:xrds="xri://$xrds" xmlns="xri://$xrd*($v*2.0)">
+  <XRD>
+    <Service priority="0">
+      <Type>http://specs.openid.net/auth/2.0/signon</Type>
+      <URI>%(server_url)s</URI>
+      <LocalID>%(local_id)s</LocalID>
+    </Service>
+  </XRD>
+</xrds:XRDS>
+'''
+
+HTML_TEMPLATE = '''\
+<html>
+  <head>
+    <title>Benchmark identity</title>
+    <link rel="openid2.provider" href="%(server_url)s" />
+    <link rel="openid2.local_id" href="%(local_id)s" />
+  </head>
+  <body>Benchmark identity page.</body>
+</html>
+'''
+
+_dh_sessions = {
+    'DH-SHA1': DiffieHellmanSHA1ConsumerSession,
+    'DH-SHA256': DiffieHellmanSHA256ConsumerSession,
+    }
+
+class Provider(object):
+    """An OpenID 2.0 provider that approves every request.
+
+    @ivar base_url: The URL that the provider's pages are under.
+
+    @ivar server_url: The provider's OpenID endpoint.
+
+    @ivar stateless: Sign assertions with a private association, so
+        that the relying party has to verify them with
+        C{check_authentication}, even if it has associated.
+    @type stateless: bool
+
+    @ivar assoc_lifetime: Lifetime of the associations handed out, in
+        seconds.
+
+    @ivar requests: How many requests of each kind the provider has
+        answered, by kind: C{'xrds'}, C{'html'}, C{'associate'},
+        C{'check_authentication'} and C{'checkid'}.
+    @type requests: {str:int}
+    """
+
+    assoc_lifetime = 14 * 24 * 60 * 60
+
+    def __init__(self, base_url='http://op.bench.invalid/', stateless=False):
+        self.base_url = base_url
+        self.server_url = base_url + 'server'
+        self.stateless = stateless
+
+        # handle -> Association, for associations shared with relying
+        # parties and for the provider's private ones.
+        self.shared = {}
+        self.private = {}
+        self._private_assoc = None
+
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    def getIdentityURL(self, name='user', discovery='xrds'):
+        """Return an identifier that is discovered as this provider's
+        user C{name}, using either C{'xrds'} or C{'html'} discovery."""
+        return '%s%s/%s' % (self.base_url, discovery, name)
+
+    def handle(self, url, body=None, headers=None):
+        """Answer an HTTP request.
+
+        @returns: The status, headers and body of the response.
+        @rtype: (int, {str:str}, str)
+        """
+        path = urlparse.urlparse(url)[2]
+        if path == urlparse.urlparse(self.server_url)[2]:
+            if body is None:
+                return 405, {'content-type': 'text/plain'}, 'POST only'
+            args = dict(cgi.parse_qsl(body))
+            return self._direct(args)
+
+        for discovery, render in [('xrds', self._renderXRDS),
+                                  ('html', self._renderHTML)]:
+            prefix = urlparse.urlparse(self.getIdentityURL('', discovery))[2]
+            if path.startswith(prefix):
+                self._count(discovery)
+                return render(url)
+
+        return 404, {'content-type': 'text/plain'}, 'Not found'
+
+    def _count(self, kind):
+        self._lock.acquire()
+        try:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+        finally:
+            self._lock.release()
+
+    def _renderXRDS(self, url):
+        body = XRDS_TEMPLATE % {'server_url': self.server_url,
+                                'local_id': url}
+        return 200, {'content-type': 'application/xrds+xml'}, body
+
+    def _renderHTML(self, url):
+        body = HTML_TEMPLATE % {'server_url': self.server_url,
+                                'local_id': url}
+        return 200, {'content-type': 'text/html'}, body
+
+    def _direct(self, args):
+        mode = args.get('openid.mode')
+        if mode == 'associate':
+            fields = self._associate(args)
+        elif mode == 'check_authentication':
+            fields = self._checkAuthentication(args)
+        else:
+            fields = {'error': 'Unsupported mode: %r' % (mode,)}
+
+        fields['ns'] = OPENID2_NS
+        status = 200
+        if 'error' in fields:
+            status = 400
+        else:
+            self._count(mode)
+
+        return status, {'content-type': 'text/plain'}, kvform.dictToKV(fields)
+
+    def _associate(self, args):
+        assoc_type = args.get('openid.assoc_type')
+        session_type = args.get('openid.session_type')
+        try:
+            secret_size = getSecretSize(assoc_type)
+        except ValueError, why:
+            return {'error': str(why), 'error_code': 'unsupported-type'}
+
+        assoc = self._newAssociation(assoc_type, secret_size)
+        self._lock.acquire()
+        try:
+            self.shared[assoc.handle] = assoc
+        finally:
+            self._lock.release()
+
+        fields = {
+            'assoc_type': assoc_type,
+            'session_type': session_type,
+            'assoc_handle': assoc.handle,
+            'expires_in': str(self.assoc_lifetime),
+            }
+
+        if session_type == 'no-encryption':
+            fields['mac_key'] = oidutil.toBase64(assoc.secret)
+        elif session_type in _dh_sessions:
+            session = _dh_sessions[session_type]
+            consumer_public = cryptutil.base64ToLong(
+                args['openid.dh_consumer_public'])
+            dh = DiffieHellman.fromDefaults()
+            enc_mac_key = dh.xorSecret(consumer_public, assoc.secret,
+                                       session.hash_func)
+            fields['dh_server_public'] = cryptutil.longToBase64(dh.public)
+            fields['enc_mac_key'] = oidutil.toBase64(enc_mac_key)
+        else:
+            return {'error': 'Unsupported session type: %r' % (session_type,),
+                    'error_code': 'unsupported-type'}
+
+        return fields
+
+    def _checkAuthentication(self, args):
+        handle = args.get('openid.assoc_handle')
+        assoc = self.private.get(handle)
+        fields = {'is_valid': 'false'}
+        if assoc is not None:
+            signed_args = dict(args)
+            signed_args['openid.mode'] = 'id_res'
+            if assoc.checkPostArgsSignature(signed_args):
+                fields['is_valid'] = 'true'
+
+        invalidate_handle = args.get('openid.invalidate_handle')
+        if (invalidate_handle is not None and
+            invalidate_handle not in self.shared):
+            fields['invalidate_handle'] = invalidate_handle
+
+        return fields
+
+    def _newAssociation(self, assoc_type, secret_size):
+        secret = cryptutil.getBytes(secret_size)
+        handle = '{%s}{%s}' % (assoc_type,
+                               oidutil.toBase64(cryptutil.getBytes(12)))
+        return Association.fromExpiresIn(
+            self.assoc_lifetime, handle, secret, assoc_type)
+
+    def _getPrivateAssociation(self):
+        self._lock.acquire()
+        try:
+            if self._private_assoc is None:
+                assoc = self._newAssociation('HMAC-SHA1', 20)
+                self.private[assoc.handle] = assoc
+                self._private_assoc = assoc
+            return self._private_assoc
+        finally:
+            self._lock.release()
+
+    def respond(self, redirect_url):
+        """Approve the C{checkid_setup} request in a redirect URL.
+
+        @returns: The query arguments of the request that the user's
+            browser would then make to the return_to URL.
+        @rtype: {str:str}
+        """
+        self._count('checkid')
+        query = urlparse.urlparse(redirect_url)[4]
+        request = Message.fromPostArgs(dict(cgi.parse_qsl(query)))
+
+        return_to = request.getArg(OPENID2_NS, 'return_to')
+        claimed_id = request.getArg(OPENID2_NS, 'claimed_id')
+        identity = request.getArg(OPENID2_NS, 'identity')
+        if claimed_id == IDENTIFIER_SELECT:
+            claimed_id = identity = self.getIdentityURL()
+
+        response = Message(OPENID2_NS)
+        response.updateArgs(OPENID2_NS, {
+            'mode': 'id_res',
+            'op_endpoint': self.server_url,
+            'claimed_id': claimed_id,
+            'identity': identity,
+            'return_to': return_to,
+            'response_nonce': mkNonce(),
+            })
+
+        handle = request.getArg(OPENID2_NS, 'assoc_handle')
+        assoc = self.shared.get(handle)
+        if assoc is None or self.stateless:
+            if handle is not None:
+                response.setArg(OPENID2_NS, 'invalidate_handle', handle)
+            assoc = self._getPrivateAssociation()
+
+        args = assoc.signMessage(response).toPostArgs()
+
+        # The browser arrives at the return_to URL, with its query
+        # arguments as well as the assertion.
+        args.update(cgi.parse_qsl(urlparse.urlparse(return_to)[4]))
+        return args
+
+class ProviderFetcher(fetchers.HTTPFetcher):
+    """Answers requests with a C{L{Provider}} instead of the network.
+
+    URLs that are not under the provider's C{base_url} are fetched
+    with C{fallback}, if one is given.
+    """
+
+    def __init__(self, provider, fallback=None):
+        self.provider = provider
+        self.fallback = fallback
+
+    def fetch(self, url, body=None, headers=None):
+        if not url.startswith(self.provider.base_url):
+            if self.fallback is None:
+                raise fetchers.HTTPFetchingError('No route to %r' % (url,))
+            return self.fallback.fetch(url, body, headers)
+
+        status, headers, body = self.provider.handle(url, body, headers)
+        return fetchers.HTTPResponse(url, status, headers, body)
+
+class _ProviderRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Send each response in one write, so that it is not held back
+    # waiting for the client to acknowledge the status line.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._respond(None)
+
+    def do_POST(self):
+        length = int(self.headers.get('content-length', 0))
+        self._respond(self.rfile.read(length))
+
+    def _respond(self, body):
+        provider = self.server.provider
+        url = urlparse.urljoin(provider.base_url, self.path)
+        status, headers, response_body = provider.handle(url, body,
+                                                         self.headers)
+        self.send_response(status)
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, *args):
+        pass
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    # Connections that are kept alive would otherwise hold up the
+    # server, and its shutdown, for as long as they stay open.
+    daemon_threads = True
+
+class ProviderServer(object):
+    """Serves a C{L{Provider}} over HTTP on the loopback interface,
+    from a background thread.
+
+    @ivar provider: The provider, with its C{base_url} pointing at the
+        server.
+    """
+
+    def __init__(self, stateless=False):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0),
+                                            _ProviderRequestHandler)
+        base_url = 'http://127.0.0.1:%d/' % (self._server.server_port,)
+        self.provider = Provider(base_url, stateless)
+        self._server.provider = self.provider
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='ProviderServer')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._thread = None
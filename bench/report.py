@@ -0,0 +1,305 @@
+"""Timing, summaries and saved results for the benchmarks.
+
+Results are nested dictionaries: benchmark case name, then measurement
+name, then statistic.  For example::
+
+    {'MemoryStore/login': {'discovery': {'median_ms': 0.41, ...}}}
+
+C{L{saveResults}} writes them to a JSON file together with a
+description of the machine and revision they were measured on, and
+C{L{compareResults}} reports how a later run differs from a saved one.
+"""
+
+__all__ = [
+    'Recorder',
+    'timeCalls',
+    'summarize',
+    'printResults',
+    'printRates',
+    'saveResults',
+    'loadResults',
+    'compareResults',
+    'addOptions',
+    'finish',
+    ]
+
+import gc
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+timer = timeit.default_timer
+
+class Recorder(object):
+    """Collects the time taken, and the objects allocated, by the
+    named phases of a benchmark.
+
+    Allocations are read from the collector's count of container
+    objects allocated and not yet freed.  The collector is disabled
+    while a phase runs, so the count is the number of objects the
+    phase created and kept alive, plus any still waiting to be freed;
+    it does not see strings and other objects that cannot form
+    cycles.
+
+    @ivar samples: Measurements by phase name: a list of
+        (seconds, objects) pairs.
+    @type samples: {str:[(float, int)]}
+    """
+
+    def __init__(self):
+        self.samples = {}
+
+    def wrap(self, name, func):
+        """Return a function that calls C{func} and records the call
+        as phase C{name}."""
+        def recorded(*args, **kwargs):
+            return self.call(name, func, *args, **kwargs)
+        return recorded
+
+    def call(self, name, func, *args, **kwargs):
+        """Call C{func}, recording the call as phase C{name}."""
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        objects = gc.get_count()[0]
+        start = timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = timer() - start
+            objects = gc.get_count()[0] - objects
+            if gc_enabled:
+                gc.enable()
+            self.samples.setdefault(name, []).append((elapsed, objects))
+
+    def summarize(self):
+        """Summarize the samples of every phase.
+
+        @rtype: {str:{str:float}}
+        """
+        summary = {}
+        for name, samples in self.samples.iteritems():
+            summary[name] = summarize(samples)
+        return summary
+
+def timeCalls(func, batches=20, number=1000):
+    """Time calls to a function that is too quick to time one call at
+    a time.
+
+    C{func} is called C{number} times in each of C{batches} batches,
+    with the collector disabled.
+
+    @returns: A (seconds, objects) sample per batch, for one call.
+    @rtype: [(float, float)]
+    """
+    samples = []
+    calls = xrange(number)
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in xrange(batches):
+            objects = gc.get_count()[0]
+            start = timer()
+            for _ in calls:
+                func()
+            elapsed = timer() - start
+            objects = gc.get_count()[0] - objects
+            samples.append((elapsed / number, float(objects) / number))
+            gc.collect()
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    return samples
+
+def _percentile(ordered, fraction):
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+def summarize(samples):
+    """Summarize (seconds, objects) samples as the count, median,
+    90th percentile and mean in milliseconds and the median number of
+    objects."""
+    times = [seconds for (seconds, _) in samples]
+    times.sort()
+    objects = [count for (_, count) in samples]
+    objects.sort()
+    return {
+        'count': len(samples),
+        'median_ms': _percentile(times, 0.5) * 1000,
+        'p90_ms': _percentile(times, 0.9) * 1000,
+        'mean_ms': sum(times) / len(times) * 1000,
+        'objects': _percentile(objects, 0.5),
+        }
+
+def printResults(results, out=None):
+    if out is None:
+        out = sys.stdout
+
+    fmt = '%-32s %-16s %10s %10s %10s %8s\n'
+    out.write(fmt % ('case', 'phase', 'median ms', 'p90 ms', 'mean ms',
+                     'objects'))
+    for case in sorted(results):
+        for phase in sorted(results[case]):
+            stats = results[case][phase]
+            out.write(fmt % (case, phase,
+                             '%.4g' % stats['median_ms'],
+                             '%.4g' % stats['p90_ms'],
+                             '%.4g' % stats['mean_ms'],
+                             '%.4g' % stats['objects']))
+
+def printRates(results, out=None):
+    """Print the cases that have a C{per_sec} statistic, as calls per
+    second."""
+    if out is None:
+        out = sys.stdout
+
+    fmt = '%-32s %-16s %14s\n'
+    out.write(fmt % ('case', 'phase', 'calls/second'))
+    for case in sorted(results):
+        for phase in sorted(results[case]):
+            per_sec = results[case][phase].get('per_sec')
+            if per_sec is not None:
+                out.write(fmt % (case, phase, '%.0f' % (per_sec,)))
+    out.write('\n')
+
+def _getRevision():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        proc = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+                                cwd=here, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, _ = proc.communicate()
+    except OSError:
+        return None
+
+    if proc.returncode != 0:
+        return None
+
+    return out.strip()
+
+def saveResults(filename, benchmark, results, settings):
+    """Write results to a JSON file.
+
+    @param benchmark: The name of the benchmark.
+    @param settings: The options the benchmark was run with, which
+        must match for two runs to be compared.
+    """
+    data = {
+        'benchmark': benchmark,
+        'settings': settings,
+        'revision': _getRevision(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'results': results,
+        }
+    f = open(filename, 'w')
+    try:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write('\n')
+    finally:
+        f.close()
+
+def loadResults(filename):
+    f = open(filename)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def compareResults(saved, benchmark, results, settings, threshold,
+                   out=None):
+    """Print how results differ from saved ones.
+
+    A phase regresses when its median time is more than C{threshold}
+    (a fraction) slower than the saved median.
+
+    @returns: The number of regressions.
+    @rtype: int
+    """
+    if out is None:
+        out = sys.stdout
+
+    if saved.get('benchmark') != benchmark:
+        out.write('Saved results are for %r, not %r\n' %
+                  (saved.get('benchmark'), benchmark))
+        return 0
+
+    if saved.get('settings') != settings:
+        out.write('Warning: saved results used different settings: %r\n' %
+                  (saved.get('settings'),))
+
+    out.write('Compared with revision %s (%s)\n' %
+              (saved.get('revision'), saved.get('time')))
+
+    fmt = '%-32s %-16s %10s %10s %8s %8s %s\n'
+    out.write(fmt % ('case', 'phase', 'before ms', 'after ms', 'change',
+                     'objects', ''))
+    regressions = 0
+    old_results = saved.get('results', {})
+    for case in sorted(results):
+        for phase in sorted(results[case]):
+            try:
+                old = old_results[case][phase]
+            except KeyError:
+                continue
+
+            new = results[case][phase]
+            if old['median_ms']:
+                change = new['median_ms'] / old['median_ms'] - 1
+            else:
+                change = 0.0
+
+            flag = ''
+            if change > threshold:
+                flag = 'REGRESSION'
+                regressions += 1
+
+            out.write(fmt % (case, phase,
+                             '%.4g' % old['median_ms'],
+                             '%.4g' % new['median_ms'],
+                             '%+.1f%%' % (change * 100),
+                             '%+.4g' % (new['objects'] - old['objects']),
+                             flag))
+
+    return regressions
+
+def addOptions(parser):
+    """Add the options for saving and comparing results to an
+    C{optparse} parser."""
+    parser.add_option('--save', metavar='FILE',
+                      help='write the results to FILE as JSON')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare the results with ones saved in FILE')
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='slowdown of a median that counts as a '
+                      'regression, as a fraction [default: %default]')
+
+def finish(options, benchmark, results, settings):
+    """Print, save and compare results as the options ask.
+
+    @returns: The exit status for the benchmark: 1 if there were
+        regressions, otherwise 0.
+    """
+    printResults(results)
+
+    status = 0
+    if options.compare:
+        sys.stdout.write('\n')
+        saved = loadResults(options.compare)
+        if compareResults(saved, benchmark, results, settings,
+                          options.threshold):
+            status = 1
+
+    if options.save:
+        saveResults(options.save, benchmark, results, settings)
+
+    return status
@@ -0,0 +1,259 @@
+"""Benchmark C{L{SQLiteStore<openid.store.sqlstore.SQLiteStore>}}
+and C{L{SQLiteWALStore<openid.store.sqlstore.SQLiteWALStore>}} with a
+database on disk.
+
+Each case is run for both stores, C{SQLiteStore} as C{rollback}, after
+SQLite's default rollback journal, and C{SQLiteWALStore} as C{wal}:
+
+  - C{STORE/useNonce}: a nonce that has not been used, each in a
+    transaction of its own (C{single}) and C{--batch} at a time in one
+    C{L{batch<openid.store.sqlstore.SQLStore.batch>}} (C{batch})
+  - C{STORE/useNonce/used}: a nonce that was already used
+  - C{STORE/storeAssociation}: storing a new association for one of a
+    hundred servers, the same two ways as C{useNonce}
+  - C{STORE/getAssociation/newest}: the newest association for one
+    server, as C{Consumer.begin} asks for
+  - C{STORE/readwrite}: C{--readers} threads looking up associations
+    (C{read}) while another thread uses nonces (C{write}), each with a
+    connection of its own, for C{--seconds}
+  - C{STORE/cleanupNonces/idle}: cleaning up C{--nonces} nonces when
+    none have expired, as a periodic cleanup mostly does
+  - C{STORE/cleanupNonces/expired}: cleaning up C{--nonces} expired
+    nonces, from a thread of its own
+  - C{STORE/useNonce/during cleanup}: using nonces from another
+    thread, a few hundred a second, while that cleanup runs, as logins
+    would
+
+The times are per call, with the calls per second.
+
+Usage::
+
+    python -m bench.sqlstore [--batch N] [--readers N] [--nonces N]
+        [--save FILE] [--compare FILE]
+"""
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from openid.association import Association
+from openid.store.nonce import SKEW
+from openid.store.sqlstore import SQLiteStore, SQLiteWALStore
+
+from bench import report
+from bench.stores import sqlite3
+
+profiles = [
+    ('rollback', SQLiteStore),
+    ('wal', SQLiteWALStore),
+    ]
+
+def serverURL(i):
+    return 'https://op%d.example.com/openid' % (i,)
+
+def openStore(store_class, filename, pool_size=None):
+    """Make a store that makes a connection for each thread using it,
+    and create its tables."""
+    def connect():
+        return sqlite3.connect(filename, timeout=600,
+                               check_same_thread=False)
+
+    store = store_class(connect(), connect=connect, pool_size=pool_size)
+    store.createTables()
+    return store
+
+def benchStore(results, options, filename, name, store_class):
+    store = openStore(store_class, filename)
+    server_url = serverURL(0)
+    now = int(time.time())
+    counter = iter(xrange(1 << 30))
+
+    def timed(func, per_call=1):
+        stats = report.summarize(report.timeCalls(
+            func, options.batches, options.number / per_call))
+        for key in stats.keys():
+            if key.endswith('_ms'):
+                stats[key] /= per_call
+        stats['per_sec'] = 1000 / stats['mean_ms']
+        return stats
+
+    def use():
+        store.useNonce(server_url, now, 'salt%d' % (counter.next(),))
+
+    def store_():
+        i = counter.next()
+        assoc = Association.fromExpiresIn(
+            1209600, '{HMAC-SHA1}{%d}' % (i,), 's' * 20, 'HMAC-SHA1')
+        store.storeAssociation(serverURL(1 + i % 100), assoc)
+
+    store.storeAssociation(server_url, Association.fromExpiresIn(
+        1209600, '{HMAC-SHA1}{newest}', 's' * 20, 'HMAC-SHA1'))
+    assert store.useNonce(server_url, now, 'used')
+
+    def batched(func):
+        def run():
+            for _ in xrange(options.batch):
+                func()
+        return lambda: store.batch(run)
+
+    results[name + '/useNonce'] = {
+        'single': timed(use),
+        'batch': timed(batched(use), options.batch),
+        }
+    results[name + '/useNonce/used'] = {
+        'single': timed(lambda: store.useNonce(server_url, now, 'used')),
+        }
+    results[name + '/storeAssociation'] = {
+        'single': timed(store_),
+        'batch': timed(batched(store_), options.batch),
+        }
+    results[name + '/getAssociation/newest'] = {
+        'single': timed(lambda: store.getAssociation(server_url)),
+        }
+
+def benchReadWrite(results, options, filename, name, store_class):
+    store = openStore(store_class, filename, options.readers + 1)
+    now = int(time.time())
+    for i in xrange(100):
+        store.storeAssociation(serverURL(i), Association.fromExpiresIn(
+            1209600, '{HMAC-SHA1}{%d}' % (i,), 's' * 20, 'HMAC-SHA1'))
+
+    done = threading.Event()
+    reads = []
+    writes = []
+
+    def read():
+        samples = []
+        i = 0
+        while not done.isSet():
+            start = report.timer()
+            assert store.getAssociation(serverURL(i % 100)) is not None
+            samples.append((report.timer() - start, 0))
+            i += 1
+        reads.extend(samples)
+
+    def write():
+        samples = []
+        i = 0
+        while not done.isSet():
+            start = report.timer()
+            assert store.useNonce(serverURL(i % 100), now, 'rw%d' % (i,))
+            samples.append((report.timer() - start, 0))
+            i += 1
+        writes.extend(samples)
+
+    threads = [threading.Thread(target=read)
+               for _ in xrange(options.readers)]
+    threads.append(threading.Thread(target=write))
+    for thread in threads:
+        thread.start()
+    time.sleep(options.seconds)
+    done.set()
+    for thread in threads:
+        thread.join()
+
+    phases = results[name + '/readwrite'] = {}
+    for phase, samples in [('read', reads), ('write', writes)]:
+        stats = report.summarize(samples)
+        stats['per_sec'] = len(samples) / options.seconds
+        stats['max_ms'] = max([elapsed for (elapsed, _) in samples]) * 1000
+        phases[phase] = stats
+
+def addNonces(store, count, timestamp, prefix):
+    conn = store.conn
+    conn.executemany(
+        'INSERT INTO oid_nonces VALUES (?, ?, ?)',
+        [(serverURL(i % 100), timestamp, '%s%d' % (prefix, i))
+         for i in xrange(count)])
+    conn.commit()
+
+def benchCleanup(results, options, filename, name, store_class):
+    store = openStore(store_class, filename)
+    now = int(time.time())
+    addNonces(store, options.nonces, now, 'live')
+    results[name + '/cleanupNonces/idle'] = {
+        'single': report.summarize(report.timeCalls(
+            store.cleanupNonces, options.batches, 10)),
+        }
+
+    addNonces(store, options.nonces, now - SKEW - 60, 'expired')
+    cleanup = []
+    def clean():
+        start = report.timer()
+        cleanup.append(store.cleanupNonces())
+        cleanup.append(report.timer() - start)
+
+    thread = threading.Thread(target=clean)
+    thread.start()
+    samples = []
+    salts = iter(xrange(1 << 30))
+    while thread.isAlive():
+        time.sleep(0.002)
+        start = report.timer()
+        store.useNonce(serverURL(0), now, 'during%d' % (salts.next(),))
+        samples.append((report.timer() - start, 0))
+    thread.join()
+
+    removed, seconds = cleanup
+    assert removed == options.nonces, (removed, options.nonces)
+    results[name + '/cleanupNonces/expired'] = {
+        'single': report.summarize([(seconds, 0)]),
+        }
+    stats = report.summarize(samples)
+    stats['max_ms'] = max([elapsed for (elapsed, _) in samples]) * 1000
+    results[name + '/useNonce/during cleanup'] = {'single': stats}
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--batch', type='int', default=50,
+                      help='calls in each batch transaction '
+                      '[default: %default]')
+    parser.add_option('--readers', type='int', default=3,
+                      help='threads reading while one writes '
+                      '[default: %default]')
+    parser.add_option('--seconds', type='float', default=2.0,
+                      help='seconds to run the readers and writer for '
+                      '[default: %default]')
+    parser.add_option('--nonces', type='int', default=200000,
+                      help='nonces in the table when cleaning up '
+                      '[default: %default]')
+    parser.add_option('--batches', type='int', default=5,
+                      help='batches of calls to time [default: %default]')
+    parser.add_option('--number', type='int', default=200,
+                      help='calls per batch [default: %default]')
+    report.addOptions(parser)
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %r' % (args,))
+    if sqlite3 is None:
+        parser.error('SQLite is not available')
+
+    directory = tempfile.mkdtemp(prefix='bench-sqlstore-')
+    try:
+        results = {}
+        for name, store_class in profiles:
+            for bench in [benchStore, benchReadWrite, benchCleanup]:
+                filename = os.path.join(
+                    directory, '%s-%s.db' % (name, bench.__name__))
+                bench(results, options, filename, name, store_class)
+    finally:
+        shutil.rmtree(directory)
+
+    report.printRates(results)
+
+    settings = {
+        'batch': options.batch,
+        'readers': options.readers,
+        'seconds': options.seconds,
+        'nonces': options.nonces,
+        'batches': options.batches,
+        'number': options.number,
+        }
+    return report.finish(options, 'sqlstore', results, settings)
+
+if __name__ == '__main__':
+    sys.exit(main())
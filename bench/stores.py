@@ -0,0 +1,73 @@
+"""The stores that benchmarks run against.
+
+Each store is made fresh, in a directory of its own, by name::
+
+    store = makeStore('SQLiteStore', directory)
+"""
+
+__all__ = ['store_names', 'makeStore']
+
+import os
+
+from openid.store.filestore import FileOpenIDStore
+from openid.store.logstore import LogOpenIDStore
+from openid.store.memstore import MemoryStore
+from openid.store.shmstore import SharedMemoryStore
+from openid.store.sqlstore import SQLiteStore, SQLiteWALStore
+
+try:
+    import sqlite3
+except ImportError:
+    try:
+        from pysqlite2 import dbapi2 as sqlite3
+    except ImportError:
+        sqlite3 = None
+
+def _makeMemoryStore(directory):
+    return MemoryStore()
+
+def _makeFileOpenIDStore(directory):
+    return FileOpenIDStore(os.path.join(directory, 'filestore'))
+
+def _makeLogOpenIDStore(directory):
+    return LogOpenIDStore(os.path.join(directory, 'logstore'))
+
+def _makeSharedMemoryStore(directory):
+    return SharedMemoryStore(os.path.join(directory, 'shmstore'))
+
+def _makeSQLiteStore(directory):
+    conn = sqlite3.connect(os.path.join(directory, 'sqlstore.db'))
+    store = SQLiteStore(conn)
+    store.createTables()
+    return store
+
+def _makeSQLiteWALStore(directory):
+    conn = sqlite3.connect(os.path.join(directory, 'sqlstore-wal.db'))
+    store = SQLiteWALStore(conn)
+    store.createTables()
+    return store
+
+# (name, factory, available)
+_stores = [
+    ('MemoryStore', _makeMemoryStore, True),
+    ('FileOpenIDStore', _makeFileOpenIDStore, True),
+    ('LogOpenIDStore', _makeLogOpenIDStore, True),
+    ('SharedMemoryStore', _makeSharedMemoryStore, True),
+    ('SQLiteStore', _makeSQLiteStore, sqlite3 is not None),
+    ('SQLiteWALStore', _makeSQLiteWALStore, sqlite3 is not None),
+    ]
+
+store_names = [name for (name, _, available) in _stores if available]
+
+def makeStore(name, directory):
+    """Make an empty store of the named kind, keeping any files it
+    needs under C{directory}.
+
+    @raises KeyError: if there is no store by that name, or it cannot
+        be used here.
+    """
+    for store_name, factory, available in _stores:
+        if store_name == name and available:
+            return factory(directory)
+
+    raise KeyError(name)
@@ -0,0 +1,146 @@
+"""Stress C{L{ConcurrentMemoryStore
+<openid.store.memstore.ConcurrentMemoryStore>}} from many threads.
+
+Each case runs with every thread count in C{--threads}, with the
+entries split between the default number of stripes (C{striped}) and
+behind a single lock (C{global}):
+
+  - C{nonces/THREADS}: each thread using its own nonces, for
+    C{--servers} servers
+  - C{mixed/THREADS}: each thread looking up the newest association
+    for a server and using a nonce, as a login does
+
+The times are per operation across all threads, with the operations
+per second.  Before timing, every thread tries the same nonces at
+once, and each nonce must be accepted exactly once.
+
+Usage::
+
+    python -m bench.threads [--threads 1,2,4,8] [--save FILE]
+        [--compare FILE]
+"""
+
+import optparse
+import sys
+import threading
+import time
+
+from openid.association import Association
+from openid.store.memstore import ConcurrentMemoryStore
+
+from bench import report
+
+layouts = [
+    ('striped', None),
+    ('global', 1),
+    ]
+
+def serverURL(i):
+    return 'https://op%d.example.com/openid' % (i,)
+
+def runThreads(count, work):
+    """Run C{work(i)} in C{count} threads at once, and return the
+    seconds until the last one finished."""
+    start = threading.Event()
+
+    def run(i):
+        start.wait()
+        work(i)
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in xrange(count)]
+    for thread in threads:
+        thread.start()
+
+    began = report.timer()
+    start.set()
+    for thread in threads:
+        thread.join()
+    return report.timer() - began
+
+def checkNonces(store, count, nonces=2000):
+    """Have every thread try the same nonces, and check that each was
+    accepted once."""
+    now = int(time.time())
+    accepted = [0] * count
+
+    def work(i):
+        for j in xrange(nonces):
+            if store.useNonce(serverURL(j % 4), now, 'shared%d' % (j,)):
+                accepted[i] += 1
+
+    runThreads(count, work)
+    assert sum(accepted) == nonces, (accepted, nonces)
+
+def benchThreads(results, options, count):
+    now = int(time.time())
+    for layout, stripes in layouts:
+        store = ConcurrentMemoryStore(stripes)
+        checkNonces(store, count)
+
+        for i in xrange(options.servers):
+            store.storeAssociation(serverURL(i), Association.fromExpiresIn(
+                1209600, '{HMAC-SHA1}{%d}' % (i,), 's' * 20, 'HMAC-SHA1'))
+
+        runs = iter(xrange(1 << 30))
+
+        def nonces(i):
+            run = runs.next()
+            for j in xrange(options.ops):
+                store.useNonce(serverURL(j % options.servers), now,
+                               '%d-%d-%d' % (run, i, j))
+
+        def mixed(i):
+            run = runs.next()
+            for j in xrange(options.ops):
+                server_url = serverURL(j % options.servers)
+                store.getAssociation(server_url)
+                store.useNonce(server_url, now, 'm%d-%d-%d' % (run, i, j))
+
+        for case, work in [('nonces', nonces), ('mixed', mixed)]:
+            total = count * options.ops
+            samples = [(runThreads(count, work) / total, 0)
+                       for _ in xrange(options.batches)]
+            stats = report.summarize(samples)
+            stats['per_sec'] = 1000 / stats['mean_ms']
+            name = '%s/%d' % (case, count)
+            results.setdefault(name, {})[layout] = stats
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--threads', default='1,2,4,8',
+                      help='thread counts to run with, separated by commas '
+                      '[default: %default]')
+    parser.add_option('--servers', type='int', default=64,
+                      help='servers that the threads use [default: %default]')
+    parser.add_option('--ops', type='int', default=5000,
+                      help='operations per thread in each batch '
+                      '[default: %default]')
+    parser.add_option('--batches', type='int', default=5,
+                      help='batches to time [default: %default]')
+    report.addOptions(parser)
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %r' % (args,))
+
+    try:
+        counts = [int(count) for count in options.threads.split(',')]
+    except ValueError:
+        parser.error('bad thread counts: %r' % (options.threads,))
+
+    results = {}
+    for count in counts:
+        benchThreads(results, options, count)
+
+    report.printRates(results)
+
+    settings = {
+        'threads': options.threads,
+        'servers': options.servers,
+        'ops': options.ops,
+        'batches': options.batches,
+        }
+    return report.finish(options, 'threads', results, settings)
+
+if __name__ == '__main__':
+    sys.exit(main())
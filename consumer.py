@@ -52,29 +52,34 @@ from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 
+from openid import cryptutil
 from openid import fetchers
 from openid.consumer.consumer import Consumer
 from openid.consumer import discover
+from openid.consumer.warmer import AssociationWarmer
 from openid.extensions import pape, sreg
 import fetcher
 import store
 import string
-import random
 
 import models
 
 # Set to True if stack traces should be shown in the browser, etc.
 _DEBUG = False
 
+# Number of recent logins WarmHandler looks at to find popular providers.
+WARM_LOGIN_SAMPLE = 200
+
 
 def GenKeyName(length=8, chars=string.letters + string.digits):
-  return ''.join([random.choice(chars) for i in xrange(length)])
+  return cryptutil.randomString(length, chars)
 
 
 class Session(db.Expando):
   """An in-progress OpenID login."""
   claimed_id = db.StringProperty()
   server_url = db.LinkProperty()
+  type_uris = db.StringListProperty()
 
 
 class Login(db.Model):
@@ -82,6 +87,9 @@ class Login(db.Model):
   status = db.StringProperty(choices=('success', 'cancel', 'failure'))
   claimed_id = db.LinkProperty()
   server_url = db.LinkProperty()
+  # The OpenID service types of the provider's endpoint, so that WarmHandler
+  # can talk to it in the right protocol version.
+  type_uris = db.StringListProperty()
   timestamp = db.DateTimeProperty(auto_now_add=True)
   session = db.ReferenceProperty(Session)
 
@@ -322,6 +330,7 @@ class StartHandler(Handler):
 
     self.session.claimed_id = auth_request.endpoint.claimed_id
     self.session.server_url = auth_request.endpoint.server_url
+    self.session.type_uris = list(auth_request.endpoint.type_uris)
     self.store_session()
 
     sreg_request = sreg.SRegRequest(optional=['nickname', 'fullname', 'email'])
@@ -366,6 +375,7 @@ class FinishHandler(Handler):
       pape_data = pape.Response.fromSuccessResponse(response)
       self.session.claimed_id = response.endpoint.claimed_id
       self.session.server_url = response.endpoint.server_url
+      self.session.type_uris = list(response.endpoint.type_uris)
     elif response.status == 'failure':
       logging.error(str(response))
 
@@ -382,6 +392,7 @@ class FinishHandler(Handler):
                   status=response.status,
                   claimed_id=self.session.claimed_id,
                   server_url=self.session.server_url,
+                  type_uris=self.session.type_uris,
                   session=self.session.key())
     login.put()
 
@@ -396,11 +407,37 @@ class FinishHandler(Handler):
     self.redirect('/')
 
 
+class WarmHandler(webapp.RequestHandler):
+  """Renews associations with the providers used by recent logins.
+
+  Run from cron (see cron.yaml), so that StartHandler rarely has to
+  negotiate an association while the user waits.
+  """
+  def get(self):
+    fetchers.setDefaultFetcher(fetcher.UrlfetchFetcher())
+    warmer = AssociationWarmer(store.DatastoreStore())
+
+    logins = Login.gql('ORDER BY timestamp DESC').fetch(WARM_LOGIN_SAMPLE)
+    for login in logins:
+      # Logins recorded before type_uris was added don't say which
+      # protocol version the provider speaks, so leave those providers to
+      # StartHandler rather than guess.
+      if login.server_url and login.type_uris:
+        endpoint = discover.OpenIDServiceEndpoint()
+        endpoint.server_url = login.server_url
+        endpoint.type_uris = list(login.type_uris)
+        warmer.noteEndpoint(endpoint)
+
+    renewed = warmer.warm()
+    logging.info('Renewed %d associations' % renewed)
+
+
 # Map URLs to our RequestHandler subclasses above
 _URLS = [
   ('/s/openid', FrontPage),
   ('/s/startopenid', StartHandler),
   ('/s/finish', FinishHandler),
+  ('/s/warm', WarmHandler),
 ]
 
 def main(argv):
@@ -32,12 +32,13 @@ __all__ = [
     'Association',
     ]
 
+import struct
 import time
 
 from openid import cryptutil
 from openid import kvform
 from openid import oidutil
-from openid.message import OPENID_NS
+from openid.message import OPENID_NS, OPENID1_NS
 
 all_association_types = [
     'HMAC-SHA1',
@@ -194,6 +195,26 @@ def getSecretSize(assoc_type):
     else:
         raise ValueError('Unsupported association type: %r' % (assoc_type,))
 
+def _sigEq(calculated_sig, message_sig):
+    """Compare a calculated signature with the one a message carries,
+    in constant time."""
+    if isinstance(message_sig, unicode):
+        try:
+            message_sig = message_sig.encode('ascii')
+        except UnicodeError:
+            return False
+
+    return cryptutil.constEq(calculated_sig, message_sig)
+
+# The binary serialization: version, association type (an index into
+# all_association_types, so new types go at the end), handle length,
+# secret length, issued and lifetime, followed by the handle and the
+# secret.  The version byte can never start KV form.
+_binary_version = 3
+_binary_version_byte = chr(_binary_version)
+_binary_header = struct.Struct('!BBHBqq')
+_binary_assoc_types = tuple(all_association_types)
+
 class Association(object):
     """
     This class represents an association between a server and a
@@ -205,6 +226,12 @@ class Association(object):
     of the C{L{handle}}, C{L{secret}}, C{L{issued}}, C{L{lifetime}}, and
     C{L{assoc_type}} instance variables.
 
+    Associations cannot be changed once they are made, so stores and
+    caches can keep and hand out the same object.
+
+    @change: Setting the attributes of an association raises
+        C{AttributeError}.  Make a new one instead.
+
     @ivar handle: This is the handle the server gave this association.
 
     @type handle: C{str}
@@ -241,6 +268,8 @@ class Association(object):
         handle, secret, issued, lifetime, assoc_type
     """
 
+    __slots__ = ('handle', 'secret', 'issued', 'lifetime', 'assoc_type')
+
     # The ordering and name of keys as stored by serialize
     assoc_keys = [
         'version',
@@ -345,11 +374,18 @@ class Association(object):
 #             fmt = 'Wrong size secret (%s bytes) for association type %s'
 #             raise ValueError(fmt % (len(secret), assoc_type))
 
-        self.handle = handle
-        self.secret = secret
-        self.issued = issued
-        self.lifetime = lifetime
-        self.assoc_type = assoc_type
+        _set = object.__setattr__
+        _set(self, 'handle', handle)
+        _set(self, 'secret', secret)
+        _set(self, 'issued', issued)
+        _set(self, 'lifetime', lifetime)
+        _set(self, 'assoc_type', assoc_type)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Association objects cannot be changed')
+
+    def __delattr__(self, name):
+        raise AttributeError('Association objects cannot be changed')
 
     def getExpiresIn(self, now=None):
         """
@@ -380,7 +416,8 @@ class Association(object):
 
         @rtype: C{bool}
         """
-        return type(self) is type(other) and self.__dict__ == other.__dict__
+        return (type(self) is type(other) and
+                self.__getstate__() == other.__getstate__())
 
     def __ne__(self, other):
         """
@@ -395,15 +432,52 @@ class Association(object):
         """
         return not (self == other)
 
-    def serialize(self):
+    def __getstate__(self):
+        """
+        Return the attributes of this association, for pickling.
+
+        @rtype: C{dict}
         """
-        Convert an association to KV form.
+        state = dict(getattr(self, '__dict__', ()))
+        for name in Association.__slots__:
+            state[name] = getattr(self, name)
+        return state
 
-        @return: String in KV form suitable for deserialization by
-            deserialize.
+    def __setstate__(self, state):
+        """
+        Restore the attributes of a pickled association.  This also
+        reads associations pickled before this class had
+        C{__slots__}, whose state is their C{__dict__}.
+        """
+        for name, value in state.iteritems():
+            object.__setattr__(self, name, value)
+
+    def serialize(self, version='2'):
+        """
+        Convert an association to a string.
+
+        Version C{'2'} is KV form, with the secret in base64.  Version
+        C{'3'} is a smaller binary form that is quicker to read: a
+        fixed-size header holding the version, association type,
+        lengths and times, followed by the raw handle and secret.
+        Stores that keep associations as bytes can use it; every
+        version is read by deserialize.
+
+        @param version: The serialization format, C{'2'} or C{'3'}.
+
+        @type version: str
+
+
+        @return: String suitable for deserialization by deserialize.
 
         @rtype: str
         """
+        version = str(version)
+        if version == '3':
+            return self._serializeBinary()
+        elif version != '2':
+            raise ValueError('Unknown version: %r' % (version,))
+
         data = {
             'version':'2',
             'handle':self.handle,
@@ -420,9 +494,24 @@ class Association(object):
 
         return kvform.seqToKV(pairs, strict=True)
 
+    def _serializeBinary(self):
+        handle = self.handle
+        if isinstance(handle, unicode):
+            handle = handle.encode('UTF8')
+
+        try:
+            header = _binary_header.pack(
+                _binary_version, _binary_assoc_types.index(self.assoc_type),
+                len(handle), len(self.secret), int(self.issued),
+                int(self.lifetime))
+        except struct.error, why:
+            raise ValueError('Cannot serialize %r: %s' % (self, why))
+
+        return header + handle + self.secret
+
     def deserialize(cls, assoc_s):
         """
-        Parse an association as stored by serialize().
+        Parse an association as stored by serialize(), in any version.
 
         inverse of serialize
 
@@ -434,6 +523,9 @@ class Association(object):
 
         @return: instance of this class
         """
+        if assoc_s[:1] == _binary_version_byte:
+            return cls._deserializeBinary(assoc_s)
+
         pairs = kvform.kvToSeq(assoc_s, strict=True)
         keys = []
         values = []
@@ -452,6 +544,29 @@ class Association(object):
         secret = oidutil.fromBase64(secret)
         return cls(handle, secret, issued, lifetime, assoc_type)
 
+    def _deserializeBinary(cls, assoc_s):
+        try:
+            (_, type_code, handle_len, secret_len,
+             issued, lifetime) = _binary_header.unpack_from(assoc_s)
+        except struct.error, why:
+            raise ValueError('Bad serialized association: %s' % (why,))
+
+        handle_end = _binary_header.size + handle_len
+        if len(assoc_s) != handle_end + secret_len:
+            raise ValueError('Bad serialized association length: %d' %
+                             (len(assoc_s),))
+
+        if type_code >= len(_binary_assoc_types):
+            raise ValueError('Unknown association type code: %d' %
+                             (type_code,))
+
+        handle = assoc_s[_binary_header.size:handle_end]
+        secret = assoc_s[handle_end:]
+        return cls(handle, secret, issued, lifetime,
+                   _binary_assoc_types[type_code])
+
+    _deserializeBinary = classmethod(_deserializeBinary)
+
     deserialize = classmethod(deserialize)
 
     def sign(self, pairs):
@@ -469,7 +584,9 @@ class Association(object):
         @rtype: str
         """
         kv = kvform.seqToKV(pairs)
+        return self._mac(kv)
 
+    def _mac(self, kv):
         try:
             mac = self._macs[self.assoc_type]
         except KeyError:
@@ -528,11 +645,64 @@ class Association(object):
         @raises ValueError: if the message has no signature or no signature
             can be calculated for it.
         """        
+        post_args = message.getRawPostArgs()
+        if post_args is not None:
+            return self.checkPostArgsSignature(post_args)
+
         message_sig = message.getArg(OPENID_NS, 'sig')
         if not message_sig:
             raise ValueError("%s has no sig." % (message,))
         calculated_sig = self.getMessageSignature(message)
-        return calculated_sig == message_sig
+        return _sigEq(calculated_sig, message_sig)
+
+    def checkPostArgsSignature(self, post_args):
+        """Check the signature of a message given as the query
+        arguments it was received in, without parsing it into a
+        C{L{Message<openid.message.Message>}}.
+
+        The signed fields are looked up directly and encoded in one
+        pass, giving the same result as C{L{checkMessageSignature}} on
+        C{Message.fromPostArgs(post_args)}.
+
+        @param post_args: The query arguments, one value for each key.
+        @type post_args: {str:(str|unicode)}
+
+        @raises ValueError: if the message has no signature or no signature
+            can be calculated for it.
+        """
+        message_sig = post_args.get('openid.sig')
+        if not message_sig:
+            raise ValueError("%r has no sig." % (post_args,))
+
+        signed = post_args.get('openid.signed')
+        if not signed:
+            raise ValueError('Message has no signed list: %r' % (post_args,))
+
+        # Message.toPostArgs leaves out the namespace declarations of
+        # an OpenID 1 message, so they are signed as empty values.
+        openid_ns_uri = post_args.get('openid.ns', OPENID1_NS)
+        is_openid1 = openid_ns_uri == OPENID1_NS
+
+        lines = []
+        for field in signed.split(','):
+            if is_openid1 and (field == 'ns' or field.startswith('ns.')):
+                value = ''
+            else:
+                value = post_args.get('openid.' + field, '')
+
+            if isinstance(field, unicode):
+                field = field.encode('UTF8')
+            if isinstance(value, unicode):
+                value = value.encode('UTF8')
+
+            if '\n' in field or ':' in field or '\n' in value:
+                raise ValueError(
+                    'Invalid signed field %r: %r' % (field, value))
+
+            lines.append('%s:%s\n' % (field, value))
+
+        calculated_sig = oidutil.toBase64(self._mac(''.join(lines)))
+        return _sigEq(calculated_sig, message_sig)
 
 
     def _makePairs(self, message):
@@ -0,0 +1,179 @@
+"""Local caching of check_authentication results.
+
+When a consumer has no association matching an assertion, it can only
+verify the assertion by asking the provider with a
+C{check_authentication} request.  A C{L{CheckAuthCache}} remembers the
+requests that the provider has confirmed, keyed by the provider's
+endpoint URL, the association handle and a digest of the whole
+request, so that verifying the same assertion again is answered
+locally.  The request holds every signed field, so an assertion with
+any signed value changed is sent to the provider again, even if it
+reuses a signature that was confirmed before.  It can also
+hold a fetcher that keeps its connections to providers open, such as
+C{L{KeepAliveHTTPFetcher<openid.fetchers.KeepAliveHTTPFetcher>}}, for
+the requests that do have to be made.
+
+Use it with
+C{L{Consumer.setCheckAuthCache
+<openid.consumer.consumer.Consumer.setCheckAuthCache>}}::
+
+    check_auth_cache = CheckAuthCache(fetchers.KeepAliveHTTPFetcher())
+
+    consumer = Consumer(session, store)
+    consumer.setCheckAuthCache(check_auth_cache)
+
+The cache is only consulted by consumers that have a store.  Replays
+of a cached assertion are then still caught by the store's nonce
+check.  A consumer without a store relies on the provider to reject
+replayed assertions, so it always asks the provider.
+"""
+
+__all__ = ['CheckAuthCache']
+
+import threading
+import time
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python < 2.7
+    OrderedDict = None
+
+from openid import cryptutil
+from openid import fetchers
+from openid.message import OPENID_NS
+from openid.store import nonce
+
+class CheckAuthCache(object):
+    """Remembers positive C{check_authentication} responses.
+
+    @ivar fetcher: The fetcher used for C{check_authentication}
+        requests, or None to use the default fetcher.  Like the default
+        fetcher, it is wrapped in an
+        C{L{openid.fetchers.ExceptionWrappingFetcher}}, so that a
+        provider that cannot be reached fails the verification rather
+        than raising.
+    @type fetcher: C{L{openid.fetchers.HTTPFetcher}}
+
+    @ivar max_age: How long a response is remembered, in seconds.
+        Defaults to the nonce window, L{openid.store.nonce.SKEW},
+        because the assertion's nonce is not accepted after that.
+    @type max_age: int
+
+    @ivar max_entries: The most responses remembered at once.  The
+        oldest ones are forgotten first.
+    @type max_entries: int
+    """
+
+    max_age = nonce.SKEW
+    max_entries = 10000
+
+    def __init__(self, fetcher=None, max_age=None, max_entries=None):
+        if OrderedDict is None:
+            raise RuntimeError('CheckAuthCache requires Python 2.7')
+
+        if fetcher is not None and not isinstance(
+            fetcher, fetchers.ExceptionWrappingFetcher):
+            fetcher = fetchers.ExceptionWrappingFetcher(fetcher)
+        self.fetcher = fetcher
+
+        if max_age is not None:
+            self.max_age = max_age
+
+        if max_entries is not None:
+            self.max_entries = max_entries
+
+        # (server_url, assoc_handle, digest) -> expiry time, oldest first
+        self._verified = OrderedDict()
+
+        # (server_url, assoc_handle) -> [digest]
+        self._digests = {}
+
+        self._lock = threading.Lock()
+
+    def _key(self, server_url, request):
+        """Return the key of a C{check_authentication} request."""
+        assoc_handle = request.getArg(OPENID_NS, 'assoc_handle')
+        digest = cryptutil.sha1(request.toURLEncoded())
+        return (server_url, assoc_handle, digest)
+
+    def isVerified(self, server_url, request, now=None):
+        """Has the provider confirmed this C{check_authentication}
+        request recently?
+
+        @param request: The C{check_authentication} request for the
+            assertion
+        @type request: L{openid.message.Message}
+
+        @rtype: bool
+        """
+        if now is None:
+            now = time.time()
+
+        key = self._key(server_url, request)
+        self._lock.acquire()
+        try:
+            expires = self._verified.get(key)
+            return expires is not None and expires > now
+        finally:
+            self._lock.release()
+
+    def addVerified(self, server_url, request, now=None):
+        """Remember that the provider confirmed this
+        C{check_authentication} request.
+
+        @type request: L{openid.message.Message}
+        """
+        if now is None:
+            now = time.time()
+
+        key = self._key(server_url, request)
+        server_url, assoc_handle, digest = key
+        self._lock.acquire()
+        try:
+            self._expire(now)
+            if key in self._verified:
+                return
+
+            self._verified[key] = now + self.max_age
+            self._digests.setdefault(
+                (server_url, assoc_handle), []).append(digest)
+        finally:
+            self._lock.release()
+
+    def invalidateHandle(self, server_url, assoc_handle):
+        """Forget every assertion made with this association handle.
+
+        @returns: The number of assertions forgotten.
+        @rtype: int
+        """
+        self._lock.acquire()
+        try:
+            digests = self._digests.pop((server_url, assoc_handle), [])
+            for digest in digests:
+                del self._verified[(server_url, assoc_handle, digest)]
+            return len(digests)
+        finally:
+            self._lock.release()
+
+    def _expire(self, now):
+        """Drop expired responses, and the oldest ones if there is no
+        room for another.  Call with the lock held."""
+        while self._verified:
+            key, expires = self._oldest()
+            if expires > now and len(self._verified) < self.max_entries:
+                break
+
+            del self._verified[key]
+            server_url, assoc_handle, digest = key
+            digests = self._digests[(server_url, assoc_handle)]
+            digests.remove(digest)
+            if not digests:
+                del self._digests[(server_url, assoc_handle)]
+
+    def _oldest(self):
+        for item in self._verified.iteritems():
+            return item
+
+    def __len__(self):
+        return len(self._verified)
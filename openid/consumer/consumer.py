@@ -223,17 +223,25 @@ def appEngineLoggingFunction(message, level=0):
 oidutil.log = appEngineLoggingFunction
 
 
-def makeKVPost(request_message, server_url):
+def makeKVPost(request_message, server_url, fetcher=None):
     """Make a Direct Request to an OpenID Provider and return the
     result as a Message object.
 
+    @param fetcher: The fetcher to make the request with, or None to
+        use the default fetcher.
+    @type fetcher: L{openid.fetchers.HTTPFetcher}
+
     @raises openid.fetchers.HTTPFetchingError: if an error is
         encountered in making the HTTP post.
 
     @rtype: L{openid.message.Message}
     """
     # XXX: TESTME
-    resp = fetchers.fetch(server_url, body=request_message.toURLEncoded())
+    body = request_message.toURLEncoded()
+    if fetcher is None:
+        resp = fetchers.fetch(server_url, body=body)
+    else:
+        resp = fetcher.fetch(server_url, body=body)
 
     # Process response in separate function that can be shared by async code.
     return _httpResponseToMessage(resp, server_url)
@@ -462,6 +470,32 @@ class Consumer(object):
         """
         self.consumer.negotiator = SessionNegotiator(association_preferences)
 
+    def setAssociationWarmer(self, warmer):
+        """Report the providers used by this consumer to an
+        association warmer, so that it can renew their associations
+        before they expire.
+
+        @param warmer: The warmer to report to, or None to stop
+            reporting.
+        @type warmer: C{L{openid.consumer.warmer.AssociationWarmer}}
+
+        @returns: None
+        """
+        self.consumer.warmer = warmer
+
+    def setCheckAuthCache(self, cache):
+        """Remember the assertions that providers confirm with
+        check_authentication, so that verifying one again does not
+        need another request.
+
+        @param cache: The cache to use, or None to always ask the
+            provider.
+        @type cache: C{L{openid.consumer.checkauth.CheckAuthCache}}
+
+        @returns: None
+        """
+        self.consumer.check_auth_cache = cache
+
 class DiffieHellmanSHA1ConsumerSession(object):
     session_type = 'DH-SHA1'
     hash_func = staticmethod(cryptutil.sha1)
@@ -571,6 +605,14 @@ class GenericConsumer(object):
         different negotiator to it if you have specific requirements
         for how associations are made.
     @type negotiator: C{L{openid.association.SessionNegotiator}}
+
+    @ivar warmer: An object that is told about every endpoint that
+        this consumer gets an association for, or None.  See
+        C{L{openid.consumer.warmer.AssociationWarmer}}.
+
+    @ivar check_auth_cache: Where confirmed check_authentication
+        responses are remembered, or None.  It is only used when there
+        is a store.  See C{L{openid.consumer.checkauth.CheckAuthCache}}.
     """
 
     # The name of the query parameter that gets added to the return_to
@@ -597,6 +639,8 @@ class GenericConsumer(object):
     def __init__(self, store):
         self.store = store
         self.negotiator = default_negotiator.copy()
+        self.warmer = None
+        self.check_auth_cache = None
 
     def begin(self, service_endpoint):
         """Create an AuthRequest object for the specified
@@ -1096,17 +1140,41 @@ class GenericConsumer(object):
         @returns: True if the request is valid.
         @rtype: bool
         """
-        oidutil.log('Using OpenID check_authentication')
+        # Without a store, the provider is the only thing that stops a
+        # replayed assertion, so it has to be asked every time.
+        cache = self.check_auth_cache
+        if self.store is None:
+            cache = None
+
         request = self._createCheckAuthRequest(message)
         if request is None:
             return False
+
+        # The cache is keyed on the whole request, so a hit means that
+        # the provider confirmed these exact signed values.
+        if cache is not None and cache.isVerified(server_url, request):
+            oidutil.log('Using cached check_authentication response')
+            return True
+
+        oidutil.log('Using OpenID check_authentication')
         try:
-            response = self._makeKVPost(request, server_url)
+            if cache is not None and cache.fetcher is not None:
+                response = self._makeKVPost(request, server_url,
+                                            cache.fetcher)
+            else:
+                response = self._makeKVPost(request, server_url)
         except (fetchers.HTTPFetchingError, ServerError), e:
             oidutil.log('check_authentication failed: %s' % (e[0],))
             return False
-        else:
-            return self._processCheckAuthResponse(response, server_url)
+
+        is_valid = self._processCheckAuthResponse(response, server_url)
+        # Do not remember an assertion made with a handle that the
+        # provider has just told us to invalidate.
+        invalidate_handle = response.getArg(OPENID_NS, 'invalidate_handle')
+        if (is_valid and cache is not None and
+            invalidate_handle != request.getArg(OPENID_NS, 'assoc_handle')):
+            cache.addVerified(server_url, request)
+        return is_valid
 
     def _createCheckAuthRequest(self, message):
         """Generate a check_authentication request message given an
@@ -1153,6 +1221,10 @@ class GenericConsumer(object):
             else:
                 self.store.removeAssociation(server_url, invalidate_handle)
 
+            if self.check_auth_cache is not None:
+                self.check_auth_cache.invalidateHandle(server_url,
+                                                       invalidate_handle)
+
         if is_valid == 'true':
             return True
         else:
@@ -1171,6 +1243,9 @@ class GenericConsumer(object):
         @returns: A valid association for the endpoint's server_url or None
         @rtype: openid.association.Association or NoneType
         """
+        if self.warmer is not None:
+            self.warmer.noteEndpoint(endpoint)
+
         assoc = self.store.getAssociation(endpoint.server_url)
 
         if assoc is None or assoc.expiresIn <= 0:
@@ -1188,8 +1263,15 @@ class GenericConsumer(object):
 
         @rtype: L{openid.association.Association}
         """
-        # Get our preferred session/association type from the negotiatior.
-        assoc_type, session_type = self.negotiator.getAllowedType()
+        # Start with the association/session type that this server
+        # accepted last time, if the store remembers one. Otherwise,
+        # get our preferred session/association type from the
+        # negotiatior.
+        negotiated = self._getNegotiatedType(endpoint)
+        if negotiated is None:
+            assoc_type, session_type = self.negotiator.getAllowedType()
+        else:
+            assoc_type, session_type = negotiated
 
         try:
             assoc = self._requestAssociation(
@@ -1215,10 +1297,51 @@ class GenericConsumer(object):
                                    assoc_type))
                     return None
                 else:
+                    if assoc is not None:
+                        self._storeNegotiatedType(
+                            endpoint, assoc_type, session_type, negotiated)
                     return assoc
         else:
+            if assoc is not None:
+                self._storeNegotiatedType(
+                    endpoint, assoc_type, session_type, negotiated)
             return assoc
 
+    def _getNegotiatedType(self, endpoint):
+        """Get the association/session type that the store remembers
+        this endpoint's server accepting, if our negotiator still
+        allows it.
+
+        @returns: a pair of association type and session type, or None
+        @rtype: (str, str) or NoneType
+        """
+        getNegotiation = getattr(self.store, 'getNegotiation', None)
+        if getNegotiation is None:
+            return None
+
+        negotiated = getNegotiation(endpoint.server_url)
+        if negotiated is None:
+            return None
+
+        # Stores may hand back unicode
+        assoc_type, session_type = str(negotiated[0]), str(negotiated[1])
+        if not self.negotiator.isAllowed(assoc_type, session_type):
+            return None
+
+        return assoc_type, session_type
+
+    def _storeNegotiatedType(self, endpoint, assoc_type, session_type,
+                             negotiated):
+        """Have the store remember the association/session type that
+        this endpoint's server accepted, unless it already does.
+        """
+        if negotiated == (assoc_type, session_type):
+            return
+
+        storeNegotiation = getattr(self.store, 'storeNegotiation', None)
+        if storeNegotiation is not None:
+            storeNegotiation(endpoint.server_url, assoc_type, session_type)
+
     def _extractSupportedAssociationType(self, server_error, endpoint,
                                          assoc_type):
         """Handle ServerErrors resulting from association requests.
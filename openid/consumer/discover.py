@@ -43,6 +43,9 @@ class OpenIDServiceEndpoint(object):
     @ivar canonicalID: For XRI, the persistent identifier.
     """
 
+    __slots__ = ('claimed_id', 'server_url', 'type_uris', 'local_id',
+                 'canonicalID', 'used_yadis', 'display_identifier')
+
     # OpenID service type URIs, listed in order of preference.  The
     # ordering of this list affects yadis and XRI service discovery.
     openid_type_uris = [
@@ -62,6 +65,23 @@ class OpenIDServiceEndpoint(object):
         self.used_yadis = False # whether this came from an XRDS
         self.display_identifier = None
 
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', ()))
+        for name in OpenIDServiceEndpoint.__slots__:
+            state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        # Endpoints stored in sessions before this class had __slots__
+        # were pickled with their __dict__, which may be missing newer
+        # attributes or have ones that are gone.
+        OpenIDServiceEndpoint.__init__(self)
+        for name, value in state.iteritems():
+            try:
+                setattr(self, name, value)
+            except AttributeError:
+                pass
+
     def usesExtension(self, extension_uri):
         return extension_uri in self.type_uris
 
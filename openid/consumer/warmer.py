@@ -0,0 +1,226 @@
+"""Keep associations with frequently used OpenID providers fresh.
+
+When the store has no usable association for a provider,
+C{L{GenericConsumer<openid.consumer.consumer.GenericConsumer>}}
+negotiates one during C{begin}.  That is a Diffie-Hellman exchange
+and a direct request to the provider while the user is waiting for
+the redirect.
+
+An C{L{AssociationWarmer}} remembers which providers logins are
+using, and renews their associations before they run out.  It can be
+driven from a scheduled handler by calling C{L{warm
+<AssociationWarmer.warm>}}, or run on its own in a background thread
+with C{L{start<AssociationWarmer.start>}}::
+
+    warmer = AssociationWarmer(store)
+    warmer.start()
+
+    consumer = Consumer(session, store)
+    consumer.setAssociationWarmer(warmer)
+
+The warmer writes to the same store that the consumers read from, so
+a store shared with a background thread must be safe to use from more
+than one thread.
+"""
+
+__all__ = ['AssociationWarmer']
+
+import sys
+import threading
+
+from openid import oidutil
+from openid.consumer.consumer import GenericConsumer
+
+class AssociationWarmer(object):
+    """Renews associations with the most used OpenID providers ahead
+    of their expiry.
+
+    @ivar consumer: The consumer used to negotiate associations.  Set
+        its C{negotiator} to match the one used for logins if the
+        default association preferences have been changed.
+    @type consumer: C{L{GenericConsumer
+        <openid.consumer.consumer.GenericConsumer>}}
+
+    @ivar max_servers: How many of the most used providers to keep
+        associations with.
+    @type max_servers: int
+
+    @ivar renew_threshold: An association is renewed once fewer than
+        this many seconds remain before it expires.
+    @type renew_threshold: int
+
+    @ivar interval: Seconds between runs of C{L{warm}} when running
+        in a background thread.
+    @type interval: int
+    """
+
+    max_servers = 20
+    renew_threshold = 60 * 60 # One hour, in seconds
+    interval = 5 * 60
+
+    def __init__(self, store, consumer_class=None, max_servers=None,
+                 renew_threshold=None):
+        """
+        @param store: The store that consumers get their associations
+            from.
+        @type store: C{L{openid.store.interface.OpenIDStore}}
+
+        @param consumer_class: The class used to negotiate
+            associations.  Defaults to C{L{GenericConsumer
+            <openid.consumer.consumer.GenericConsumer>}}.
+        """
+        if consumer_class is None:
+            consumer_class = GenericConsumer
+
+        self.store = store
+        self.consumer = consumer_class(store)
+
+        if max_servers is not None:
+            self.max_servers = max_servers
+
+        if renew_threshold is not None:
+            self.renew_threshold = renew_threshold
+
+        # server_url -> use count, halved on every run of warm()
+        self._uses = {}
+
+        # server_url -> the most recently used endpoint for that URL
+        self._endpoints = {}
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def noteEndpoint(self, endpoint):
+        """Record that a login is using this endpoint's provider.
+
+        @type endpoint: L{OpenIDServiceEndpoint
+            <openid.consumer.discover.OpenIDServiceEndpoint>}
+        """
+        server_url = endpoint.server_url
+        self._lock.acquire()
+        try:
+            self._uses[server_url] = self._uses.get(server_url, 0) + 1
+            self._endpoints[server_url] = endpoint
+        finally:
+            self._lock.release()
+
+    def getPopularEndpoints(self):
+        """Return the endpoints of the most used providers, most used
+        first.
+
+        @rtype: [L{OpenIDServiceEndpoint
+            <openid.consumer.discover.OpenIDServiceEndpoint>}]
+        """
+        self._lock.acquire()
+        try:
+            ranked = [(-uses, server_url)
+                      for (server_url, uses) in self._uses.iteritems()]
+            ranked.sort()
+            return [self._endpoints[server_url]
+                    for (_, server_url) in ranked[:self.max_servers]]
+        finally:
+            self._lock.release()
+
+    def needsRenewal(self, server_url, now=None):
+        """Is the best stored association for this provider missing or
+        about to expire?
+
+        @rtype: bool
+        """
+        assoc = self.store.getAssociation(server_url)
+        return (assoc is None or
+                assoc.getExpiresIn(now) < self.renew_threshold)
+
+    def renew(self, endpoint):
+        """Negotiate a new association with this endpoint's provider
+        and put it in the store.
+
+        @returns: The new association, or None if negotiation failed.
+        @rtype: L{openid.association.Association} or NoneType
+        """
+        assoc = self.consumer._negotiateAssociation(endpoint)
+        if assoc is not None:
+            self.store.storeAssociation(endpoint.server_url, assoc)
+        return assoc
+
+    def warm(self, now=None):
+        """Renew the associations of the most used providers that are
+        missing or about to expire.
+
+        Usage counts are halved on every call, so that recently used
+        providers rank above ones that are no longer used.
+
+        @returns: The number of associations that were negotiated.
+        @rtype: int
+        """
+        renewed = 0
+        for endpoint in self.getPopularEndpoints():
+            if self.needsRenewal(endpoint.server_url, now):
+                if self.renew(endpoint) is not None:
+                    renewed += 1
+                else:
+                    oidutil.log('Could not renew association with %s' %
+                                (endpoint.server_url,))
+
+        self._ageUses()
+        return renewed
+
+    def _ageUses(self):
+        self._lock.acquire()
+        try:
+            ranked = []
+            for server_url, uses in self._uses.iteritems():
+                ranked.append((-uses, server_url))
+                self._uses[server_url] = max(1, uses // 2)
+
+            # Forget the least used providers once there are many more
+            # than are being kept warm.
+            ranked.sort()
+            for (_, server_url) in ranked[self.max_servers * 4:]:
+                del self._uses[server_url]
+                del self._endpoints[server_url]
+        finally:
+            self._lock.release()
+
+    def start(self, interval=None):
+        """Run C{L{warm}} every C{interval} seconds in a daemon
+        thread, until C{L{stop}} is called.
+
+        The first run happens after one interval, when some logins
+        have been noted.
+        """
+        if interval is not None:
+            self.interval = interval
+
+        if self._thread is not None:
+            raise RuntimeError('Association warmer is already running')
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='AssociationWarmer')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread started by C{L{start}}."""
+        if self._thread is None:
+            return
+
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            self._stopping.wait(self.interval)
+            if self._stopping.isSet():
+                break
+
+            try:
+                self.warm()
+            except (SystemExit, KeyboardInterrupt, MemoryError):
+                raise
+            except:
+                why = sys.exc_info()[1]
+                oidutil.log('Association warmer failed: %s' % (why,))
@@ -16,6 +16,7 @@ http://www.amk.ca/python/code/crypto
 __all__ = [
     'base64ToLong',
     'binaryToLong',
+    'constEq',
     'hmacSha1',
     'hmacSha256',
     'longToBase64',
@@ -26,9 +27,12 @@ __all__ = [
     'sha256',
     ]
 
+from binascii import hexlify, unhexlify
 import hmac
 import os
 import random
+import threading
+from timeit import default_timer
 
 from openid.oidutil import toBase64, fromBase64
 
@@ -77,6 +81,22 @@ else:
 
     SHA256_AVAILABLE = False
 
+try:
+    # Present in Python >= 2.7.7
+    constEq = hmac.compare_digest
+except AttributeError:
+    def constEq(a, b):
+        """Compare two strings in time that does not depend on where
+        they first differ, so that comparing signatures does not leak
+        how much of a forged signature was right."""
+        if len(a) != len(b):
+            return False
+
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
 try:
     from Crypto.Util.number import long_to_bytes, bytes_to_long
 except ImportError:
@@ -98,16 +118,68 @@ except ImportError:
         def reversed(seq):
             return map(seq.__getitem__, xrange(len(seq) - 1, -1, -1))
 
-    def longToBinary(l):
+    def _pickleLongToBinary(l):
         if l == 0:
             return '\x00'
 
         return ''.join(reversed(pickle.encode_long(l)))
 
-    def binaryToLong(s):
+    def _pickleBinaryToLong(s):
         return pickle.decode_long(''.join(reversed(s)))
+
+    # The same big-endian two's complement encoding as the pickle
+    # functions, through hex strings.
+    def _hexLongToBinary(l):
+        if l < 0:
+            return _pickleLongToBinary(l)
+
+        h = '%x' % (l,)
+        if len(h) % 2:
+            h = '0' + h
+        elif h[0] in '89abcdef':
+            # Leave room for the sign bit
+            h = '00' + h
+
+        return unhexlify(h)
+
+    def _hexBinaryToLong(s):
+        if not s:
+            return 0L
+
+        l = long(hexlify(s), 16)
+        if s[0] > '\x7f':
+            l -= 1L << (len(s) * 8)
+
+        return l
+
+    # (name, longToBinary, binaryToLong)
+    _long_backends = [
+        ('hex', _hexLongToBinary, _hexBinaryToLong),
+        ('pickle', _pickleLongToBinary, _pickleBinaryToLong),
+        ]
+
+    def _timeLongBackend(backend, sample=3L ** 640):
+        _, to_binary, to_long = backend
+        best = None
+        for _ in xrange(3):
+            start = default_timer()
+            for _ in xrange(20):
+                to_long(to_binary(sample))
+            elapsed = default_timer() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+
+    # Use whichever backend is quickest with this Python
+    _timed_backends = [(_timeLongBackend(backend), backend)
+                       for backend in _long_backends]
+    _timed_backends.sort()
+    _long_backend, longToBinary, binaryToLong = _timed_backends[0][1]
+    del _timed_backends
+
 else:
     # We have pycrypto
+    _long_backend = 'pycrypto'
 
     def longToBinary(l):
         if l < 0:
@@ -210,10 +282,108 @@ def longToBase64(l):
 def base64ToLong(s):
     return binaryToLong(fromBase64(s))
 
+class _EntropyPool(object):
+    """Hands out random bytes from a buffer that is refilled from
+    getBytes a block at a time, so that many short strings do not each
+    cost a read from the system's random source.
+
+    The buffer is thrown away in a forked child, which would otherwise
+    hand out the same bytes as its parent.
+    """
+
+    block_size = 4096
+
+    def __init__(self):
+        self._buffer = ''
+        self._offset = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def getBytes(self, n):
+        if n > self.block_size:
+            return getBytes(n)
+
+        self._lock.acquire()
+        try:
+            pid = _getpid()
+            start = self._offset
+            end = start + n
+            if pid != self._pid or end > len(self._buffer):
+                self._buffer = getBytes(self.block_size)
+                self._pid = pid
+                start = 0
+                end = n
+
+            self._offset = end
+            return self._buffer[start:end]
+        finally:
+            self._lock.release()
+
+# Not every sandboxed Python has os.getpid; without it, there is no
+# fork to guard against either.
+_getpid = getattr(os, 'getpid', lambda: None)
+
+_entropy_pool = _EntropyPool()
+
+# (type(chrs), chrs) -> (str.translate table, bytes to drop, limit), for
+# the most recently used alphabets.  The type is part of the key because
+# u'ab' == 'ab', and a unicode alphabet must not get a str table.
+_alphabet_tables = {}
+
+def _getAlphabetTable(chrs):
+    key = (type(chrs), chrs)
+    try:
+        return _alphabet_tables[key]
+    except (KeyError, TypeError):
+        pass
+
+    n = len(chrs)
+    for c in chrs:
+        if not isinstance(c, str) or len(c) != 1:
+            return None
+
+    # Drop the bytes past the last whole multiple of the alphabet, so
+    # that every character is equally likely.
+    limit = 256 - (256 % n)
+    table = (''.join([chrs[b % n] for b in xrange(limit)]) +
+             '\x00' * (256 - limit))
+    reject = ''.join([chr(b) for b in xrange(limit, 256)])
+
+    if isinstance(chrs, str):
+        if len(_alphabet_tables) > 10:
+            _alphabet_tables.clear()
+        _alphabet_tables[key] = (table, reject, limit)
+
+    return (table, reject, limit)
+
 def randomString(length, chrs=None):
     """Produce a string of length random bytes, chosen from chrs."""
     if chrs is None:
         return getBytes(length)
+
+    n = len(chrs)
+    if n == 0 and length > 0:
+        raise ValueError('Cannot choose from an empty alphabet')
+
+    if n <= 256 and length > 0:
+        alphabet = _getAlphabetTable(chrs)
     else:
-        n = len(chrs)
+        alphabet = None
+
+    if alphabet is None:
         return ''.join([chrs[randrange(n)] for _ in xrange(length)])
+
+    # Map a block of random bytes onto the alphabet, dropping the
+    # bytes that would make some characters more likely than others,
+    # and draw more until there are enough.
+    table, reject, limit = alphabet
+    parts = []
+    needed = length
+    while needed > 0:
+        wanted = needed * 256 // limit + 8
+        chars = _entropy_pool.getBytes(wanted).translate(table, reject)
+        chars = chars[:needed]
+        parts.append(chars)
+        needed -= len(chars)
+
+    return ''.join(parts)
@@ -1,3 +1,7 @@
+from binascii import hexlify, unhexlify
+import os
+import threading
+
 from openid import cryptutil
 from openid import oidutil
 
@@ -5,29 +9,110 @@ def strxor(x, y):
     if len(x) != len(y):
         raise ValueError('Inputs to strxor must have the same length')
 
-    xor = lambda (a, b): chr(ord(a) ^ ord(b))
-    return "".join(map(xor, zip(x, y)))
+    if not x:
+        return ''
+
+    # XOR the strings as two big integers, rather than a byte at a
+    # time, and zero-pad the result back out to the full length.
+    xor = long(hexlify(x), 16) ^ long(hexlify(y), 16)
+    return unhexlify('%0*x' % (len(x) * 2, xor))
+
+class FixedBaseTable(object):
+    """Precomputed powers of a fixed base, for raising it to many
+    different exponents.
+
+    Row i holds base ** (j << (window * i)) for every window-sized
+    digit j, so that raising the base to an exponent of n bits takes
+    n / window multiplications instead of the n squarings and about
+    n / 5 multiplications that C{pow} does.
+    """
+
+    def __init__(self, base, modulus, window=6):
+        self.base = long(base)
+        self.modulus = long(modulus)
+        self.window = window
+
+        bits = 0
+        while modulus >> bits:
+            bits += 1
+        self.bits = bits
+
+        self._rows = []
+        row_base = self.base
+        for _ in xrange((bits + window - 1) // window):
+            row = [1L]
+            for _ in xrange((1 << window) - 1):
+                row.append(row[-1] * row_base % self.modulus)
+            self._rows.append(row)
+            row_base = row[-1] * row_base % self.modulus
+
+    def pow(self, exponent):
+        """Return base ** exponent % modulus."""
+        if exponent < 0 or exponent >> self.bits:
+            return pow(self.base, exponent, self.modulus)
+
+        modulus = self.modulus
+        mask = (1 << self.window) - 1
+        window = self.window
+        result = 1L
+        for row in self._rows:
+            if not exponent:
+                break
+
+            digit = exponent & mask
+            if digit:
+                result = result * row[digit] % modulus
+            exponent >>= window
+
+        return result
+
+_default_table = None
+_default_table_lock = threading.Lock()
 
 class DiffieHellman(object):
     DEFAULT_MOD = 155172898181473697471232257763715539915724801966915404479707795314057629378541917580651227423698188993727816152646631438561595825688188889951272158842675419950341258706556549803580104870537681476726513255747040765857479291291572334510643245094715007229621094194349783925984760375594985848253359305585439638443L
 
     DEFAULT_GEN = 2
 
+    # Digit size, in bits, of the FixedBaseTable used to make public
+    # keys with the default modulus and generator.  The table takes
+    # about 1.8MB with 6-bit digits.  Set to None to use pow instead.
+    fixed_base_window = 6
+
     def fromDefaults(cls):
-        return cls(cls.DEFAULT_MOD, cls.DEFAULT_GEN)
+        pool = getDefaultKeyPairPool()
+        if pool is None:
+            return cls(cls.DEFAULT_MOD, cls.DEFAULT_GEN)
+        else:
+            return cls(cls.DEFAULT_MOD, cls.DEFAULT_GEN, pool.get())
 
     fromDefaults = classmethod(fromDefaults)
 
-    def __init__(self, modulus, generator):
+    def __init__(self, modulus, generator, keypair=None):
+        """
+        @param keypair: A (private, public) key pair for this modulus
+            and generator that has never been used before, or None to
+            make a new one.
+        """
         self.modulus = long(modulus)
         self.generator = long(generator)
 
-        self._setPrivate(cryptutil.randrange(1, modulus - 1))
+        if keypair is None:
+            self._setPrivate(cryptutil.randrange(1, modulus - 1))
+        else:
+            self.private, self.public = keypair
 
     def _setPrivate(self, private):
         """This is here to make testing easier"""
         self.private = private
-        self.public = pow(self.generator, self.private, self.modulus)
+        self.public = self._powGenerator(private)
+
+    def _powGenerator(self, exponent):
+        if self.fixed_base_window and self.usingDefaultValues():
+            table = _getDefaultTable(self.fixed_base_window)
+            return table.pow(exponent)
+        else:
+            return pow(self.generator, exponent, self.modulus)
 
     def usingDefaultValues(self):
         return (self.modulus == self.DEFAULT_MOD and
@@ -40,3 +125,205 @@ class DiffieHellman(object):
         dh_shared = self.getSharedSecret(composite)
         hashed_dh_shared = hash_func(cryptutil.longToBinary(dh_shared))
         return strxor(secret, hashed_dh_shared)
+
+def _getDefaultTable(window):
+    global _default_table
+
+    table = _default_table
+    if table is None or table.window != window:
+        _default_table_lock.acquire()
+        try:
+            table = _default_table
+            if table is None or table.window != window:
+                table = FixedBaseTable(DiffieHellman.DEFAULT_GEN,
+                                       DiffieHellman.DEFAULT_MOD, window)
+                _default_table = table
+        finally:
+            _default_table_lock.release()
+
+    return table
+
+class KeyPairPool(object):
+    """A supply of key pairs for the default modulus and generator,
+    made ahead of time by a background thread.
+
+    Install one with C{L{setDefaultKeyPairPool}} and start it, and
+    C{DiffieHellman.fromDefaults} takes its key pairs from the pool
+    instead of making them while an associate request waits::
+
+        pool = KeyPairPool()
+        pool.start()
+        setDefaultKeyPairPool(pool)
+
+    Every key pair is handed out once.  When the pool runs down to
+    C{low_water} pairs, the thread refills it to C{depth}; if it runs
+    out, C{L{get}} makes a pair itself rather than wait.  Pairs made
+    before a C{fork} are thrown away in the child, so that parent and
+    child never use the same one.
+
+    @ivar depth: The number of key pairs the pool is filled to.
+    @ivar low_water: Refill once no more than this many are left.
+    """
+
+    depth = 32
+    low_water = 8
+
+    def __init__(self, depth=None, low_water=None):
+        if depth is not None:
+            self.depth = depth
+
+        if low_water is not None:
+            self.low_water = low_water
+
+        self.modulus = DiffieHellman.DEFAULT_MOD
+        self.generator = DiffieHellman.DEFAULT_GEN
+
+        self._pairs = []
+        self._pid = os.getpid()
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+        self._running = False
+
+    def makeKeyPair(self):
+        """Make a new (private, public) key pair."""
+        dh = DiffieHellman(self.modulus, self.generator)
+        return (dh.private, dh.public)
+
+    def get(self):
+        """Take a key pair that has not been handed out before.
+
+        @rtype: (long, long)
+        """
+        self._cond.acquire()
+        try:
+            self._checkFork()
+            if self._pairs:
+                keypair = self._pairs.pop()
+            else:
+                keypair = None
+
+            if self._running and len(self._pairs) <= self.low_water:
+                self._cond.notify()
+        finally:
+            self._cond.release()
+
+        if keypair is None:
+            keypair = self.makeKeyPair()
+
+        return keypair
+
+    def fill(self):
+        """Fill the pool to C{depth} in this thread."""
+        while True:
+            self._cond.acquire()
+            try:
+                self._checkFork()
+                if len(self._pairs) >= self.depth:
+                    return
+            finally:
+                self._cond.release()
+
+            self._add(self.makeKeyPair())
+
+    def __len__(self):
+        return len(self._pairs)
+
+    def start(self):
+        """Keep the pool filled from a daemon thread, until
+        C{L{stop}} is called."""
+        self._cond.acquire()
+        try:
+            if self._running:
+                raise RuntimeError('Key pair pool is already running')
+            self._startThread()
+        finally:
+            self._cond.release()
+
+    def stop(self):
+        """Stop the thread started by C{L{start}}."""
+        self._cond.acquire()
+        try:
+            thread = self._thread
+            self._running = False
+            self._thread = None
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+        if thread is not None and thread.isAlive():
+            thread.join()
+
+    def _startThread(self):
+        # Called with the lock held.
+        self._running = True
+        self._thread = threading.Thread(target=self._run,
+                                        name='KeyPairPool')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _checkFork(self):
+        # Called with the lock held.
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            del self._pairs[:]
+
+            # Threads do not survive a fork.
+            if self._running:
+                self._startThread()
+
+    def _add(self, keypair):
+        self._cond.acquire()
+        try:
+            if os.getpid() == self._pid:
+                self._pairs.append(keypair)
+        finally:
+            self._cond.release()
+
+    def _run(self):
+        thread = threading.currentThread()
+        while True:
+            self._cond.acquire()
+            try:
+                while (self._thread is thread and
+                       len(self._pairs) > self.low_water):
+                    self._cond.wait()
+
+                if self._thread is not thread:
+                    return
+
+                wanted = self.depth - len(self._pairs)
+            finally:
+                self._cond.release()
+
+            try:
+                for _ in xrange(wanted):
+                    self._add(self.makeKeyPair())
+            except (SystemExit, KeyboardInterrupt, MemoryError):
+                raise
+            except Exception, why:
+                oidutil.log('Key pair pool failed to make a key pair: %s'
+                            % (why,))
+                return
+
+_default_pool = None
+
+def getDefaultKeyPairPool():
+    """Return the pool that C{DiffieHellman.fromDefaults} takes key
+    pairs from, or None."""
+    return _default_pool
+
+def setDefaultKeyPairPool(pool):
+    """Set the pool that C{DiffieHellman.fromDefaults} takes key pairs
+    from.
+
+    @type pool: L{KeyPairPool} or NoneType
+    """
+    global _default_pool
+
+    if pool is not None and (pool.modulus != DiffieHellman.DEFAULT_MOD or
+                             pool.generator != DiffieHellman.DEFAULT_GEN):
+        raise ValueError('Key pair pool is not for the default modulus '
+                         'and generator')
+
+    _default_pool = pool
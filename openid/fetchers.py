@@ -5,9 +5,13 @@ This module contains the HTTP fetcher interface and several implementations.
 
 __all__ = ['fetch', 'getDefaultFetcher', 'setDefaultFetcher', 'HTTPResponse',
            'HTTPFetcher', 'createHTTPFetcher', 'HTTPFetchingError',
-           'HTTPError']
+           'HTTPError', 'KeepAliveHTTPFetcher']
 
+import httplib
+import socket
+import threading
 import urllib2
+import urlparse
 import time
 import cStringIO
 import sys
@@ -226,6 +230,126 @@ class Urllib2Fetcher(HTTPFetcher):
 
         return resp
 
+class KeepAliveHTTPFetcher(HTTPFetcher):
+    """An C{L{HTTPFetcher}} that uses C{httplib} and keeps HTTP/1.1
+    connections open between requests, so that repeated direct
+    requests to the same OpenID provider (associate,
+    check_authentication) do not pay for a new TCP and TLS handshake
+    each time.
+
+    Idle connections are pooled per scheme, host and port.  An
+    instance may be shared between threads; a connection is only ever
+    used by one request at a time.
+
+    @cvar max_idle: The number of idle connections kept per host.
+    @cvar max_redirects: The number of redirects followed before
+        giving up.
+    @cvar timeout: Socket timeout, in seconds.
+    """
+
+    max_idle = 4
+    max_redirects = 10
+    timeout = 20
+
+    _connection_classes = {
+        'http': httplib.HTTPConnection,
+        'https': httplib.HTTPSConnection,
+        }
+
+    def __init__(self):
+        HTTPFetcher.__init__(self)
+        # (scheme, netloc) -> [idle connection]
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, url, body=None, headers=None):
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', USER_AGENT)
+
+        for _ in xrange(self.max_redirects + 1):
+            if not _allowedURL(url):
+                raise ValueError('Bad URL scheme: %r' % (url,))
+
+            resp = self._request(url, body, headers)
+            location = resp.headers.get('location')
+            if resp.status not in [301, 302, 303, 307] or location is None:
+                return resp
+
+            url = urlparse.urljoin(url, location)
+            if resp.status != 307:
+                # Like urllib2, turn a redirected POST into a GET
+                body = None
+
+        raise HTTPError('Too many redirects fetching %r' % (url,))
+
+    def _request(self, url, body, headers):
+        scheme, netloc, path, params, query, _ = urlparse.urlparse(url)
+        target = urlparse.urlunparse(('', '', path or '/', params, query, ''))
+        key = (scheme, netloc)
+
+        headers = dict(headers)
+        if body is None:
+            method = 'GET'
+        else:
+            method = 'POST'
+            headers.setdefault('Content-Type',
+                               'application/x-www-form-urlencoded')
+
+        conn, reused = self._getConnection(key)
+        while True:
+            try:
+                conn.request(method, target, body, headers)
+                httplib_response = conn.getresponse()
+                resp_body = httplib_response.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+
+                # The server closed an idle connection. Try once more
+                # on a fresh one.
+                conn = self._connect(key)
+                reused = False
+            else:
+                break
+
+        if httplib_response.will_close:
+            conn.close()
+        else:
+            self._putConnection(key, conn)
+
+        return HTTPResponse(url, httplib_response.status,
+                            dict(httplib_response.getheaders()), resp_body)
+
+    def _connect(self, key):
+        scheme, netloc = key
+        return self._connection_classes[scheme](netloc, timeout=self.timeout)
+
+    def _getConnection(self, key):
+        """Return an idle connection to the host, or a new one, and
+        whether it was reused."""
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        finally:
+            self._lock.release()
+
+        return self._connect(key), False
+
+    def _putConnection(self, key, conn):
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        finally:
+            self._lock.release()
+
+        conn.close()
+
 class HTTPError(HTTPFetchingError):
     """
     This exception is raised by the C{L{CurlHTTPFetcher}} when it
@@ -2,8 +2,23 @@ __all__ = ['seqToKV', 'kvToSeq', 'dictToKV', 'kvToDict']
 
 from openid import oidutil
 
+import re
 import types
 
+def _documentPattern(flags=0):
+    # A document of lines that need no warnings: every key is not
+    # empty, and no key or value starts or ends with whitespace.
+    key = r'[^\s:](?:[^:\n]*[^\s:])?'
+    value = r'(?:[^\s](?:[^\n]*[^\s])?)?'
+    line_re = re.compile(r'(%s):(%s)\n' % (key, value), flags)
+    document_re = re.compile(r'(?:%s:%s\n)*\Z' % (key, value), flags)
+    return line_re, document_re
+
+# kvToSeq strips ASCII whitespace from the bytes of each line, and
+# seqToKV looks for any Unicode whitespace in the decoded pairs.
+_kv_line_re, _kv_document_re = _documentPattern()
+_, _seq_document_re = _documentPattern(re.UNICODE)
+
 def seqToKV(seq, strict=False):
     """Represent a sequence of pairs of strings as newline-terminated
     key:value pairs. The pairs are generated in the order given.
@@ -14,6 +29,70 @@ def seqToKV(seq, strict=False):
     @return: A string representation of the sequence
     @rtype: str
     """
+    if not isinstance(seq, (list, tuple)):
+        seq = list(seq)
+
+    # Fast path: join the pairs and check all of the lines at once.
+    # Anything unusual goes through _checkedSeqToKV, to get the same
+    # warnings and errors as before.
+    try:
+        kv = _joinStrings(seq)
+        if kv is None:
+            kv = _joinUnicode(seq)
+    except UnicodeDecodeError:
+        kv = None
+
+    if kv is not None:
+        return kv
+
+    return _checkedSeqToKV(seq, strict)
+
+def _joinStrings(seq):
+    # Join pairs of UTF-8 byte strings as they are, decoding the result
+    # once to check it.
+    lines = []
+    for k, v in seq:
+        if type(k) is not str or type(v) is not str or ':' in k:
+            return None
+        lines.append(k + ':' + v + '\n')
+
+    kv = ''.join(lines)
+    if _checkDocument(kv.decode('UTF8'), len(lines)):
+        return kv
+    else:
+        return None
+
+def _joinUnicode(seq):
+    # Join pairs with unicode in them, and encode the result once.
+    lines = []
+    for k, v in seq:
+        if type(k) is str:
+            k = k.decode('UTF8')
+        elif type(k) is not unicode:
+            return None
+
+        if type(v) is str:
+            v = v.decode('UTF8')
+        elif type(v) is not unicode:
+            return None
+
+        if ':' in k:
+            return None
+
+        lines.append(k + u':' + v + u'\n')
+
+    text = u''.join(lines)
+    if _checkDocument(text, len(lines)):
+        return text.encode('UTF8')
+    else:
+        return None
+
+def _checkDocument(text, num_lines):
+    # No newlines inside keys or values, and nothing to warn about
+    return (text.count(u'\n') == num_lines and
+            _seq_document_re.match(text) is not None)
+
+def _checkedSeqToKV(seq, strict):
     def err(msg):
         formatted = 'seqToKV warning: %s: %r' % (msg, seq)
         if strict:
@@ -65,6 +144,20 @@ def kvToSeq(data, strict=False):
         seq = kvToSeq(s)
         seqToKV(kvToSeq(seq)) == seq
     """
+    # Fast path: decode the whole message once, and if every line is
+    # well-formed, take the pairs straight from the regular expression.
+    if type(data) is str:
+        try:
+            text = data.decode('UTF8')
+        except UnicodeDecodeError:
+            pass
+        else:
+            if _kv_document_re.match(text):
+                return _kv_line_re.findall(text)
+
+    return _checkedKvToSeq(data, strict)
+
+def _checkedKvToSeq(data, strict):
     def err(msg):
         formatted = 'kvToSeq warning: %s: %r' % (msg, data)
         if strict:
@@ -54,6 +54,8 @@ OPENID_PROTOCOL_FIELDS = [
     'assoc_handle', 'trust_root', 'openid',
     ]
 
+_protocol_fields = frozenset(OPENID_PROTOCOL_FIELDS)
+
 class UndefinedOpenIDNamespace(ValueError):
     """Raised if the generic OpenID namespace is accessed when there
     is no OpenID namespace set for this message."""
@@ -66,6 +68,18 @@ no_default = object()
 # registerNamespaceAlias.
 registered_aliases = {}
 
+# The OpenID namespace URIs and the registered ones, mapped to
+# themselves.  These are always in _checked_namespaces.
+_known_namespaces = {OPENID1_NS: OPENID1_NS, OPENID2_NS: OPENID2_NS}
+
+# Namespace URIs that Message._fixNS has accepted without a warning,
+# mapped to themselves, so that they are checked once and messages share
+# one copy of each.  Parsed messages declare URIs of their senders'
+# choosing, so when there are _max_checked_namespaces of them, all but
+# the known ones are forgotten and the cache fills up again.
+_checked_namespaces = dict(_known_namespaces)
+_max_checked_namespaces = 1024
+
 class NamespaceAliasRegistrationError(Exception):
     """
     Raised when an alias or namespace URI has already been registered.
@@ -94,6 +108,9 @@ def registerNamespaceAlias(namespace_uri, alias):
               'Alias %r already registered' % (alias,)
 
     registered_aliases[alias] = namespace_uri
+    if ':' in namespace_uri:
+        _known_namespaces[namespace_uri] = namespace_uri
+        _checked_namespaces[namespace_uri] = namespace_uri
 
 class Message(object):
     """
@@ -106,15 +123,25 @@ class Message(object):
 
     @ivar ns_args: two-level dictionary of the values in this message,
         grouped by namespace URI. The first level is the namespace
-        URI.
+        URI.  Copies of a message share these dictionaries until one
+        of them is changed, so change them only with C{L{setArg}} and
+        C{L{delArg}}.
     """
 
     allowed_openid_namespaces = [OPENID1_NS, OPENID2_NS]
 
     def __init__(self, openid_namespace=None):
         """Create an empty Message"""
-        self.args = {}
+        self.ns_args = {}
         self.namespaces = NamespaceMap()
+        self._post_args = None
+        self._rendered = None
+
+        # Whether ns_args, and which of the dictionaries in it, are
+        # shared with a copy of this message
+        self._args_shared = False
+        self._shared_namespaces = ()
+
         if openid_namespace is None:
             self._openid_ns_uri = None
         else:
@@ -123,59 +150,80 @@ class Message(object):
     def fromPostArgs(cls, args):
         """Construct a Message containing a set of POST arguments"""
         self = cls()
-
-        # Partition into "openid." args and bare args
-        openid_args = {}
-        for key, value in args.iteritems():
-            if isinstance(value, list):
-                raise TypeError("query dict must have one value for each key, "
-                                "not lists of values.  Query is %r" % (args,))
-
-
-            try:
-                prefix, rest = key.split('.', 1)
-            except ValueError:
-                prefix = None
-
-            if prefix != 'openid':
-                self.args[(BARE_NS, key)] = value
-            else:
-                openid_args[rest] = value
-
-        self._fromOpenIDArgs(openid_args)
-
+        self._fromArgs(args, True)
+        self._post_args = dict(args)
         return self
 
     fromPostArgs = classmethod(fromPostArgs)
 
+    def getRawPostArgs(self):
+        """Return the arguments that this message was parsed from by
+        C{L{fromPostArgs}}.
+
+        @returns: The arguments, or None if the message was not made
+            by C{fromPostArgs} or has been changed since.
+        @rtype: dict or NoneType
+        """
+        return self._post_args
+
     def fromOpenIDArgs(cls, openid_args):
         """Construct a Message from a parsed KVForm message"""
         self = cls()
-        self._fromOpenIDArgs(openid_args)
+        self._fromArgs(openid_args, False)
         return self
 
     fromOpenIDArgs = classmethod(fromOpenIDArgs)
 
-    def _fromOpenIDArgs(self, openid_args):
-        global registered_aliases
+    def _fromArgs(self, args, post):
+        """Fill in this empty message from a dictionary of arguments,
+        in one pass over them.
+
+        @param post: Whether the arguments are a query, where only the
+            keys that start with "openid." are OpenID arguments, or
+            OpenID arguments without the "openid.".
+        """
+        bare_args = {}
+
+        # OpenID arguments by namespace alias, with NULL_NAMESPACE for
+        # the ones without an alias.  Namespace declarations are added
+        # to self.namespaces as they are found.
+        alias_args = {}
+
+        for key, value in args.iteritems():
+            if post:
+                if isinstance(value, list):
+                    raise TypeError(
+                        "query dict must have one value for each key, "
+                        "not lists of values.  Query is %r" % (args,))
+
+                if not key.startswith('openid.'):
+                    bare_args[key] = value
+                    continue
 
-        ns_args = []
+                key = key[7:]
 
-        # Resolve namespaces
-        for rest, value in openid_args.iteritems():
             try:
-                ns_alias, ns_key = rest.split('.', 1)
+                ns_alias, ns_key = key.split('.', 1)
             except ValueError:
-                ns_alias = NULL_NAMESPACE
-                ns_key = rest
+                if key == 'ns':
+                    # null namespace
+                    self.namespaces.addAlias(value, NULL_NAMESPACE)
+                    continue
 
-            if ns_alias == 'ns':
-                self.namespaces.addAlias(value, ns_key)
-            elif ns_alias == NULL_NAMESPACE and ns_key == 'ns':
-                # null namespace
-                self.namespaces.addAlias(value, NULL_NAMESPACE)
+                ns_alias = NULL_NAMESPACE
+                ns_key = key
             else:
-                ns_args.append((ns_alias, ns_key, value))
+                if ns_alias == 'ns':
+                    self.namespaces.addAlias(value, ns_key)
+                    continue
+
+            try:
+                alias_args[ns_alias][ns_key] = value
+            except KeyError:
+                alias_args[ns_alias] = {ns_key: value}
+
+        if bare_args:
+            self.ns_args[BARE_NS] = bare_args
 
         # Ensure that there is an OpenID namespace definition
         openid_ns_uri = self.namespaces.getNamespaceURI(NULL_NAMESPACE)
@@ -184,25 +232,31 @@ class Message(object):
 
         self.setOpenIDNamespace(openid_ns_uri)
 
-        # Actually put the pairs into the appropriate namespaces
-        for (ns_alias, ns_key, value) in ns_args:
+        # Actually put the pairs into the appropriate namespaces,
+        # resolving each alias once
+        for ns_alias, values in alias_args.iteritems():
             ns_uri = self.namespaces.getNamespaceURI(ns_alias)
             if ns_uri is None:
                 # Only try to map an alias to a default if it's an
                 # OpenID 1.x message.
                 if openid_ns_uri == OPENID1_NS:
-                    for _alias, _uri in registered_aliases.iteritems():
-                        if _alias == ns_alias:
-                            ns_uri = _uri
-                            break
+                    ns_uri = registered_aliases.get(ns_alias)
 
                 if ns_uri is None:
                     ns_uri = openid_ns_uri
-                    ns_key = '%s.%s' % (ns_alias, ns_key)
+                    prefix = ns_alias + '.'
+                    values = dict([(prefix + ns_key, value)
+                                   for (ns_key, value) in values.iteritems()])
                 else:
                     self.namespaces.addAlias(ns_uri, ns_alias)
 
-            self.setArg(ns_uri, ns_key, value)
+            ns_uri = self._fixNS(ns_uri)
+            self.namespaces.add(ns_uri)
+            ns_args = self.ns_args.get(ns_uri)
+            if ns_args is None:
+                self.ns_args[ns_uri] = values
+            else:
+                ns_args.update(values)
 
     def setOpenIDNamespace(self, openid_ns_uri):
         if openid_ns_uri not in self.allowed_openid_namespaces:
@@ -210,6 +264,8 @@ class Message(object):
 
         self.namespaces.addAlias(openid_ns_uri, NULL_NAMESPACE)
         self._openid_ns_uri = openid_ns_uri
+        self._post_args = None
+        self._rendered = None
 
     def getOpenIDNamespace(self):
         return self._openid_ns_uri
@@ -226,12 +282,105 @@ class Message(object):
 
     fromKVForm = classmethod(fromKVForm)
 
+    # Attributes that copy shares between a message and its copy
+    _shared_attributes = ['ns_args', 'namespaces', '_post_args',
+                          '_rendered', '_args_shared', '_shared_namespaces']
+
     def copy(self):
-        return copy.deepcopy(self)
+        """Return a copy of this message.
+
+        The copy shares its arguments and namespace aliases with this
+        message until one of the two is changed, so making it takes the
+        same time however large the message is.
+        """
+        message = object.__new__(self.__class__)
+        for name, value in self.__dict__.iteritems():
+            if name not in self._shared_attributes:
+                value = copy.deepcopy(value)
+            message.__dict__[name] = value
+
+        message.ns_args = self.ns_args
+        self._args_shared = message._args_shared = True
+        message._shared_namespaces = ()
+        message.namespaces = self.namespaces.copy()
+
+        message._rendered = None
+        rendered = self._rendered
+        if rendered is not None and rendered[0] is self.namespaces:
+            message._rendered = (message.namespaces,) + rendered[1:]
+
+        return message
+
+    def _getMutableArgs(self, namespace):
+        """Return the dictionary of the arguments in a namespace, to
+        change them.  Arguments shared with a copy of this message are
+        copied first.
+        """
+        if self._args_shared:
+            self.ns_args = dict(self.ns_args)
+            self._shared_namespaces = set(self.ns_args)
+            self._args_shared = False
+
+        try:
+            ns_args = self.ns_args[namespace]
+        except KeyError:
+            ns_args = self.ns_args[namespace] = {}
+        else:
+            if namespace in self._shared_namespaces:
+                ns_args = self.ns_args[namespace] = dict(ns_args)
+                self._shared_namespaces.discard(namespace)
+
+        return ns_args
+
+    def _getArgs(self):
+        args = {}
+        for namespace, ns_args in self.ns_args.iteritems():
+            for ns_key, value in ns_args.iteritems():
+                args[(namespace, ns_key)] = value
+        return args
+
+    def _setArgs(self, args):
+        ns_args = {}
+        for (namespace, ns_key), value in args.iteritems():
+            try:
+                ns_args[namespace][ns_key] = value
+            except KeyError:
+                ns_args[namespace] = {ns_key: value}
+
+        self.ns_args = ns_args
+        self._args_shared = False
+        self._shared_namespaces = ()
+        self._post_args = None
+        self._rendered = None
+
+    args = property(_getArgs, _setArgs, doc="""
+        All of the values in this message, keyed by (namespace URI,
+        key) pairs.
+
+        Reading it makes a new dictionary each time, so changing that
+        dictionary does not change the message; use C{L{setArg}} and
+        C{L{delArg}} for that.  Assigning a dictionary to it replaces
+        all of the values in the message, as it did when the values
+        were kept in this attribute.
+
+        @type: {(str, str):str}
+        """)
 
     def toPostArgs(self):
         """Return all arguments with openid. in front of namespaced arguments.
         """
+        # The arguments are rendered again only after the message or
+        # its namespace aliases change.
+        rendered = self._rendered
+        if (rendered is None or rendered[0] is not self.namespaces or
+            rendered[1] != self.namespaces.version):
+            rendered = (self.namespaces, self.namespaces.version,
+                        self._renderPostArgs())
+            self._rendered = rendered
+
+        return dict(rendered[2])
+
+    def _renderPostArgs(self):
         args = {}
 
         # Add namespace definitions to the output
@@ -253,9 +402,23 @@ class Message(object):
                     ns_key = 'openid.ns.' + alias
                     args[ns_key] = ns_uri
 
-        for (ns_uri, ns_key), value in self.args.iteritems():
-            key = self.getKey(ns_uri, ns_key)
-            args[key] = value
+        for ns_uri, ns_args in self.ns_args.iteritems():
+            if ns_uri == BARE_NS:
+                prefix = ''
+            else:
+                ns_alias = self.namespaces.getAlias(ns_uri)
+                if ns_alias is None:
+                    # No key can exist (see getKey)
+                    for value in ns_args.itervalues():
+                        args[None] = value
+                    continue
+                elif ns_alias == NULL_NAMESPACE:
+                    prefix = 'openid.'
+                else:
+                    prefix = 'openid.%s.' % (ns_alias,)
+
+            for ns_key, value in ns_args.iteritems():
+                args[prefix + ns_key] = value
 
         return args
 
@@ -348,6 +511,16 @@ class Message(object):
         @param namespace: The string or constant to convert
         @type namespace: str or unicode or BARE_NS or OPENID_NS
         """
+        # Fast paths: the OpenID namespace, and namespace URIs that
+        # have been checked before
+        if namespace is OPENID_NS and self._openid_ns_uri is not None:
+            return self._openid_ns_uri
+
+        try:
+            return _checked_namespaces[namespace]
+        except (KeyError, TypeError):
+            pass
+
         if namespace == OPENID_NS:
             if self._openid_ns_uri is None:
                 raise UndefinedOpenIDNamespace('OpenID namespace not set')
@@ -368,11 +541,17 @@ class Message(object):
                 warnings.warn(fmt % (SREG_URI,), DeprecationWarning,)
                 return SREG_URI
 
+        else:
+            if len(_checked_namespaces) >= _max_checked_namespaces:
+                _checked_namespaces.clear()
+                _checked_namespaces.update(_known_namespaces)
+            _checked_namespaces[namespace] = namespace
+
         return namespace
 
     def hasKey(self, namespace, ns_key):
         namespace = self._fixNS(namespace)
-        return (namespace, ns_key) in self.args
+        return ns_key in self.ns_args.get(namespace, ())
 
     def getKey(self, namespace, ns_key):
         """Get the key for a particular namespaced argument"""
@@ -413,9 +592,8 @@ class Message(object):
             had an OpenID namespace set
         """
         namespace = self._fixNS(namespace)
-        args_key = (namespace, key)
         try:
-            return self.args[args_key]
+            return self.ns_args[namespace][key]
         except KeyError:
             if default is no_default:
                 raise KeyError((namespace, key))
@@ -429,12 +607,7 @@ class Message(object):
         @returntype: dict
         """
         namespace = self._fixNS(namespace)
-        return dict([
-            (ns_key, value)
-            for ((pair_ns, ns_key), value)
-            in self.args.iteritems()
-            if pair_ns == namespace
-            ])
+        return dict(self.ns_args.get(namespace, ()))
 
     def updateArgs(self, namespace, updates):
         """Set multiple key/value pairs in one call
@@ -451,13 +624,28 @@ class Message(object):
         assert key is not None
         assert value is not None
         namespace = self._fixNS(namespace)
-        self.args[(namespace, key)] = value
+        ns_args = self.ns_args.get(namespace)
+        if (ns_args is None or self._args_shared or
+            namespace in self._shared_namespaces):
+            ns_args = self._getMutableArgs(namespace)
+
+        ns_args[key] = value
+        self._post_args = None
+        self._rendered = None
         if not (namespace is BARE_NS):
             self.namespaces.add(namespace)
 
     def delArg(self, namespace, key):
         namespace = self._fixNS(namespace)
-        del self.args[(namespace, key)]
+        if key not in self.ns_args.get(namespace, ()):
+            raise KeyError((namespace, key))
+
+        ns_args = self._getMutableArgs(namespace)
+        del ns_args[key]
+        if not ns_args:
+            del self.ns_args[namespace]
+        self._post_args = None
+        self._rendered = None
 
     def __repr__(self):
         return "<%s.%s %r>" % (self.__class__.__module__,
@@ -465,7 +653,7 @@ class Message(object):
                                self.args)
 
     def __eq__(self, other):
-        return self.args == other.args
+        return self.ns_args == other.ns_args
 
 
     def __ne__(self, other):
@@ -499,10 +687,26 @@ class Message(object):
 
 class NamespaceMap(object):
     """Maintains a bijective map between namespace uris and aliases.
+
+    @ivar version: A number that changes whenever an alias is added.
     """
     def __init__(self):
         self.alias_to_namespace = {}
         self.namespace_to_alias = {}
+        self.version = 0
+
+        # Whether the dictionaries are shared with a copy of this map
+        self._shared = False
+
+    def copy(self):
+        """Return a copy of this map, which shares its dictionaries with
+        this one until an alias is added to either."""
+        other = self.__class__()
+        other.alias_to_namespace = self.alias_to_namespace
+        other.namespace_to_alias = self.namespace_to_alias
+        other.version = self.version
+        self._shared = other._shared = True
+        return other
 
     def getAlias(self, namespace_uri):
         return self.namespace_to_alias.get(namespace_uri)
@@ -530,7 +734,7 @@ class NamespaceMap(object):
         """
         # Check that desired_alias is not an openid protocol field as
         # per the spec.
-        assert desired_alias not in OPENID_PROTOCOL_FIELDS, \
+        assert desired_alias not in _protocol_fields, \
                "%r is not an allowed namespace alias" % (desired_alias,)
 
         # Check that desired_alias does not contain a period as per
@@ -565,8 +769,15 @@ class NamespaceMap(object):
 
         assert (desired_alias == NULL_NAMESPACE or
                 type(desired_alias) in [str, unicode]), repr(desired_alias)
-        self.alias_to_namespace[desired_alias] = namespace_uri
-        self.namespace_to_alias[namespace_uri] = desired_alias
+        if alias is None:
+            if self._shared:
+                self.alias_to_namespace = dict(self.alias_to_namespace)
+                self.namespace_to_alias = dict(self.namespace_to_alias)
+                self._shared = False
+
+            self.alias_to_namespace[desired_alias] = namespace_uri
+            self.namespace_to_alias[namespace_uri] = desired_alias
+            self.version += 1
         return desired_alias
 
     def add(self, namespace_uri):
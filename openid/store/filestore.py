@@ -6,9 +6,11 @@ flat files.
 import string
 import os
 import os.path
+import sys
+import threading
 import time
 
-from errno import EEXIST, ENOENT
+from errno import EEXIST, ENOENT, ENOTDIR, ENOTEMPTY
 
 try:
     from tempfile import mkstemp
@@ -36,7 +38,7 @@ except ImportError:
 from openid.association import Association
 from openid.store.interface import OpenIDStore
 from openid.store import nonce
-from openid import cryptutil, oidutil
+from openid import cryptutil, kvform, oidutil
 
 _filename_allowed = string.ascii_letters + string.digits + '.'
 try:
@@ -106,6 +108,103 @@ def _ensureDir(dir_name):
         if why.errno != EEXIST or not os.path.isdir(dir_name):
             raise
 
+DURABILITY_FSYNC = 'fsync'
+DURABILITY_RENAME_ONLY = 'rename-only'
+DURABILITY_GROUP_COMMIT = 'group-commit'
+
+durability_modes = [
+    DURABILITY_FSYNC,
+    DURABILITY_RENAME_ONLY,
+    DURABILITY_GROUP_COMMIT,
+    ]
+
+def _fsyncPath(path):
+    """Flush a file or directory to disk, if it is still there.
+
+    str -> NoneType
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Replaced or removed since it was written, or a directory on a
+        # platform that cannot open one
+        return
+
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class _GroupCommitter(object):
+    """Flushes the files written in group-commit mode, and their
+    directories, in a background thread.  The thread runs while there
+    are files to flush, waking every C{window} seconds, so that all of
+    the files written in one window share one pass.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._thread = None
+
+    def add(self, filename):
+        """Flush C{filename} and its directory with the next group.
+
+        str -> NoneType
+        """
+        self._lock.acquire()
+        try:
+            self._pending[filename] = None
+            # The thread does not survive a fork
+            if self._thread is None or not self._thread.isAlive():
+                self._thread = threading.Thread(
+                    target=self._run, name='FileOpenIDStore group commit')
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """Flush the files added so far.
+
+        () -> NoneType
+        """
+        self._lock.acquire()
+        try:
+            pending = self._pending
+            self._pending = {}
+        finally:
+            self._lock.release()
+
+        directories = {}
+        for filename in pending:
+            _fsyncPath(filename)
+            directories[os.path.dirname(filename)] = None
+
+        for directory in directories:
+            _fsyncPath(directory)
+
+    def _run(self):
+        while True:
+            time.sleep(self.window)
+            try:
+                self.flush()
+            except (SystemExit, KeyboardInterrupt, MemoryError):
+                raise
+            except:
+                why = sys.exc_info()[1]
+                oidutil.log('FileOpenIDStore group commit failed: %s' %
+                            (why,))
+
+            self._lock.acquire()
+            try:
+                if not self._pending:
+                    self._thread = None
+                    return
+            finally:
+                self._lock.release()
+
 class FileOpenIDStore(OpenIDStore):
     """
     This is a filesystem-based store for OpenID associations and
@@ -121,19 +220,98 @@ class FileOpenIDStore(OpenIDStore):
 
     Methods of this object can raise OSError if unexpected filesystem
     conditions, such as bad permissions or missing directories, occur.
+
+    Associations are kept in a directory for each server URL, so that
+    finding the associations for a server does not depend on how many
+    other servers there are.  Each directory also has an index file
+    naming the association stored last, which C{L{getAssociation}}
+    returns without looking at the others while it is still valid.
+    Nonces are kept in a directory for each hour of timestamps, so
+    that expired nonces are removed a directory at a time and
+    C{L{cleanupNonces}} never looks at the ones still in use.  Files
+    from older versions of this library, which kept associations and
+    nonces each in one directory, are moved into place the first time
+    the store is used.
+
+    @cvar association_version: The version of
+        C{L{Association.serialize<openid.association.Association.serialize>}}
+        that associations are written in.  Associations in any version
+        are read.  Set it to C{'2'} if the directory is shared with
+        older versions of this library, which read only that one.
+
+    @cvar association_index: Whether to keep an index file in each
+        server's directory.  Without one, C{L{getAssociation}} reads
+        every association for the server to find the newest.
+
+    @cvar durability: How associations and other replaced files are
+        written.  Every file is written to a temporary file and renamed
+        into place, so that readers never see part of one.  With
+        C{'fsync'}, each is flushed to disk before the rename, and
+        survives a crash once the method writing it returns.  With
+        C{'rename-only'}, nothing is flushed, and a crash of the machine
+        can lose or empty files written shortly before it; the store
+        removes empty files when it reads them, and the consumer
+        negotiates a new association.  With C{'group-commit'}, files are
+        not flushed while they are written, but a background thread
+        flushes them and their directories in groups every
+        C{group_commit_window} seconds.
+
+    @cvar group_commit_window: The seconds between flushes in
+        group-commit mode, and so the most recent writes a crash of the
+        machine can lose.
     """
 
-    def __init__(self, directory):
+    association_version = '3'
+
+    association_index = True
+
+    durability = DURABILITY_FSYNC
+
+    group_commit_window = 0.05
+
+    # The name of the index file in a server's association directory.
+    # Association file names are 27 characters long.
+    _index_name = 'newest'
+
+    # The file in the association directory that records that it has
+    # been moved to one directory per server.
+    _layout_marker = '.per-server'
+
+    # Nonce timestamps in each nonce directory
+    _nonce_bucket_size = 60 * 60
+
+    # The file in the nonce directory that holds the timestamp of the
+    # oldest nonce directory that cleanupNonces has not removed.
+    _nonce_cursor_name = '.cleanup'
+
+    def __init__(self, directory, durability=None):
         """
         Initializes a new FileOpenIDStore.  This initializes the
-        nonce and association directories, which are subdirectories of
-        the directory passed in.
+        nonce, association and negotiation directories, which are
+        subdirectories of the directory passed in.
 
         @param directory: This is the directory to put the store
             directories in.
 
         @type directory: C{str}
+
+        @param durability: One of C{L{durability_modes}}, to override
+            C{L{durability}}.
+
+        @type durability: C{str}
         """
+        if durability is not None:
+            self.durability = durability
+
+        if self.durability not in durability_modes:
+            raise ValueError('Unknown durability mode: %r' %
+                             (self.durability,))
+
+        if self.durability == DURABILITY_GROUP_COMMIT:
+            self._committer = _GroupCommitter(self.group_commit_window)
+        else:
+            self._committer = None
+
         # Make absolute
         directory = os.path.normpath(os.path.abspath(directory))
 
@@ -141,6 +319,8 @@ class FileOpenIDStore(OpenIDStore):
 
         self.association_dir = os.path.join(directory, 'associations')
 
+        self.negotiation_dir = os.path.join(directory, 'negotiations')
+
         # Temp dir must be on the same filesystem as the assciations
         # directory
         self.temp_dir = os.path.join(directory, 'temp')
@@ -157,8 +337,78 @@ class FileOpenIDStore(OpenIDStore):
         """
         _ensureDir(self.nonce_dir)
         _ensureDir(self.association_dir)
+        _ensureDir(self.negotiation_dir)
         _ensureDir(self.temp_dir)
 
+        marker = os.path.join(self.association_dir, self._layout_marker)
+        if not os.path.exists(marker):
+            self._moveFlatAssociations()
+            os.close(os.open(marker, os.O_CREAT | os.O_WRONLY, 0600))
+
+        if self._readNonceCursor() is None:
+            self._moveFlatNonces()
+
+    def _moveFlatAssociations(self):
+        """Move association files written by older versions of this
+        store, which are named for both the server URL and the handle,
+        into the directory for their server URL.
+
+        () -> NoneType
+        """
+        for name in os.listdir(self.association_dir):
+            filename = os.path.join(self.association_dir, name)
+            if name.startswith('.') or os.path.isdir(filename):
+                continue
+
+            try:
+                server_name, handle_hash = name.rsplit('-', 1)
+            except ValueError:
+                continue
+
+            server_dir = os.path.join(self.association_dir, server_name)
+            _ensureDir(server_dir)
+            try:
+                os.rename(filename, os.path.join(server_dir, handle_hash))
+            except OSError, why:
+                # Another process moved it first
+                if why.errno != ENOENT:
+                    raise
+
+    def _moveFlatNonces(self):
+        """Move the nonce files written by older versions of this store
+        into the directories for their timestamps, removing the expired
+        ones, and start the cleanup cursor at the oldest directory.
+
+        () -> NoneType
+        """
+        now = time.time()
+        oldest = self._nonceBucket(int(now - nonce.SKEW))
+        for name in os.listdir(self.nonce_dir):
+            filename = os.path.join(self.nonce_dir, name)
+            if name.startswith('.'):
+                continue
+
+            try:
+                timestamp = int(name.split('-', 1)[0], 16)
+            except ValueError:
+                continue
+
+            if os.path.isdir(filename):
+                oldest = min(oldest, timestamp)
+            elif abs(timestamp - now) > nonce.SKEW:
+                _removeIfPresent(filename)
+            else:
+                bucket_dir = self._nonceBucketDirectory(timestamp)
+                _ensureDir(bucket_dir)
+                try:
+                    os.rename(filename, os.path.join(bucket_dir, name))
+                except OSError, why:
+                    # Another process moved it first
+                    if why.errno != ENOENT:
+                        raise
+
+        self._writeNonceCursor(oldest)
+
     def _mktemp(self):
         """Create a temporary file on the same filesystem as
         self.association_dir.
@@ -178,14 +428,12 @@ class FileOpenIDStore(OpenIDStore):
             _removeIfPresent(name)
             raise
 
-    def getAssociationFilename(self, server_url, handle):
-        """Create a unique filename for a given server url and
-        handle. This implementation does not assume anything about the
-        format of the handle. The filename that is returned will
-        contain the domain name from the server URL for ease of human
-        inspection of the data directory.
+    def getAssociationDirectory(self, server_url):
+        """Create the name of the directory that holds the associations
+        for a server url.  The name contains the domain name from the
+        server URL for ease of human inspection of the data directory.
 
-        (str, str) -> str
+        str -> str
         """
         if server_url.find('://') == -1:
             raise ValueError('Bad server URL: %r' % server_url)
@@ -193,29 +441,61 @@ class FileOpenIDStore(OpenIDStore):
         proto, rest = server_url.split('://', 1)
         domain = _filenameEscape(rest.split('/', 1)[0])
         url_hash = _safe64(server_url)
-        if handle:
-            handle_hash = _safe64(handle)
-        else:
-            handle_hash = ''
+        dirname = '%s-%s-%s' % (proto, domain, url_hash)
+        return os.path.join(self.association_dir, dirname)
+
+    def getAssociationFilename(self, server_url, handle):
+        """Create a unique filename for a given server url and
+        handle. This implementation does not assume anything about the
+        format of the handle.  The file is in the directory named by
+        C{L{getAssociationDirectory}}, which this returns if the handle
+        is empty.
 
-        filename = '%s-%s-%s-%s' % (proto, domain, url_hash, handle_hash)
+        (str, str) -> str
+        """
+        server_dir = self.getAssociationDirectory(server_url)
+        if not handle:
+            return server_dir
 
+        filename = os.path.join(server_dir, _safe64(handle))
         oidutil.log('filename for %s %s is %s' % (server_url, handle, filename))
-        return os.path.join(self.association_dir, filename)
+        return filename
 
     def storeAssociation(self, server_url, association):
         """Store an association in the association directory.
 
         (str, Association) -> NoneType
         """
-        association_s = association.serialize()
+        association_s = association.serialize(self.association_version)
         filename = self.getAssociationFilename(server_url, association.handle)
+        server_dir, name = os.path.split(filename)
+        for retry in [True, False]:
+            _ensureDir(server_dir)
+            try:
+                self._writeFile(filename, association_s)
+                if self.association_index:
+                    self._writeFile(os.path.join(server_dir, self._index_name),
+                                    name)
+            except OSError, why:
+                # cleanupAssociations removes empty server directories
+                if why.errno != ENOENT or not retry:
+                    raise
+            else:
+                break
+
+    def _writeFile(self, filename, data):
+        """Atomically replace the contents of filename with data, by
+        writing a temporary file and renaming it into place.
+
+        (str, str) -> NoneType
+        """
         tmp_file, tmp = self._mktemp()
 
         try:
             try:
-                tmp_file.write(association_s)
-                os.fsync(tmp_file.fileno())
+                tmp_file.write(data)
+                if self.durability == DURABILITY_FSYNC:
+                    os.fsync(tmp_file.fileno())
             finally:
                 tmp_file.close()
 
@@ -245,6 +525,18 @@ class FileOpenIDStore(OpenIDStore):
             _removeIfPresent(tmp)
             raise
 
+        if self._committer is not None:
+            self._committer.add(filename)
+
+    def flush(self):
+        """Flush the files written so far to disk now, rather than
+        waiting for the next group in group-commit mode.
+
+        () -> NoneType
+        """
+        if self._committer is not None:
+            self._committer.flush()
+
     def getAssociation(self, server_url, handle=None):
         """Retrieve an association. If no handle is specified, return
         the association with the latest expiration.
@@ -252,41 +544,102 @@ class FileOpenIDStore(OpenIDStore):
         (str, str or NoneType) -> Association or NoneType
         """
         oidutil.log('getting association %s for url %s' % (handle, server_url))
-        if handle is None:
-            handle = ''
+        if handle:
+            filename = self.getAssociationFilename(server_url, handle)
+            association = self._getAssociation(filename)
+            if association is None:
+                association = self._getFlatAssociation(server_url, handle)
+            return association
 
-        # The filename with the empty handle is a prefix of all other
-        # associations for the given server URL.
-        filename = self.getAssociationFilename(server_url, handle)
+        server_dir = self.getAssociationDirectory(server_url)
+        index_filename = os.path.join(server_dir, self._index_name)
+        indexed_name = None
+        if self.association_index:
+            indexed_name = self._readIndex(index_filename)
+            if indexed_name is not None:
+                association = self._getAssociation(
+                    os.path.join(server_dir, indexed_name))
+                if association is not None:
+                    return association
 
-        if handle:
-            return self._getAssociation(filename)
+        try:
+            association_files = os.listdir(server_dir)
+        except OSError, why:
+            if why.errno == ENOENT:
+                return None
+            else:
+                raise
+
+        matching_associations = []
+        # read the association files and sort by time issued
+        for name in association_files:
+            if name == self._index_name:
+                continue
+
+            full_name = os.path.join(server_dir, name)
+            association = self._getAssociation(full_name)
+            if association is not None:
+                matching_associations.append(
+                    (association.issued, name, association))
+
+        matching_associations.sort()
+
+        # return the most recently issued one.
+        if matching_associations:
+            (_, name, assoc) = matching_associations[-1]
+            if self.association_index and name != indexed_name:
+                self._writeFile(index_filename, name)
+            return assoc
         else:
-            association_files = os.listdir(self.association_dir)
-            matching_files = []
-            # strip off the path to do the comparison
-            name = os.path.basename(filename)
-            for association_file in association_files:
-                if association_file.startswith(name):
-                    matching_files.append(association_file)
-
-            matching_associations = []
-            # read the matching files and sort by time issued
-            for name in matching_files:
-                full_name = os.path.join(self.association_dir, name)
-                association = self._getAssociation(full_name)
-                if association is not None:
-                    matching_associations.append(
-                        (association.issued, association))
+            return None
 
-            matching_associations.sort()
+    def _readIndex(self, index_filename):
+        """Return the name of the association file that an index file
+        names, or None.
 
-            # return the most recently issued one.
-            if matching_associations:
-                (_, assoc) = matching_associations[-1]
-                return assoc
-            else:
+        str -> str or NoneType
+        """
+        try:
+            index_file = file(index_filename, 'rb')
+        except IOError, why:
+            if why.errno == ENOENT:
                 return None
+            else:
+                raise
+
+        try:
+            name = index_file.read()
+        finally:
+            index_file.close()
+
+        if not name or name == self._index_name or \
+               [c for c in name if not (_isFilenameSafe(c) or c == '_')]:
+            return None
+
+        return name
+
+    def _getFlatAssociation(self, server_url, handle):
+        """Look for an association file written by an older version of
+        this store since this one moved the others, and move it into
+        place.
+
+        (str, str) -> Association or NoneType
+        """
+        server_dir = self.getAssociationDirectory(server_url)
+        handle_hash = _safe64(handle)
+        flat_filename = '%s-%s' % (server_dir, handle_hash)
+        if not os.path.exists(flat_filename):
+            return None
+
+        filename = os.path.join(server_dir, handle_hash)
+        _ensureDir(server_dir)
+        try:
+            os.rename(flat_filename, filename)
+        except OSError, why:
+            if why.errno != ENOENT:
+                raise
+
+        return self._getAssociation(filename)
 
     def _getAssociation(self, filename):
         oidutil.log('getting association from file %s' % filename)
@@ -331,6 +684,59 @@ class FileOpenIDStore(OpenIDStore):
             filename = self.getAssociationFilename(server_url, handle)
             return _removeIfPresent(filename)
 
+    def getNegotiationFilename(self, server_url):
+        """Create a filename for the negotiation memory of a server
+        url, named like its association files.
+
+        str -> str
+        """
+        if server_url.find('://') == -1:
+            raise ValueError('Bad server URL: %r' % server_url)
+
+        proto, rest = server_url.split('://', 1)
+        domain = _filenameEscape(rest.split('/', 1)[0])
+        url_hash = _safe64(server_url)
+        filename = '%s-%s-%s' % (proto, domain, url_hash)
+        return os.path.join(self.negotiation_dir, filename)
+
+    def storeNegotiation(self, server_url, assoc_type, session_type):
+        """Remember the association and session type that a server
+        accepted.
+
+        (str, str, str) -> NoneType
+        """
+        negotiation_s = kvform.seqToKV([('assoc_type', assoc_type),
+                                        ('session_type', session_type)])
+        self._writeFile(self.getNegotiationFilename(server_url),
+                        negotiation_s)
+
+    def getNegotiation(self, server_url):
+        """Retrieve the association and session type that a server
+        last accepted.
+
+        str -> (str, str) or NoneType
+        """
+        filename = self.getNegotiationFilename(server_url)
+        try:
+            negotiation_file = file(filename, 'rb')
+        except IOError, why:
+            if why.errno == ENOENT:
+                return None
+            else:
+                raise
+
+        try:
+            negotiation_s = negotiation_file.read()
+        finally:
+            negotiation_file.close()
+
+        try:
+            negotiation = kvform.kvToDict(negotiation_s)
+            return negotiation['assoc_type'], negotiation['session_type']
+        except (ValueError, KeyError):
+            _removeIfPresent(filename)
+            return None
+
     def useNonce(self, server_url, timestamp, salt):
         """Return whether this nonce is valid.
 
@@ -353,24 +759,103 @@ class FileOpenIDStore(OpenIDStore):
         filename = '%08x-%s-%s-%s-%s' % (timestamp, proto, domain,
                                          url_hash, salt_hash)
 
-        filename = os.path.join(self.nonce_dir, filename)
+        bucket_dir = self._nonceBucketDirectory(timestamp)
+        filename = os.path.join(bucket_dir, filename)
+        for retry in [True, False]:
+            try:
+                fd = os.open(filename,
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0200)
+            except OSError, why:
+                if why.errno == EEXIST:
+                    return False
+                elif why.errno == ENOENT and retry:
+                    # The first nonce with a timestamp in this hour
+                    _ensureDir(bucket_dir)
+                else:
+                    raise
+            else:
+                os.close(fd)
+                return True
+
+    def _nonceBucket(self, timestamp):
+        """The first timestamp in the nonce directory for a timestamp.
+
+        int -> int
+        """
+        return timestamp - timestamp % self._nonce_bucket_size
+
+    def _nonceBucketDirectory(self, timestamp):
+        """The directory that holds the nonces with a timestamp.
+
+        int -> str
+        """
+        return os.path.join(self.nonce_dir,
+                            '%08x' % (self._nonceBucket(timestamp),))
+
+    def _readNonceCursor(self):
+        """Return the timestamp of the oldest nonce directory that
+        C{L{cleanupNonces}} has not removed, or None.
+
+        () -> int or NoneType
+        """
+        cursor_filename = os.path.join(self.nonce_dir, self._nonce_cursor_name)
         try:
-            fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0200)
-        except OSError, why:
-            if why.errno == EEXIST:
-                return False
+            cursor_file = file(cursor_filename, 'rb')
+        except IOError, why:
+            if why.errno == ENOENT:
+                return None
             else:
                 raise
-        else:
-            os.close(fd)
-            return True
+
+        try:
+            cursor_s = cursor_file.read()
+        finally:
+            cursor_file.close()
+
+        try:
+            return int(cursor_s, 16)
+        except ValueError:
+            return None
+
+    def _writeNonceCursor(self, bucket):
+        """Record the timestamp of the oldest nonce directory that
+        C{L{cleanupNonces}} has not removed.
+
+        int -> NoneType
+        """
+        self._writeFile(
+            os.path.join(self.nonce_dir, self._nonce_cursor_name),
+            '%08x' % (bucket,))
+
+    def _serverDirectories(self):
+        """The directories that hold each server's associations.
+
+        () -> [str]
+        """
+        server_dirs = []
+        for name in os.listdir(self.association_dir):
+            if not name.startswith('.'):
+                server_dirs.append(os.path.join(self.association_dir, name))
+        return server_dirs
 
     def _allAssocs(self):
         all_associations = []
 
-        association_filenames = map(
-            lambda filename: os.path.join(self.association_dir, filename),
-            os.listdir(self.association_dir))
+        association_filenames = []
+        for server_dir in self._serverDirectories():
+            try:
+                names = os.listdir(server_dir)
+            except OSError, why:
+                if why.errno in (ENOENT, ENOTDIR):
+                    continue
+                else:
+                    raise
+
+            for name in names:
+                if name != self._index_name:
+                    association_filenames.append(
+                        os.path.join(server_dir, name))
+
         for association_filename in association_filenames:
             try:
                 association_file = file(association_filename, 'rb')
@@ -413,19 +898,61 @@ class FileOpenIDStore(OpenIDStore):
             if assoc.getExpiresIn() == 0:
                 _removeIfPresent(assoc_filename)
                 removed += 1
+
+        # Remove the directories of servers with no associations left
+        for server_dir in self._serverDirectories():
+            try:
+                names = os.listdir(server_dir)
+            except OSError:
+                continue
+
+            if names and names != [self._index_name]:
+                continue
+
+            _removeIfPresent(os.path.join(server_dir, self._index_name))
+            try:
+                os.rmdir(server_dir)
+            except OSError:
+                # An association was stored in it since
+                pass
+
         return removed
 
     def cleanupNonces(self):
-        nonces = os.listdir(self.nonce_dir)
-        now = time.time()
-
+        bucket = self._readNonceCursor()
+        if bucket is None:
+            # Removed by hand; look for the oldest directory again.
+            self._moveFlatNonces()
+            bucket = self._readNonceCursor()
+
+        # Remove the directories whose newest timestamp has expired,
+        # starting from the cursor, so that the directories of nonces
+        # that are still in use are not looked at.
+        expired = time.time() - nonce.SKEW
+        start = bucket
         removed = 0
-        # Check all nonces for expiry
-        for nonce_fname in nonces:
-            timestamp = nonce_fname.split('-', 1)[0]
-            timestamp = int(timestamp, 16)
-            if abs(timestamp - now) > nonce.SKEW:
-                filename = os.path.join(self.nonce_dir, nonce_fname)
-                _removeIfPresent(filename)
-                removed += 1
+        while bucket + self._nonce_bucket_size - 1 < expired:
+            bucket_dir = self._nonceBucketDirectory(bucket)
+            try:
+                nonce_fnames = os.listdir(bucket_dir)
+            except OSError, why:
+                if why.errno != ENOENT:
+                    raise
+            else:
+                for nonce_fname in nonce_fnames:
+                    if _removeIfPresent(os.path.join(bucket_dir, nonce_fname)):
+                        removed += 1
+                try:
+                    os.rmdir(bucket_dir)
+                except OSError, why:
+                    if why.errno == ENOTEMPTY:
+                        # A nonce was used as it expired; try again
+                        # next time.
+                        break
+                    elif why.errno != ENOENT:
+                        raise
+            bucket += self._nonce_bucket_size
+
+        if bucket != start:
+            self._writeNonceCursor(bucket)
         return removed
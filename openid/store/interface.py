@@ -16,7 +16,7 @@ class OpenIDStore(object):
         C{L{cleanupAssociations}}, and C{L{cleanup}}.
 
     @sort: storeAssociation, getAssociation, removeAssociation,
-        useNonce
+        storeNegotiation, getNegotiation, useNonce
     """
 
     def storeAssociation(self, server_url, association):
@@ -124,6 +124,61 @@ class OpenIDStore(object):
         """
         raise NotImplementedError
 
+    def storeNegotiation(self, server_url, assoc_type, session_type):
+        """
+        This method records the association type and association
+        session type that the identity server last accepted, so that
+        the consumer can ask for them first the next time it
+        negotiates an association with that server.
+
+        Remembering this is optional.  The default implementation
+        forgets it, and the consumer falls back to the preferences of
+        its C{L{SessionNegotiator
+        <openid.association.SessionNegotiator>}}.
+
+
+        @param server_url: The URL of the identity server.  The same
+            character set caveats as for C{L{storeAssociation}} apply.
+
+        @type server_url: C{str}
+
+
+        @param assoc_type: The association type, such as
+            C{'HMAC-SHA1'}.
+
+        @type assoc_type: C{str}
+
+
+        @param session_type: The association session type, such as
+            C{'DH-SHA1'}.
+
+        @type session_type: C{str}
+
+
+        @return: C{None}
+
+        @rtype: C{NoneType}
+        """
+        return None
+
+    def getNegotiation(self, server_url):
+        """
+        This method returns the association type and association
+        session type recorded with C{L{storeNegotiation}} for the
+        identity server, or C{None} if nothing has been recorded.
+
+
+        @param server_url: The URL of the identity server.
+
+        @type server_url: C{str}
+
+
+        @return: The pair of association type and session type.
+
+        @rtype: C{(str, str)} or C{NoneType}
+        """
+        return None
+
     def useNonce(self, server_url, timestamp, salt):
         """Called when using a nonce.
 
@@ -0,0 +1,629 @@
+"""
+This module contains an C{L{OpenIDStore}} that keeps everything in a
+few append-only log files, for systems where one file per association
+and per nonce is too many files and too many system calls.
+
+Each change to the store is a record appended to the newest segment
+file in the store's directory: an association stored or removed, a
+nonce used or a negotiation recorded.  Every process using the store
+keeps an index of the live records in memory, built by reading the
+segments when the store is opened and brought up to date with the
+records other processes have appended since, which it reads through
+C{mmap}.  An association is read from its segment when it is asked
+for.
+
+Processes take turns with C{flock} on a lock file in the directory, so
+this store only works on Unix, and not on NFS.  When a segment grows
+past C{L{LogOpenIDStore.segment_size}} the next record starts a new
+one, and once there are more than C{L{LogOpenIDStore.max_segments}}
+the live records are copied into a single new segment and the old ones
+are removed.  The cleanup methods do that too, leaving out the expired
+records.
+
+Every record carries a CRC, so a record left half written by a crash
+is found, and removed by the next process that writes to the store.
+"""
+
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from openid.association import Association
+from openid.store.interface import OpenIDStore
+from openid.store import nonce
+
+# Record types
+_ASSOCIATION = 1
+_REMOVE_ASSOCIATION = 2
+_NONCE = 3
+_NEGOTIATION = 4
+# The records continue in the next segment.
+_NEXT_SEGMENT = 5
+# The segments up to this one have been compacted into a newer one.
+_COMPACTED = 6
+
+# CRC32 of the rest of the record, type, key length, value length
+_record_header = struct.Struct('!IBII')
+
+# Keys of association records: server URL length, then the server URL
+# and the handle.
+_url_length = struct.Struct('!I')
+
+# Keys of nonce records: timestamp and server URL length, then the
+# server URL and the salt.
+_nonce_key = struct.Struct('!qI')
+
+# Values of negotiation records: association type length, then the
+# association type and the session type.
+_type_length = struct.Struct('!H')
+
+_segment_suffix = '.log'
+
+def _segmentName(segment):
+    return '%08d%s' % (segment, _segment_suffix)
+
+def _pack(record_type, key, value=''):
+    """Make a record.
+
+    (int, str, str) -> str
+    """
+    header = _record_header.pack(0, record_type, len(key), len(value))
+    crc = zlib.crc32(value, zlib.crc32(key, zlib.crc32(header[4:])))
+    return _record_header.pack(crc & 0xffffffff, record_type, len(key),
+                               len(value)) + key + value
+
+def _utf8(s):
+    """Keys are made of bytes; server URLs from discovery are unicode.
+
+    str or unicode -> str
+    """
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+def _associationKey(server_url, handle):
+    return _url_length.pack(len(server_url)) + server_url + handle
+
+def _splitURL(key, offset=0):
+    """Split a key into the length-prefixed server URL starting at
+    C{offset} and the rest.
+
+    (str, int) -> (str, str)
+    """
+    (url_length,) = _url_length.unpack_from(key, offset)
+    start = offset + _url_length.size
+    return key[start:start + url_length], key[start + url_length:]
+
+class _Segment(object):
+    """An open segment file and its memory map."""
+
+    def __init__(self, number, filename, create=False):
+        self.number = number
+        self.filename = filename
+        flags = os.O_RDWR | os.O_APPEND
+        if create:
+            flags |= os.O_CREAT
+        self.fd = os.open(filename, flags, 0600)
+        self.map = None
+
+    def size(self):
+        return os.fstat(self.fd).st_size
+
+    def view(self, size):
+        """Return a map of at least C{size} bytes of the file.
+
+        int -> mmap
+        """
+        if self.map is None or len(self.map) < size:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        os.close(self.fd)
+
+class LogOpenIDStore(OpenIDStore):
+    """
+    An OpenID store that appends every change to a log, for use by
+    any number of processes on one machine.
+
+    @cvar segment_size: The size in bytes past which a segment file is
+        not appended to, and a new one is started.
+
+    @cvar max_segments: How many segment files there can be before the
+        store is compacted into one.
+
+    @cvar sync_writes: Whether to flush associations and negotiations
+        to disk before the methods that store or remove them return.
+        Nonces are never flushed, as with C{L{FileOpenIDStore
+        <openid.store.filestore.FileOpenIDStore>}}.
+    """
+
+    segment_size = 16 * 1024 * 1024
+
+    max_segments = 4
+
+    sync_writes = True
+
+    def __init__(self, directory):
+        """
+        Opens the store in C{directory}, creating it if it does not
+        exist yet, and reads the records in it.
+
+        @param directory: The directory to keep the log in.
+
+        @type directory: C{str}
+        """
+        self.directory = os.path.normpath(os.path.abspath(directory))
+        try:
+            os.makedirs(self.directory)
+        except OSError, why:
+            if why.errno != errno.EEXIST or \
+                   not os.path.isdir(self.directory):
+                raise
+
+        self._thread_lock = threading.Lock()
+        self._lock_fd = None
+        self._pid = None
+        self._segments = []
+        self._lockProcess(fcntl.LOCK_EX)
+        try:
+            self._load()
+        finally:
+            self._unlock()
+
+    # Locking
+
+    def _lockProcess(self, operation):
+        self._thread_lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                # A lock is shared with the process it was inherited
+                # from, so open our own.
+                self._reopen()
+            fcntl.flock(self._lock_fd, operation)
+        except:
+            self._thread_lock.release()
+            raise
+
+    def _lockShared(self):
+        self._lockProcess(fcntl.LOCK_SH)
+        try:
+            self._catchUp(False)
+        except:
+            self._unlock()
+            raise
+
+    def _lockExclusive(self):
+        self._lockProcess(fcntl.LOCK_EX)
+        try:
+            self._catchUp(True)
+        except:
+            self._unlock()
+            raise
+
+    def _unlock(self):
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        finally:
+            self._thread_lock.release()
+
+    def _reopen(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+        self._lock_fd = os.open(os.path.join(self.directory, 'lock'),
+                                os.O_RDWR | os.O_CREAT, 0600)
+        self._pid = os.getpid()
+        if self._segments:
+            # Read everything again in the locked section.
+            self._closeSegments()
+            self._segments = None
+
+    # Reading the log
+
+    def _closeSegments(self):
+        for segment in self._segments or []:
+            segment.close()
+        self._segments = []
+
+    def _load(self):
+        """Read every segment into a new index.  Call with the store
+        locked.
+
+        () -> NoneType
+        """
+        self._closeSegments()
+
+        # server_url -> {handle -> (segment, offset, length, issued,
+        # expires)}, for the association in the record's value
+        self._associations = {}
+        # (server_url, timestamp, salt) -> None
+        self._nonces = {}
+        # server_url -> (assoc_type, session_type)
+        self._negotiations = {}
+
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.endswith(_segment_suffix):
+                try:
+                    numbers.append(int(name[:-len(_segment_suffix)]))
+                except ValueError:
+                    pass
+        numbers.sort()
+
+        if not numbers:
+            # Only when the store is new, and so exclusively locked
+            numbers = [1]
+
+        for number in numbers:
+            segment = self._openSegment(number, True)
+            self._segments.append(segment)
+            self._position = 0
+            self._scan(segment, segment.size())
+
+    def _openSegment(self, number, create=False):
+        return _Segment(number, os.path.join(self.directory,
+                                             _segmentName(number)), create)
+
+    def _catchUp(self, exclusive):
+        """Read the records that other processes have appended since
+        the last call.  Call with the store locked, exclusively if
+        C{exclusive}, in which case a record left half written by a
+        crash is removed.
+
+        bool -> NoneType
+        """
+        if self._segments is None:
+            self._load()
+            return
+
+        while True:
+            segment = self._segments[-1]
+            size = segment.size()
+            if size <= self._position:
+                return
+
+            end = self._scan(segment, size)
+            if end == _COMPACTED:
+                self._load()
+                return
+            elif end == _NEXT_SEGMENT:
+                try:
+                    next_segment = self._openSegment(segment.number + 1)
+                except OSError, why:
+                    if why.errno != errno.ENOENT:
+                        raise
+                    # Compacted since we read this far
+                    self._load()
+                    return
+                self._segments.append(next_segment)
+                self._position = 0
+            else:
+                if self._position < size and exclusive:
+                    os.ftruncate(segment.fd, self._position)
+                return
+
+    def _scan(self, segment, size):
+        """Index the records in C{segment} from C{self._position} up
+        to C{size}, leaving C{self._position} after the last whole
+        record.
+
+        @return: C{_NEXT_SEGMENT} or C{_COMPACTED} if a record says
+            to go on in another segment, or None.
+        """
+        if size <= self._position:
+            return None
+
+        data = segment.view(size)
+        position = self._position
+        now = time.time()
+        header_size = _record_header.size
+        while position + header_size <= size:
+            crc, record_type, key_length, value_length = \
+                 _record_header.unpack_from(data, position)
+            key_start = position + header_size
+            value_start = key_start + key_length
+            end = value_start + value_length
+            if end > size:
+                break
+
+            check = zlib.crc32(data[position + 4:end]) & 0xffffffff
+            if check != crc:
+                break
+
+            key = data[key_start:value_start]
+            if record_type == _ASSOCIATION:
+                server_url, handle = _splitURL(key)
+                association = Association.deserialize(data[value_start:end])
+                expires = association.issued + association.lifetime
+                if expires > now:
+                    server = self._associations.setdefault(server_url, {})
+                    server[handle] = (segment, value_start, value_length,
+                                      association.issued, expires)
+            elif record_type == _REMOVE_ASSOCIATION:
+                server_url, handle = _splitURL(key)
+                self._forget(server_url, handle)
+            elif record_type == _NONCE:
+                timestamp, _ = _nonce_key.unpack_from(key)
+                server_url, salt = _splitURL(key, _nonce_key.size -
+                                             _url_length.size)
+                if abs(timestamp - now) <= nonce.SKEW:
+                    self._nonces[(server_url, timestamp, salt)] = None
+            elif record_type == _NEGOTIATION:
+                value = data[value_start:end]
+                (type_length,) = _type_length.unpack_from(value)
+                self._negotiations[key] = (
+                    value[_type_length.size:_type_length.size + type_length],
+                    value[_type_length.size + type_length:])
+            elif record_type in (_NEXT_SEGMENT, _COMPACTED):
+                self._position = end
+                return record_type
+
+            position = end
+
+        self._position = position
+        return None
+
+    def _forget(self, server_url, handle):
+        server = self._associations.get(server_url)
+        if server is not None and server.pop(handle, None) is not None:
+            if not server:
+                del self._associations[server_url]
+            return True
+        return False
+
+    def _readAssociation(self, entry):
+        segment, offset, length, _, expires = entry
+        if expires <= time.time():
+            return None
+        data = segment.view(offset + length)
+        return Association.deserialize(data[offset:offset + length])
+
+    # Writing the log
+
+    def _append(self, record, sync):
+        """Append a record to the newest segment, and return the
+        segment and the offset of the record in it.  Call with the store
+        exclusively locked.
+
+        (str, bool) -> (_Segment, int)
+        """
+        segment = self._segments[-1]
+        if self._position + len(record) > self.segment_size and \
+               self._position > 0:
+            if len(self._segments) >= self.max_segments:
+                self._compact()
+            else:
+                self._startSegment()
+            segment = self._segments[-1]
+
+        offset = self._position
+        os.write(segment.fd, record)
+        if sync:
+            os.fsync(segment.fd)
+        self._position += len(record)
+        return segment, offset
+
+    def _startSegment(self):
+        """Start appending to a new segment."""
+        old = self._segments[-1]
+        new = self._openSegment(old.number + 1, True)
+        if self.sync_writes:
+            self._syncDirectory()
+        # The new segment exists before anyone is told to read it.
+        os.write(old.fd, _pack(_NEXT_SEGMENT, ''))
+        self._segments.append(new)
+        self._position = 0
+
+    def _syncDirectory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _compact(self):
+        """Copy the live records into a new segment and remove the old
+        ones.  Call with the store exclusively locked.
+
+        @return: The numbers of expired nonces and associations left
+            out.
+        @rtype: (int, int)
+        """
+        now = time.time()
+        old = self._segments
+        number = old[-1].number + 1
+        filename = os.path.join(self.directory, _segmentName(number))
+        tmp = filename + '.tmp'
+
+        records = []
+        expired_associations = 0
+        for server_url, server in self._associations.iteritems():
+            for handle, (segment, offset, length, _, expires) in \
+                    server.iteritems():
+                if expires <= now:
+                    expired_associations += 1
+                    continue
+                value = segment.view(offset + length)[offset:offset + length]
+                records.append(_pack(_ASSOCIATION,
+                                     _associationKey(server_url, handle),
+                                     value))
+
+        expired_nonces = 0
+        for (server_url, timestamp, salt) in self._nonces:
+            if abs(timestamp - now) > nonce.SKEW:
+                expired_nonces += 1
+                continue
+            records.append(_pack(
+                _NONCE,
+                _nonce_key.pack(timestamp, len(server_url)) + server_url +
+                salt))
+
+        for server_url, (assoc_type, session_type) in \
+                self._negotiations.iteritems():
+            records.append(_pack(
+                _NEGOTIATION, server_url,
+                _type_length.pack(len(assoc_type)) + assoc_type +
+                session_type))
+
+        tmp_file = file(tmp, 'wb')
+        try:
+            tmp_file.write(''.join(records))
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        finally:
+            tmp_file.close()
+        os.rename(tmp, filename)
+        self._syncDirectory()
+
+        # Other processes reading the old segments start again from
+        # the new one.
+        os.write(old[-1].fd, _pack(_COMPACTED, ''))
+        for segment in old:
+            try:
+                os.unlink(segment.filename)
+            except OSError, why:
+                if why.errno != errno.ENOENT:
+                    raise
+
+        self._load()
+        return expired_nonces, expired_associations
+
+    # OpenIDStore
+
+    def storeAssociation(self, server_url, association):
+        server_url = _utf8(server_url)
+        handle = _utf8(association.handle)
+        key = _associationKey(server_url, handle)
+        value = association.serialize('3')
+        record = _pack(_ASSOCIATION, key, value)
+        self._lockExclusive()
+        try:
+            segment, offset = self._append(record, self.sync_writes)
+            server = self._associations.setdefault(server_url, {})
+            server[handle] = (
+                segment, offset + _record_header.size + len(key), len(value),
+                association.issued, association.issued + association.lifetime)
+        finally:
+            self._unlock()
+
+    def getAssociation(self, server_url, handle=None):
+        server_url = _utf8(server_url)
+        self._lockShared()
+        try:
+            server = self._associations.get(server_url)
+            if not server:
+                return None
+
+            if handle is not None:
+                entry = server.get(_utf8(handle))
+                if entry is None:
+                    return None
+                return self._readAssociation(entry)
+
+            # The most recently issued association that has not expired
+            now = time.time()
+            best = None
+            for entry in server.itervalues():
+                if entry[4] > now and (best is None or entry[3] > best[3]):
+                    best = entry
+            if best is None:
+                return None
+            return self._readAssociation(best)
+        finally:
+            self._unlock()
+
+    def removeAssociation(self, server_url, handle):
+        server_url = _utf8(server_url)
+        handle = _utf8(handle)
+        self._lockExclusive()
+        try:
+            if not self._forget(server_url, handle):
+                return False
+            self._append(_pack(_REMOVE_ASSOCIATION,
+                               _associationKey(server_url, handle)),
+                         self.sync_writes)
+            return True
+        finally:
+            self._unlock()
+
+    def storeNegotiation(self, server_url, assoc_type, session_type):
+        server_url = _utf8(server_url)
+        assoc_type = _utf8(assoc_type)
+        session_type = _utf8(session_type)
+        record = _pack(_NEGOTIATION, server_url,
+                       _type_length.pack(len(assoc_type)) + assoc_type +
+                       session_type)
+        self._lockExclusive()
+        try:
+            self._append(record, self.sync_writes)
+            self._negotiations[server_url] = (assoc_type, session_type)
+        finally:
+            self._unlock()
+
+    def getNegotiation(self, server_url):
+        self._lockShared()
+        try:
+            return self._negotiations.get(_utf8(server_url))
+        finally:
+            self._unlock()
+
+    def useNonce(self, server_url, timestamp, salt):
+        if abs(timestamp - time.time()) > nonce.SKEW:
+            return False
+
+        server_url = _utf8(server_url)
+        salt = _utf8(salt)
+        anonce = (server_url, timestamp, salt)
+        record = _pack(_NONCE, _nonce_key.pack(timestamp, len(server_url)) +
+                       server_url + salt)
+        self._lockExclusive()
+        try:
+            if anonce in self._nonces:
+                return False
+            self._append(record, False)
+            self._nonces[anonce] = None
+            return True
+        finally:
+            self._unlock()
+
+    def cleanupNonces(self):
+        return self.cleanup()[0]
+
+    def cleanupAssociations(self):
+        return self.cleanup()[1]
+
+    def cleanup(self):
+        """Copy the records that have not expired into a new segment,
+        and remove the old ones.
+
+        @return: The numbers of expired nonces and associations
+            removed.
+        @rtype: (int, int)
+        """
+        self._lockExclusive()
+        try:
+            return self._compact()
+        finally:
+            self._unlock()
+
+    def close(self):
+        """Close the store's files.  The store cannot be used after
+        this."""
+        self._thread_lock.acquire()
+        try:
+            self._closeSegments()
+            if self._lock_fd is not None:
+                os.close(self._lock_fd)
+                self._lock_fd = None
+        finally:
+            self._thread_lock.release()
@@ -2,34 +2,48 @@
 
 from openid.store import nonce
 
-import copy
+import heapq
+import threading
 import time
 
 class ServerAssocs(object):
     def __init__(self):
         self.assocs = {}
+        # The most recently issued association, kept up to date by
+        # set and remove so that best() does not look at the others.
+        self._best = None
 
     def set(self, assoc):
+        replaced = self.assocs.get(assoc.handle)
         self.assocs[assoc.handle] = assoc
+        if self._best is None or assoc.issued >= self._best.issued:
+            self._best = assoc
+        elif replaced is self._best:
+            self._best = self._findBest()
 
     def get(self, handle):
         return self.assocs.get(handle)
 
     def remove(self, handle):
         try:
-            del self.assocs[handle]
+            assoc = self.assocs.pop(handle)
         except KeyError:
             return False
         else:
+            if assoc is self._best:
+                self._best = self._findBest()
             return True
 
     def best(self):
-        """Returns association with the oldest issued date.
+        """Returns association with the newest issued date.
 
         or None if there are no associations.
         """
+        return self._best
+
+    def _findBest(self):
         best = None
-        for assoc in self.assocs.values():
+        for assoc in self.assocs.itervalues():
             if best is None or best.issued < assoc.issued:
                 best = assoc
         return best
@@ -44,7 +58,7 @@ class ServerAssocs(object):
             if assoc.getExpiresIn() == 0:
                 remove.append(handle)
         for handle in remove:
-            del self.assocs[handle]
+            self.remove(handle)
         return len(remove), len(self.assocs)
 
 
@@ -53,10 +67,23 @@ class MemoryStore(object):
     """In-process memory store.
 
     Use for single long-running processes.  No persistence supplied.
+
+    Associations and nonces are also kept in heaps ordered by when they
+    expire, so cleaning up only looks at the expired ones.  Expired
+    nonces are removed as new ones are used, without waiting for
+    C{cleanupNonces}.
     """
     def __init__(self):
         self.server_assocs = {}
         self.nonces = {}
+        self.negotiations = {}
+
+        # (expiry time, server_url, handle) for every stored
+        # association, including ones since replaced or removed
+        self._assoc_expiry = []
+
+        # (timestamp, nonce) for every nonce in self.nonces
+        self._nonce_expiry = []
 
     def _getServerAssocs(self, server_url):
         try:
@@ -66,55 +93,86 @@ class MemoryStore(object):
             return assocs
 
     def storeAssociation(self, server_url, assoc):
+        # Associations cannot be changed, so there is no need to copy.
         assocs = self._getServerAssocs(server_url)
-        assocs.set(copy.deepcopy(assoc))
+        assocs.set(assoc)
+        heapq.heappush(self._assoc_expiry,
+                       (assoc.issued + assoc.lifetime, server_url,
+                        assoc.handle))
 
     def getAssociation(self, server_url, handle=None):
-        assocs = self._getServerAssocs(server_url)
-        if handle is None:
+        assocs = self.server_assocs.get(server_url)
+        if assocs is None:
+            return None
+        elif handle is None:
             return assocs.best()
         else:
             return assocs.get(handle)
 
     def removeAssociation(self, server_url, handle):
-        assocs = self._getServerAssocs(server_url)
+        assocs = self.server_assocs.get(server_url)
+        if assocs is None:
+            return False
         return assocs.remove(handle)
 
+    def storeNegotiation(self, server_url, assoc_type, session_type):
+        self.negotiations[server_url] = (assoc_type, session_type)
+
+    def getNegotiation(self, server_url):
+        return self.negotiations.get(server_url)
+
     def useNonce(self, server_url, timestamp, salt):
-        if abs(timestamp - time.time()) > nonce.SKEW:
+        now = time.time()
+        if abs(timestamp - now) > nonce.SKEW:
             return False
 
+        self._expireNonces(now)
+
         anonce = (str(server_url), int(timestamp), str(salt))
         if anonce in self.nonces:
             return False
         else:
             self.nonces[anonce] = None
+            heapq.heappush(self._nonce_expiry, (anonce[1], anonce))
             return True
 
-    def cleanupNonces(self):
-        now = time.time()
-        expired = []
-        for anonce in self.nonces.iterkeys():
-            if abs(anonce[1] - now) > nonce.SKEW:
-                # removing items while iterating over the set could be bad.
-                expired.append(anonce)
+    def _expireNonces(self, now):
+        """Remove the nonces too old to pass useNonce, oldest first.
 
-        for anonce in expired:
+        Nonces newer than C{now} are only accepted within the skew, so
+        only old ones can have expired.
+        """
+        heap = self._nonce_expiry
+        oldest = now - nonce.SKEW
+        expired = 0
+        while heap and heap[0][0] < oldest:
+            _, anonce = heapq.heappop(heap)
             del self.nonces[anonce]
-        return len(expired)
+            expired += 1
+        return expired
+
+    def cleanupNonces(self):
+        return self._expireNonces(time.time())
 
     def cleanupAssociations(self):
-        remove_urls = []
+        heap = self._assoc_expiry
+        now = int(time.time())
         removed_assocs = 0
-        for server_url, assocs in self.server_assocs.iteritems():
-            removed, remaining = assocs.cleanup()
-            removed_assocs += removed
-            if not remaining:
-                remove_urls.append(server_url)
-
-        # Remove entries from server_assocs that had none remaining.
-        for server_url in remove_urls:
-            del self.server_assocs[server_url]
+        while heap and heap[0][0] <= now:
+            expires, server_url, handle = heapq.heappop(heap)
+            assocs = self.server_assocs.get(server_url)
+            if assocs is None:
+                continue
+
+            assoc = assocs.get(handle)
+            # Skip entries for associations since replaced
+            if assoc is not None and assoc.getExpiresIn(now) == 0:
+                assocs.remove(handle)
+                removed_assocs += 1
+
+            # Remove entries from server_assocs that have none remaining.
+            if not assocs.assocs:
+                del self.server_assocs[server_url]
         return removed_assocs
 
     def __eq__(self, other):
@@ -123,3 +181,99 @@ class MemoryStore(object):
 
     def __ne__(self, other):
         return not (self == other)
+
+
+class ConcurrentMemoryStore(object):
+    """In-process memory store that can be shared by threads.
+
+    The entries are split between C{stripes} C{L{MemoryStore}}s, each
+    with its own lock, so that threads working with different servers
+    seldom wait for each other.  Associations and negotiations are
+    split by server URL, and nonces by server URL and salt, since the
+    nonces a consumer makes itself all have the same empty server URL.
+    Checking and recording a nonce happen under one lock, so each
+    nonce is accepted once however many threads try it.
+
+    Use for long-running processes with more than one thread.  No
+    persistence supplied.
+    """
+
+    stripes = 16
+
+    def __init__(self, stripes=None):
+        if stripes is not None:
+            self.stripes = stripes
+
+        self._stores = [MemoryStore() for _ in xrange(self.stripes)]
+        self._locks = [threading.Lock() for _ in xrange(self.stripes)]
+
+    def _stripe(self, key):
+        i = hash(key) % self.stripes
+        return self._locks[i], self._stores[i]
+
+    def storeAssociation(self, server_url, assoc):
+        lock, store = self._stripe(server_url)
+        lock.acquire()
+        try:
+            store.storeAssociation(server_url, assoc)
+        finally:
+            lock.release()
+
+    def getAssociation(self, server_url, handle=None):
+        lock, store = self._stripe(server_url)
+        lock.acquire()
+        try:
+            return store.getAssociation(server_url, handle)
+        finally:
+            lock.release()
+
+    def removeAssociation(self, server_url, handle):
+        lock, store = self._stripe(server_url)
+        lock.acquire()
+        try:
+            return store.removeAssociation(server_url, handle)
+        finally:
+            lock.release()
+
+    def storeNegotiation(self, server_url, assoc_type, session_type):
+        lock, store = self._stripe(server_url)
+        lock.acquire()
+        try:
+            store.storeNegotiation(server_url, assoc_type, session_type)
+        finally:
+            lock.release()
+
+    def getNegotiation(self, server_url):
+        lock, store = self._stripe(server_url)
+        lock.acquire()
+        try:
+            return store.getNegotiation(server_url)
+        finally:
+            lock.release()
+
+    def useNonce(self, server_url, timestamp, salt):
+        lock, store = self._stripe((server_url, salt))
+        lock.acquire()
+        try:
+            return store.useNonce(server_url, timestamp, salt)
+        finally:
+            lock.release()
+
+    def _cleanupEach(self, method):
+        removed = 0
+        for lock, store in zip(self._locks, self._stores):
+            lock.acquire()
+            try:
+                removed += method(store)
+            finally:
+                lock.release()
+        return removed
+
+    def cleanupNonces(self):
+        return self._cleanupEach(MemoryStore.cleanupNonces)
+
+    def cleanupAssociations(self):
+        return self._cleanupEach(MemoryStore.cleanupAssociations)
+
+    def cleanup(self):
+        return self.cleanupNonces(), self.cleanupAssociations()
@@ -0,0 +1,461 @@
+"""
+This module contains an C{L{OpenIDStore}} kept in a memory-mapped
+file that every process on one host can share, for servers that fork
+worker processes.
+
+With C{L{MemoryStore<openid.store.memstore.MemoryStore>}}, each worker
+has its own nonces, so a response replayed to another worker is
+accepted, and each worker negotiates its own associations.  A
+C{L{SharedMemoryStore}} made before the workers fork, or opened by each
+of them with the same file name, is one store for all of them::
+
+    store = SharedMemoryStore('/dev/shm/openid-store')
+
+The file holds fixed-size hash tables of nonces, associations and
+negotiations, so the store never uses more memory than it was made
+with.  Each table is divided into buckets of a few slots, and each
+bucket is locked with C{fcntl.lockf} while it is used.  When a bucket
+is full, the least recently used association or negotiation in it
+makes room.  A nonce only takes the place of one that has expired: if
+every nonce in its bucket is still in use, the new nonce is refused,
+and the login fails rather than leaving room for a replay.  Make the
+nonce table larger than the number of nonces used in the skew window
+(C{L{nonce.SKEW<openid.store.nonce.SKEW>}}) so that this does not
+happen.
+
+This store needs C{fcntl}, so it only works on Unix.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+from openid import cryptutil, oidutil
+from openid.association import Association
+from openid.store.interface import OpenIDStore
+from openid.store import nonce
+
+_magic = 'OIDSHM01'
+
+# Magic, then slots, bucket size and value size of each table
+_file_header = struct.Struct('!8s' + 'III' * 3)
+
+# State, group digest, key digest, last used (ms), issued, expires,
+# value length.  Slots of one group are in the same bucket.
+_slot_header = struct.Struct('!B20s20sqqqH')
+
+_EMPTY = 0
+_FULL = 1
+
+def _digest(*parts):
+    """A digest of a key made of strings, the same in every process.
+
+    (str, ...) -> str
+    """
+    key = ''.join([struct.pack('!I', len(part)) + part for part in parts])
+    return cryptutil.sha1(key)
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+class _Table(object):
+    """A hash table of fixed-size slots in a memory map.
+
+    A slot's bucket is chosen by its group digest, and a key is found
+    by looking through the slots of the bucket.
+    """
+
+    def __init__(self, store, offset, slots, bucket_size, value_size):
+        self.store = store
+        self.offset = offset
+        self.bucket_size = bucket_size
+        self.buckets = slots // bucket_size
+        self.value_size = value_size
+        self.slot_size = _slot_header.size + value_size
+        self.bucket_bytes = self.slot_size * bucket_size
+        self.size = self.bucket_bytes * self.buckets
+        self._thread_locks = [threading.Lock()
+                              for _ in xrange(min(self.buckets, 64))]
+
+    def bucket(self, group):
+        (number,) = struct.unpack_from('!I', group)
+        return number % self.buckets
+
+    def lock(self, bucket):
+        """Lock a bucket against other threads and processes.
+
+        int -> NoneType
+        """
+        thread_lock = self._thread_locks[bucket % len(self._thread_locks)]
+        thread_lock.acquire()
+        try:
+            fcntl.lockf(self.store._fd, fcntl.LOCK_EX, 1,
+                        self.offset + bucket * self.bucket_bytes)
+        except:
+            thread_lock.release()
+            raise
+
+    def unlock(self, bucket):
+        thread_lock = self._thread_locks[bucket % len(self._thread_locks)]
+        try:
+            fcntl.lockf(self.store._fd, fcntl.LOCK_UN, 1,
+                        self.offset + bucket * self.bucket_bytes)
+        finally:
+            thread_lock.release()
+
+    def offsets(self, bucket):
+        """The offsets of the slots in a bucket.
+
+        int -> [int]
+        """
+        start = self.offset + bucket * self.bucket_bytes
+        return xrange(start, start + self.bucket_bytes, self.slot_size)
+
+    def slots(self, bucket):
+        """The offsets and headers of the slots in a bucket.
+
+        int -> [(int, tuple)]
+        """
+        data = self.store._map
+        return [(offset, _slot_header.unpack_from(data, offset))
+                for offset in self.offsets(bucket)]
+
+    def find(self, bucket, key, now):
+        """Look through a bucket for the slot holding C{key}, clearing
+        the slots that have expired.  Entries that expire at 0 do not
+        expire.
+
+        @return: The offset and header of the slot holding C{key}, the
+            offset of the first free slot, and the offset of the least
+            recently used slot, each or None.
+        """
+        match = free = lru = None
+        lru_used = None
+        for offset, header in self.slots(bucket):
+            state, _, slot_key, used, _, expires, _ = header
+            if state == _FULL and 0 < expires <= now:
+                self.clear(offset)
+                state = _EMPTY
+
+            if state == _EMPTY:
+                if free is None:
+                    free = offset
+            elif slot_key == key:
+                match = (offset, header)
+            elif lru is None or used < lru_used:
+                lru = offset
+                lru_used = used
+
+        return match, free, lru
+
+    def read(self, offset, header):
+        length = header[6]
+        start = offset + _slot_header.size
+        return self.store._map[start:start + length]
+
+    def write(self, offset, group, key, issued, expires, value=''):
+        data = self.store._map
+        data[offset + _slot_header.size:
+             offset + _slot_header.size + len(value)] = value
+        _slot_header.pack_into(data, offset, _FULL, group, key, _now_ms(),
+                               issued, expires, len(value))
+
+    def touch(self, offset, header):
+        _slot_header.pack_into(self.store._map, offset, header[0], header[1],
+                               header[2], _now_ms(), header[4], header[5],
+                               header[6])
+
+    def clear(self, offset):
+        self.store._map[offset] = chr(_EMPTY)
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+class SharedMemoryStore(OpenIDStore):
+    """
+    An OpenID store in a memory-mapped file shared by the processes on
+    one host.
+
+    @cvar nonce_slots: The number of nonces the store can hold.
+
+    @cvar association_slots: The number of associations the store can
+        hold.
+
+    @cvar negotiation_slots: The number of servers whose negotiations
+        the store can hold.
+
+    @cvar association_size: The largest serialized association the
+        store can hold, which is enough for a 255 character handle.
+    """
+
+    nonce_slots = 64 * 1024
+    nonce_bucket_size = 16
+
+    association_slots = 4096
+    association_bucket_size = 8
+    association_size = 320
+
+    negotiation_slots = 1024
+    negotiation_bucket_size = 4
+    negotiation_size = 64
+
+    def __init__(self, filename, nonce_slots=None, association_slots=None,
+                 negotiation_slots=None):
+        """
+        Opens the store in C{filename}, making it if it does not exist
+        yet.
+
+        @param filename: The file to keep the store in.  A file on a
+            memory file system, such as C{/dev/shm} on Linux, is not
+            written to disk.
+
+        @type filename: C{str}
+
+        @raises ValueError: If the file is a store made with different
+            sizes, or is not a store.
+        """
+        if nonce_slots is not None:
+            self.nonce_slots = nonce_slots
+        if association_slots is not None:
+            self.association_slots = association_slots
+        if negotiation_slots is not None:
+            self.negotiation_slots = negotiation_slots
+
+        self.filename = filename
+        params = (
+            self.nonce_slots, self.nonce_bucket_size, 0,
+            self.association_slots, self.association_bucket_size,
+            self.association_size,
+            self.negotiation_slots, self.negotiation_bucket_size,
+            self.negotiation_size,
+            )
+        header = _file_header.pack(_magic, *params)
+
+        offset = _file_header.size
+        self._nonces = _Table(self, offset, *params[0:3])
+        offset += self._nonces.size
+        self._associations = _Table(self, offset, *params[3:6])
+        offset += self._associations.size
+        self._negotiations = _Table(self, offset, *params[6:9])
+        size = offset + self._negotiations.size
+
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            # Lock the file header while the file is made or checked.
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, 0)
+            try:
+                existing = os.fstat(self._fd).st_size
+                if existing == 0:
+                    os.ftruncate(self._fd, size)
+                    os.write(self._fd, header)
+                else:
+                    found = os.read(self._fd, _file_header.size)
+                    if found != header or existing != size:
+                        raise ValueError(
+                            '%s is not a store with these sizes' %
+                            (filename,))
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 0)
+
+            self._map = mmap.mmap(self._fd, size)
+        except:
+            os.close(self._fd)
+            raise
+
+    def close(self):
+        """Close the store's file.  The store cannot be used after
+        this."""
+        self._map.close()
+        os.close(self._fd)
+
+    # Associations
+
+    def storeAssociation(self, server_url, association):
+        server_url = _utf8(server_url)
+        value = association.serialize('3')
+        if len(value) > self.association_size:
+            oidutil.log('Association %r is too large for %s' %
+                        (association.handle, self.__class__.__name__))
+            return
+
+        group = _digest(server_url)
+        key = _digest(server_url, _utf8(association.handle))
+        table = self._associations
+        bucket = table.bucket(group)
+        table.lock(bucket)
+        try:
+            match, free, lru = table.find(bucket, key, time.time())
+            if match is not None:
+                slot = match[0]
+            elif free is not None:
+                slot = free
+            else:
+                slot = lru
+
+            table.write(slot, group, key, association.issued,
+                        association.issued + association.lifetime, value)
+        finally:
+            table.unlock(bucket)
+
+    def getAssociation(self, server_url, handle=None):
+        server_url = _utf8(server_url)
+        group = _digest(server_url)
+        if handle is not None:
+            key = _digest(server_url, _utf8(handle))
+
+        table = self._associations
+        bucket = table.bucket(group)
+        table.lock(bucket)
+        try:
+            now = time.time()
+            if handle is not None:
+                best = table.find(bucket, key, now)[0]
+            else:
+                # The most recently issued for the server, unpacking
+                # only its slots
+                best = None
+                data = self._map
+                tag = chr(_FULL) + group
+                for offset in table.offsets(bucket):
+                    if data[offset:offset + len(tag)] != tag:
+                        continue
+                    header = _slot_header.unpack_from(data, offset)
+                    if header[5] <= now:
+                        table.clear(offset)
+                    elif best is None or header[4] > best[1][4]:
+                        best = (offset, header)
+
+            if best is None:
+                return None
+
+            offset, header = best
+            try:
+                association = Association.deserialize(
+                    table.read(offset, header))
+            except ValueError:
+                # Left half written by a process that died
+                table.clear(offset)
+                return None
+
+            table.touch(offset, header)
+            return association
+        finally:
+            table.unlock(bucket)
+
+    def removeAssociation(self, server_url, handle):
+        server_url = _utf8(server_url)
+        group = _digest(server_url)
+        key = _digest(server_url, _utf8(handle))
+        table = self._associations
+        bucket = table.bucket(group)
+        table.lock(bucket)
+        try:
+            for offset, header in table.slots(bucket):
+                if header[0] == _FULL and header[2] == key:
+                    table.clear(offset)
+                    return True
+            return False
+        finally:
+            table.unlock(bucket)
+
+    # Negotiations
+
+    def storeNegotiation(self, server_url, assoc_type, session_type):
+        value = '%s %s' % (assoc_type, session_type)
+        if len(value) > self.negotiation_size:
+            return
+
+        key = _digest(_utf8(server_url))
+        table = self._negotiations
+        bucket = table.bucket(key)
+        table.lock(bucket)
+        try:
+            match, free, lru = table.find(bucket, key, time.time())
+            if match is not None:
+                slot = match[0]
+            elif free is not None:
+                slot = free
+            else:
+                slot = lru
+
+            table.write(slot, key, key, 0, 0, value)
+        finally:
+            table.unlock(bucket)
+
+    def getNegotiation(self, server_url):
+        key = _digest(_utf8(server_url))
+        table = self._negotiations
+        bucket = table.bucket(key)
+        table.lock(bucket)
+        try:
+            match = table.find(bucket, key, time.time())[0]
+            if match is None:
+                return None
+
+            offset, header = match
+            try:
+                assoc_type, session_type = table.read(offset, header).split()
+            except ValueError:
+                table.clear(offset)
+                return None
+
+            table.touch(offset, header)
+            return assoc_type, session_type
+        finally:
+            table.unlock(bucket)
+
+    # Nonces
+
+    def useNonce(self, server_url, timestamp, salt):
+        now = time.time()
+        if abs(timestamp - now) > nonce.SKEW:
+            return False
+
+        key = _digest(_utf8(server_url), _utf8(salt), str(timestamp))
+        # The first second in which the timestamp fails the skew check
+        expires = timestamp + nonce.SKEW + 1
+        table = self._nonces
+        bucket = table.bucket(key)
+        table.lock(bucket)
+        try:
+            match, slot, _ = table.find(bucket, key, now)
+            if match is not None:
+                return False
+            elif slot is None:
+                # Every nonce in the bucket is still in use.  Evicting
+                # one would let it be replayed.
+                oidutil.log('Nonce table of %s is full; refusing nonce' %
+                            (self.filename,))
+                return False
+
+            table.write(slot, key, key, timestamp, expires)
+            return True
+        finally:
+            table.unlock(bucket)
+
+    # Cleanup
+
+    def _cleanupTable(self, table):
+        now = time.time()
+        removed = 0
+        for bucket in xrange(table.buckets):
+            table.lock(bucket)
+            try:
+                for offset, header in table.slots(bucket):
+                    if header[0] == _FULL and 0 < header[5] <= now:
+                        table.clear(offset)
+                        removed += 1
+            finally:
+                table.unlock(bucket)
+        return removed
+
+    def cleanupNonces(self):
+        return self._cleanupTable(self._nonces)
+
+    def cleanupAssociations(self):
+        return self._cleanupTable(self._associations)
@@ -6,9 +6,10 @@ Example of how to initialize a store database::
 
     python -c 'from openid.store import sqlstore; import pysqlite2.dbapi2; sqlstore.SQLiteStore(pysqlite2.dbapi2.connect("cstore.db")).createTables()'
 """
-import re
+import threading
 import time
 
+from openid import oidutil
 from openid.association import Association
 from openid.store.interface import OpenIDStore
 from openid.store import nonce
@@ -28,25 +29,40 @@ def _inTxn(func):
 
     return wrapped
 
+class _TransactionState(threading.local):
+    """The connection and cursor of the transaction that a thread has
+    open, if any, and how many store calls deep the thread is in it."""
+    conn = None
+    cur = None
+    depth = 0
+
 class SQLStore(OpenIDStore):
     """
     This is the parent class for the SQL stores, which contains the
     logic common to all of the SQL stores.
 
     The table names used are determined by the class variables
-    C{L{settings_table}}, C{L{associations_table}}, and
-    C{L{nonces_table}}.  To change the name of the tables used, pass
-    new table names into the constructor.
+    C{L{settings_table}}, C{L{associations_table}},
+    C{L{nonces_table}}, and C{L{negotiations_table}}.  To change the
+    name of the tables used, pass new table names into the
+    constructor.
 
     To create the tables with the proper schema, see the
-    C{L{createTables}} method.
+    C{L{createTables}} method.  Tables created before the associations
+    table had an C{expires_at} column still work, more slowly, until
+    C{L{migrateTables}} is run on them.
 
     This class shouldn't be used directly.  Use one of its subclasses
     instead, as those contain the code necessary to use a specific
     database.
 
-    All methods other than C{L{__init__}} and C{L{createTables}}
-    should be considered implementation details.
+    Each call to a store method runs in a transaction of its own.  To
+    run many calls in one transaction, paying for a single commit, see
+    C{L{batch}}.
+
+    All methods other than C{L{__init__}}, C{L{createTables}},
+    C{L{migrateTables}} and C{L{batch}} should be considered
+    implementation details.
 
 
     @cvar settings_table: This is the default name of the table to
@@ -58,16 +74,64 @@ class SQLStore(OpenIDStore):
     @cvar nonces_table: This is the default name of the table to keep
         nonces in.
 
+    @cvar negotiations_table: This is the default name of the table to
+        keep the association and session types that servers accepted
+        in.
+
+    @cvar pool_size: This is the default number of idle connections
+        kept for reuse when the store makes its own connections.
+
+    @cvar cleanup_chunk_size: This is the most nonces or associations
+        that cleaning up removes in one transaction.  Cleaning up a
+        large table takes many short transactions, so that logins using
+        the table at the same time are not held up for long.
+
+    @cvar cleanup_pause: This is how many seconds cleaning up waits
+        between transactions, so that connections waiting for the
+        locks it held get them before it takes them again.
 
-    @sort: __init__, createTables
+    @cvar savepoint_sql: The statement that marks a savepoint, or
+        C{None} if a failed statement leaves the rest of its
+        transaction usable in this database.  Inside a C{L{batch}},
+        statements that are expected to fail, like using a nonce twice,
+        run after a savepoint and are rolled back to it.
+
+
+    @sort: __init__, createTables, migrateTables, batch
     """
 
     settings_table = 'oid_settings'
     associations_table = 'oid_associations'
     nonces_table = 'oid_nonces'
+    negotiations_table = 'oid_negotiations'
+
+    pool_size = 4
+
+    cleanup_chunk_size = 1000
+    cleanup_pause = 0.01
+
+    savepoint_sql = None
+    release_savepoint_sql = None
+    rollback_savepoint_sql = None
+
+    # These statements take no parameters, so they are the same in
+    # every database.
+    create_assoc_index_sql = ('CREATE INDEX %(associations)s_expires_at '
+                              'ON %(associations)s (expires_at);')
+    create_nonce_index_sql = ('CREATE INDEX %(nonces)s_timestamp '
+                              'ON %(nonces)s (timestamp);')
+    check_negotiations_sql = ('SELECT server_url FROM %(negotiations)s '
+                              'WHERE 1 = 0;')
+    check_expires_at_sql = ('SELECT expires_at FROM %(associations)s '
+                            'WHERE 1 = 0;')
+    add_expires_at_sql = ('ALTER TABLE %(associations)s '
+                          'ADD COLUMN expires_at INTEGER;')
+    fill_expires_at_sql = ('UPDATE %(associations)s '
+                           'SET expires_at = issued + lifetime;')
 
     def __init__(self, conn, settings_table=None, associations_table=None,
-                 nonces_table=None):
+                 nonces_table=None, negotiations_table=None, connect=None,
+                 pool_size=None):
         """
         This creates a new SQLStore instance.  It requires an
         established database connection be given to it, and it allows
@@ -103,17 +167,64 @@ class SQLStore(OpenIDStore):
             default value is specified in C{L{SQLStore.nonces_table}}.
 
         @type nonces_table: C{str}
+
+
+        @param negotiations_table: This is an optional parameter to
+            specify the name of the table used for remembering the
+            association and session types that servers accepted.  The
+            default value is specified in
+            C{L{SQLStore.negotiations_table}}.
+
+        @type negotiations_table: C{str}
+
+
+        @param connect: This is an optional function that takes no
+            arguments and returns a new connection to the same
+            database as C{conn}.  Without it, threads take turns using
+            C{conn}.  With it, threads using the store at the same time
+            each get a connection of their own, made as needed, with
+            up to C{pool_size} of them kept for reuse.  For SQLite, the
+            connections must be made with C{check_same_thread=False}.
+
+        @type connect: C{callable}
+
+
+        @param pool_size: This is an optional parameter to specify how
+            many idle connections are kept when C{connect} is given.
+            The default value is specified in
+            C{L{SQLStore.pool_size}}.
+
+        @type pool_size: C{int}
         """
         self.conn = conn
-        self.cur = None
+        self.connect = connect
+        if pool_size is not None:
+            self.pool_size = pool_size
+
+        # (connection, cursor) pairs not in use by any thread. Each
+        # connection keeps its cursor, so the driver can reuse the
+        # statements it has prepared on it.
+        self._idle = [(conn, conn.cursor())]
+        self._pool_lock = threading.Condition()
+        self._txn = _TransactionState()
+
         self._statement_cache = {}
         self._table_names = {
             'settings': settings_table or self.settings_table,
             'associations': associations_table or self.associations_table,
             'nonces': nonces_table or self.nonces_table,
+            'negotiations': negotiations_table or self.negotiations_table,
             }
         self.max_nonce_age = 6 * 60 * 60 # Six hours, in seconds
 
+        # Whether the negotiations table exists, or None until it has
+        # been looked for.
+        self._has_negotiations = None
+
+        # Whether the associations table has an expires_at column, or
+        # None until it has been looked at.
+        self._has_expires_at = None
+
         # DB API extension: search for "Connection Attributes .Error,
         # .ProgrammingError, etc." in
         # http://www.python.org/dev/peps/pep-0249/
@@ -126,6 +237,14 @@ class SQLStore(OpenIDStore):
             raise RuntimeError("Error using database connection module "
                                "(Maybe it can't be imported?)")
 
+        self._setUpConnection(*self._idle[0])
+
+    def _setUpConnection(self, conn, cur):
+        """Prepare a connection, with its cursor, that the store is
+        about to start using.  This does nothing here, and is for
+        subclasses that set options on their connections."""
+        pass
+
     def blobDecode(self, blob):
         """Convert a blob as returned by the SQL engine into a str object.
 
@@ -141,7 +260,14 @@ class SQLStore(OpenIDStore):
         try:
             return self._statement_cache[sql_name]
         except KeyError:
-            sql = getattr(self, sql_name)
+            sql = None
+            if self._has_expires_at is False:
+                # Use the statement for tables without expires_at, if
+                # this one needs the column.
+                sql = getattr(self, sql_name[:-4] + '_unmigrated_sql',
+                              None)
+            if sql is None:
+                sql = getattr(self, sql_name)
             sql %= self._table_names
             self._statement_cache[sql_name] = sql
             return sql
@@ -155,35 +281,145 @@ class SQLStore(OpenIDStore):
         # implementation that looks up the appropriate SQL statement
         # as an attribute of this object and executes it.
         if attr[:3] == 'db_':
-            sql_name = attr[3:] + '_sql'
+            # Look the statement up once, and pass the same string to
+            # the driver on every call, so that drivers that cache
+            # prepared statements by their text find it.
+            sql = self._getSQL(attr[3:] + '_sql')
+            txn = self._txn
             def func(*args):
-                return self._execSQL(sql_name, *args)
+                txn.cur.execute(sql, args)
             setattr(self, attr, func)
             return func
         else:
             raise AttributeError('Attribute %r not found' % (attr,))
 
+    def _getCursor(self):
+        return self._txn.cur
+
+    cur = property(_getCursor, doc="""The cursor of the transaction
+        that the current thread has open, or C{None}.""")
+
+    def _takeConnection(self):
+        """Take an idle connection and its cursor from the pool,
+        making a new one if there are none and C{connect} was given,
+        or waiting for one otherwise."""
+        self._pool_lock.acquire()
+        try:
+            while not self._idle:
+                if self.connect is not None:
+                    break
+                self._pool_lock.wait()
+            else:
+                return self._idle.pop()
+        finally:
+            self._pool_lock.release()
+
+        conn = self.connect()
+        cur = conn.cursor()
+        self._setUpConnection(conn, cur)
+        return conn, cur
+
+    def _returnConnection(self, conn, cur, usable):
+        """Put a connection back in the pool, or close it if it is not
+        C{usable} or the pool is full.  The connection given to
+        C{L{__init__}} is always put back when C{connect} was not
+        given, since there is no other."""
+        self._pool_lock.acquire()
+        try:
+            if self.connect is None or (
+                usable and len(self._idle) < self.pool_size):
+                self._idle.append((conn, cur))
+                self._pool_lock.notify()
+                return
+        finally:
+            self._pool_lock.release()
+
+        try:
+            cur.close()
+            conn.close()
+        except self.exceptions.Error:
+            pass
+
     def _callInTransaction(self, func, *args, **kwargs):
         """Execute the given function inside of a transaction, with an
         open cursor. If no exception is raised, the transaction is
-        comitted, otherwise it is rolled back."""
-        # No nesting of transactions
-        self.conn.rollback()
+        comitted, otherwise it is rolled back.
+
+        If the current thread already has a transaction open, the
+        function runs as part of it instead."""
+        txn = self._txn
+        if txn.cur is not None:
+            txn.depth += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                txn.depth -= 1
 
+        conn, cur = self._takeConnection()
+        txn.conn = conn
+        txn.cur = cur
+        txn.depth = 1
+        usable = False
         try:
-            self.cur = self.conn.cursor()
             try:
                 ret = func(*args, **kwargs)
-            finally:
-                self.cur.close()
-                self.cur = None
+            except:
+                conn.rollback()
+                usable = True
+                raise
+            else:
+                conn.commit()
+                usable = True
+        finally:
+            txn.conn = None
+            txn.cur = None
+            txn.depth = 0
+            self._returnConnection(conn, cur, usable)
+
+        return ret
+
+    def _callInSavepoint(self, func, *args):
+        """Call a function that may fail without spoiling the rest of
+        the transaction it runs in.
+
+        In databases with a C{L{savepoint_sql}}, a failed statement
+        aborts its whole transaction.  Outside of a C{L{batch}} that
+        does not matter, since the transaction ends with the method
+        call, but inside one the function runs after a savepoint, and
+        is rolled back to it if it raises."""
+        if self.savepoint_sql is None or self._txn.depth < 2:
+            return func(*args)
+
+        self.db_savepoint()
+        try:
+            ret = func(*args)
         except:
-            self.conn.rollback()
+            self.db_rollback_savepoint()
             raise
         else:
-            self.conn.commit()
+            self.db_release_savepoint()
+            return ret
 
-        return ret
+    def batch(self, func, *args, **kwargs):
+        """Call C{func(*args, **kwargs)} with every call it makes to
+        this store, from the current thread, running in one
+        transaction.
+
+        The transaction is committed when C{func} returns, and rolled
+        back if it raises, so storing many associations or using many
+        nonces pays for one commit rather than one per call::
+
+            def useNonces(nonces):
+                return [store.useNonce(*n) for n in nonces]
+
+            results = store.batch(useNonces, nonces)
+
+        Calling C{batch} from inside C{func} runs as part of the same
+        transaction.
+
+        @returns: What C{func} returned
+        """
+        return self._callInTransaction(func, *args, **kwargs)
 
     def txn_createTables(self):
         """
@@ -192,24 +428,79 @@ class SQLStore(OpenIDStore):
         exist.
         """
         self.db_create_nonce()
+        self.db_create_nonce_index()
         self.db_create_assoc()
+        self.db_create_assoc_index()
         self.db_create_settings()
+        self.db_create_negotiation()
+        self._has_negotiations = True
+        self._has_expires_at = True
 
     createTables = _inTxn(txn_createTables)
 
+    def txn_migrateTables(self):
+        """
+        This method brings tables created by earlier versions of this
+        store up to date.  It adds the C{expires_at} column to the
+        associations table and fills it in, and adds the indexes that
+        cleaning up uses.  It should be run once, and only on tables
+        that do not have the column yet.
+
+        Stores in other processes that looked at the table before the
+        migration keep storing associations without C{expires_at}
+        until they are restarted.  Cleaning up removes those by their
+        C{issued} and C{lifetime}, so they are not left behind.
+
+        In databases that commit before each change to a table's
+        definition, like MySQL, a migration that fails part way is not
+        rolled back.
+        """
+        self.db_add_expires_at()
+        self.db_fill_expires_at()
+        self.db_create_assoc_index()
+        self.db_create_nonce_index()
+        self._has_expires_at = True
+        self._statement_cache.clear()
+        for attr in self.__dict__.keys():
+            if attr[:3] == 'db_':
+                delattr(self, attr)
+
+    migrateTables = _inTxn(txn_migrateTables)
+
+    def _hasExpiresAt(self):
+        """Return whether the associations table has an C{expires_at}
+        column, looking the first time it is asked.
+
+        This must be called before the statements that use the column
+        are first run, so that tables without it get the statements
+        written for them."""
+        if self._has_expires_at is None:
+            try:
+                # Inside another transaction, this runs after a
+                # savepoint where a failed statement would spoil it.
+                self._callInTransaction(self._callInSavepoint,
+                                        self.db_check_expires_at)
+            except (self.exceptions.OperationalError,
+                    self.exceptions.ProgrammingError), why:
+                oidutil.log('Associations table has no expires_at column; '
+                            'run migrateTables to add it: %s' % (why,))
+                self._has_expires_at = False
+            else:
+                self._has_expires_at = True
+
+        return self._has_expires_at
+
     def txn_storeAssociation(self, server_url, association):
         """Set the association for the server URL.
 
         Association -> NoneType
         """
         a = association
-        self.db_set_assoc(
-            server_url,
-            a.handle,
-            self.blobEncode(a.secret),
-            a.issued,
-            a.lifetime,
-            a.assoc_type)
+        args = [server_url, a.handle, self.blobEncode(a.secret), a.issued,
+                a.lifetime, a.assoc_type]
+        if self._hasExpiresAt():
+            args.append(a.issued + a.lifetime)
+        self.db_set_assoc(*args)
 
     storeAssociation = _inTxn(txn_storeAssociation)
 
@@ -229,9 +520,9 @@ class SQLStore(OpenIDStore):
             return None
         else:
             associations = []
-            for values in rows:
-                assoc = Association(*values)
-                assoc.secret = self.blobDecode(assoc.secret)
+            for (handle, secret, issued, lifetime, assoc_type) in rows:
+                assoc = Association(handle, self.blobDecode(secret), issued,
+                                    lifetime, assoc_type)
                 if assoc.getExpiresIn() == 0:
                     self.txn_removeAssociation(server_url, assoc.handle)
                 else:
@@ -256,6 +547,78 @@ class SQLStore(OpenIDStore):
 
     removeAssociation = _inTxn(txn_removeAssociation)
 
+    def txn_storeNegotiation(self, server_url, assoc_type, session_type):
+        """Remember the association and session type that the server
+        accepted.
+
+        (str, str, str) -> NoneType
+        """
+        self._callInSavepoint(self.db_set_negotiation,
+                              server_url, assoc_type, session_type)
+
+    _storeNegotiation = _inTxn(txn_storeNegotiation)
+
+    def txn_getNegotiation(self, server_url):
+        """Get the association and session type that the server last
+        accepted.
+
+        str -> NoneType or (str, str)
+        """
+        self._callInSavepoint(self.db_get_negotiation, server_url)
+        row = self.cur.fetchone()
+        if row is None:
+            return None
+        else:
+            return tuple(row)
+
+    _getNegotiation = _inTxn(txn_getNegotiation)
+
+    def storeNegotiation(self, server_url, assoc_type, session_type):
+        self._callNegotiation(self._storeNegotiation,
+                              server_url, assoc_type, session_type)
+
+    def getNegotiation(self, server_url):
+        return self._callNegotiation(self._getNegotiation, server_url)
+
+    def _callNegotiation(self, func, *args):
+        """Call func, treating a missing negotiations table as having
+        nothing remembered. Databases created before the table was
+        added keep working until C{L{createTables}} is run on a fresh
+        database or the table is created by hand.
+
+        Other database errors, like a lock that could not be had in
+        time, are logged and treated as nothing remembered for this
+        call only."""
+        if not self._hasNegotiations():
+            return None
+
+        try:
+            return func(*args)
+        except (self.exceptions.OperationalError,
+                self.exceptions.ProgrammingError), why:
+            oidutil.log('Could not use association negotiations: %s'
+                        % (why,))
+            return None
+
+    def _hasNegotiations(self):
+        """Return whether the negotiations table exists, looking the
+        first time it is asked."""
+        if self._has_negotiations is None:
+            try:
+                # Inside another transaction, this runs after a
+                # savepoint where a failed statement would spoil it.
+                self._callInTransaction(self._callInSavepoint,
+                                        self.db_check_negotiations)
+            except (self.exceptions.OperationalError,
+                    self.exceptions.ProgrammingError), why:
+                oidutil.log('Not remembering association negotiations: %s'
+                            % (why,))
+                self._has_negotiations = False
+            else:
+                self._has_negotiations = True
+
+        return self._has_negotiations
+
     def txn_useNonce(self, server_url, timestamp, salt):
         """Return whether this nonce is present, and if it is, then
         remove it from the set.
@@ -265,7 +628,8 @@ class SQLStore(OpenIDStore):
             return False
 
         try:
-            self.db_add_nonce(server_url, timestamp, salt)
+            self._callInSavepoint(self.db_add_nonce,
+                                  server_url, timestamp, salt)
         except self.exceptions.IntegrityError:
             # The key uniqueness check failed
             return False
@@ -276,16 +640,54 @@ class SQLStore(OpenIDStore):
     useNonce = _inTxn(txn_useNonce)
 
     def txn_cleanupNonces(self):
-        self.db_clean_nonce(int(time.time()) - nonce.SKEW)
+        """Remove up to C{L{cleanup_chunk_size}} expired nonces,
+        returning how many were removed.
+
+        () -> int
+        """
+        self.db_clean_nonce(int(time.time()) - nonce.SKEW,
+                            self.cleanup_chunk_size)
         return self.cur.rowcount
 
-    cleanupNonces = _inTxn(txn_cleanupNonces)
+    def cleanupNonces(self):
+        return self._cleanupInChunks(self._cleanupNonceChunk)
+
+    _cleanupNonceChunk = _inTxn(txn_cleanupNonces)
 
     def txn_cleanupAssociations(self):
-        self.db_clean_assoc(int(time.time()))
+        """Remove up to C{L{cleanup_chunk_size}} expired associations,
+        returning how many were removed.
+
+        () -> int
+        """
+        now = int(time.time())
+        if self._hasExpiresAt():
+            # Associations stored by processes that have not seen the
+            # migration yet have no expires_at.
+            self.db_clean_assoc(now, now, self.cleanup_chunk_size)
+        else:
+            self.db_clean_assoc(now, self.cleanup_chunk_size)
         return self.cur.rowcount
 
-    cleanupAssociations = _inTxn(txn_cleanupAssociations)
+    def cleanupAssociations(self):
+        return self._cleanupInChunks(self._cleanupAssociationChunk)
+
+    _cleanupAssociationChunk = _inTxn(txn_cleanupAssociations)
+
+    def _cleanupInChunks(self, chunk):
+        """Call C{chunk}, which removes up to C{L{cleanup_chunk_size}}
+        entries in a transaction of its own, until it removes fewer,
+        and return how many were removed in all."""
+        removed = 0
+        while True:
+            count = chunk()
+            if count < 0:
+                # -1 is undefined
+                return removed
+            removed += count
+            if count < self.cleanup_chunk_size:
+                return removed
+            time.sleep(self.cleanup_pause)
 
 
 class SQLiteStore(SQLStore):
@@ -296,8 +698,13 @@ class SQLiteStore(SQLStore):
     tables it will use, see C{L{SQLStore.createTables}}.
 
     All other methods are implementation details.
+
+    @cvar pragmas: The C{PRAGMA} statements run on each connection
+        before the store first uses it.
     """
 
+    pragmas = ()
+
     create_nonce_sql = """
     CREATE TABLE %(nonces)s (
         server_url VARCHAR,
@@ -316,6 +723,7 @@ class SQLiteStore(SQLStore):
         issued INTEGER,
         lifetime INTEGER,
         assoc_type VARCHAR(64),
+        expires_at INTEGER,
         PRIMARY KEY (server_url, handle)
     );
     """
@@ -328,8 +736,23 @@ class SQLiteStore(SQLStore):
     );
     """
 
+    create_negotiation_sql = """
+    CREATE TABLE %(negotiations)s
+    (
+        server_url VARCHAR(2047) PRIMARY KEY,
+        assoc_type VARCHAR(64),
+        session_type VARCHAR(64)
+    );
+    """
+
     set_assoc_sql = ('INSERT OR REPLACE INTO %(associations)s '
-                     'VALUES (?, ?, ?, ?, ?, ?);')
+                     '(server_url, handle, secret, issued, lifetime, '
+                     'assoc_type, expires_at) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?);')
+    set_assoc_unmigrated_sql = ('INSERT OR REPLACE INTO %(associations)s '
+                                '(server_url, handle, secret, issued, '
+                                'lifetime, assoc_type) '
+                                'VALUES (?, ?, ?, ?, ?, ?);')
     get_assocs_sql = ('SELECT handle, secret, issued, lifetime, assoc_type '
                       'FROM %(associations)s WHERE server_url = ?;')
     get_assoc_sql = (
@@ -342,11 +765,29 @@ class SQLiteStore(SQLStore):
     remove_assoc_sql = ('DELETE FROM %(associations)s '
                         'WHERE server_url = ? AND handle = ?;')
 
-    clean_assoc_sql = 'DELETE FROM %(associations)s WHERE issued + lifetime < ?;'
-
-    add_nonce_sql = 'INSERT INTO %(nonces)s VALUES (?, ?, ?);'
-
-    clean_nonce_sql = 'DELETE FROM %(nonces)s WHERE timestamp < ?;'
+    # SQLite only has DELETE ... LIMIT when built with it, so these
+    # delete a limited number of rows by their rowids.
+    clean_assoc_sql = ('DELETE FROM %(associations)s WHERE rowid IN '
+                       '(SELECT rowid FROM %(associations)s '
+                       'WHERE expires_at < ? OR (expires_at IS NULL AND '
+                       'issued + lifetime < ?) LIMIT ?);')
+    clean_assoc_unmigrated_sql = ('DELETE FROM %(associations)s '
+                                  'WHERE rowid IN '
+                                  '(SELECT rowid FROM %(associations)s '
+                                  'WHERE issued + lifetime < ? LIMIT ?);')
+
+    # A nonce that was already used is ignored rather than raising an
+    # error, and the cursor's rowcount tells which happened.
+    add_nonce_sql = 'INSERT OR IGNORE INTO %(nonces)s VALUES (?, ?, ?);'
+
+    clean_nonce_sql = ('DELETE FROM %(nonces)s WHERE rowid IN '
+                       '(SELECT rowid FROM %(nonces)s '
+                       'WHERE timestamp < ? LIMIT ?);')
+
+    set_negotiation_sql = ('INSERT OR REPLACE INTO %(negotiations)s '
+                           'VALUES (?, ?, ?);')
+    get_negotiation_sql = ('SELECT assoc_type, session_type '
+                           'FROM %(negotiations)s WHERE server_url = ?;')
 
     def blobDecode(self, buf):
         return str(buf)
@@ -354,17 +795,51 @@ class SQLiteStore(SQLStore):
     def blobEncode(self, s):
         return buffer(s)
 
-    def useNonce(self, *args, **kwargs):
-        # Older versions of the sqlite wrapper do not raise
-        # IntegrityError as they should, so we have to detect the
-        # message from the OperationalError.
-        try:
-            return super(SQLiteStore, self).useNonce(*args, **kwargs)
-        except self.exceptions.OperationalError, why:
-            if re.match('^columns .* are not unique$', why[0]):
-                return False
-            else:
-                raise
+    def _setUpConnection(self, conn, cur):
+        for pragma in self.pragmas:
+            cur.execute(pragma)
+            cur.fetchall()
+
+    def txn_useNonce(self, server_url, timestamp, salt):
+        """Return whether this nonce is present, and if it is, then
+        remove it from the set.
+
+        str -> bool"""
+        if abs(timestamp - time.time()) > nonce.SKEW:
+            return False
+
+        self.db_add_nonce(server_url, timestamp, salt)
+        return self.cur.rowcount == 1
+
+    useNonce = _inTxn(txn_useNonce)
+
+class SQLiteWALStore(SQLiteStore):
+    """
+    This is a C{L{SQLiteStore}} tuned for a database that many
+    threads or processes use at once.
+
+    The database is switched to write-ahead logging, so that reading
+    associations is not held up by another connection writing, and
+    writing does not wait for readers to finish.  Each commit only
+    appends to the log, which is synced to disk when it is copied
+    back into the database, rather than on every commit.  A
+    transaction committed just before the machine loses power can be
+    lost, so a nonce used then could be used again, within the
+    allowed clock skew; the database itself is not damaged.
+
+    Write-ahead logging needs SQLite 3.7.0 or later, and a database on
+    a local disk.  Once switched, the database stays in that mode for
+    every connection, including ones made by a plain
+    C{L{SQLiteStore}}.
+
+    To create an instance, see C{L{SQLStore.__init__}}.  To create the
+    tables it will use, see C{L{SQLStore.createTables}}.
+    """
+
+    pragmas = (
+        'PRAGMA journal_mode = WAL;',
+        'PRAGMA synchronous = NORMAL;',
+        )
 
 class MySQLStore(SQLStore):
     """
@@ -402,6 +877,7 @@ class MySQLStore(SQLStore):
         issued INTEGER,
         lifetime INTEGER,
         assoc_type VARCHAR(64),
+        expires_at INTEGER,
         PRIMARY KEY (server_url(255), handle)
     )
     TYPE=InnoDB;
@@ -416,8 +892,25 @@ class MySQLStore(SQLStore):
     TYPE=InnoDB;
     """
 
+    create_negotiation_sql = """
+    CREATE TABLE %(negotiations)s
+    (
+        server_url BLOB,
+        assoc_type VARCHAR(64),
+        session_type VARCHAR(64),
+        PRIMARY KEY (server_url(255))
+    )
+    TYPE=InnoDB;
+    """
+
     set_assoc_sql = ('REPLACE INTO %(associations)s '
-                     'VALUES (%%s, %%s, %%s, %%s, %%s, %%s);')
+                     '(server_url, handle, secret, issued, lifetime, '
+                     'assoc_type, expires_at) '
+                     'VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s);')
+    set_assoc_unmigrated_sql = ('REPLACE INTO %(associations)s '
+                                '(server_url, handle, secret, issued, '
+                                'lifetime, assoc_type) '
+                                'VALUES (%%s, %%s, %%s, %%s, %%s, %%s);')
     get_assocs_sql = ('SELECT handle, secret, issued, lifetime, assoc_type'
                       ' FROM %(associations)s WHERE server_url = %%s;')
     get_expired_sql = ('SELECT server_url '
@@ -429,11 +922,21 @@ class MySQLStore(SQLStore):
     remove_assoc_sql = ('DELETE FROM %(associations)s '
                         'WHERE server_url = %%s AND handle = %%s;')
 
-    clean_assoc_sql = 'DELETE FROM %(associations)s WHERE issued + lifetime < %%s;'
+    clean_assoc_sql = ('DELETE FROM %(associations)s '
+                       'WHERE expires_at < %%s OR (expires_at IS NULL AND '
+                       'issued + lifetime < %%s) LIMIT %%s;')
+    clean_assoc_unmigrated_sql = ('DELETE FROM %(associations)s '
+                                  'WHERE issued + lifetime < %%s LIMIT %%s;')
 
     add_nonce_sql = 'INSERT INTO %(nonces)s VALUES (%%s, %%s, %%s);'
 
-    clean_nonce_sql = 'DELETE FROM %(nonces)s WHERE timestamp < %%s;'
+    clean_nonce_sql = ('DELETE FROM %(nonces)s '
+                       'WHERE timestamp < %%s LIMIT %%s;')
+
+    set_negotiation_sql = ('REPLACE INTO %(negotiations)s '
+                           'VALUES (%%s, %%s, %%s);')
+    get_negotiation_sql = ('SELECT assoc_type, session_type '
+                           'FROM %(negotiations)s WHERE server_url = %%s;')
 
     def blobDecode(self, blob):
         if type(blob) is str:
@@ -481,6 +984,7 @@ class PostgreSQLStore(SQLStore):
         issued INTEGER,
         lifetime INTEGER,
         assoc_type VARCHAR(64),
+        expires_at INTEGER,
         PRIMARY KEY (server_url, handle),
         CONSTRAINT secret_length_constraint CHECK (LENGTH(secret) <= 128)
     );
@@ -495,30 +999,54 @@ class PostgreSQLStore(SQLStore):
     );
     """
 
-    def db_set_assoc(self, server_url, handle, secret, issued, lifetime, assoc_type):
+    create_negotiation_sql = """
+    CREATE TABLE %(negotiations)s
+    (
+        server_url VARCHAR(2047) PRIMARY KEY,
+        assoc_type VARCHAR(64),
+        session_type VARCHAR(64)
+    );
+    """
+
+    def db_set_assoc(self, server_url, handle, secret, issued, lifetime,
+                     assoc_type, *expires_at):
         """
         Set an association.  This is implemented as a method because
         REPLACE INTO is not supported by PostgreSQL (and is not
         standard SQL).
+
+        C{expires_at} is given only if the table has the column.
         """
         result = self.db_get_assoc(server_url, handle)
         rows = self.cur.fetchall()
         if len(rows):
             # Update the table since this associations already exists.
-            return self.db_update_assoc(secret, issued, lifetime, assoc_type,
-                                        server_url, handle)
+            args = ((secret, issued, lifetime, assoc_type) + expires_at +
+                    (server_url, handle))
+            return self.db_update_assoc(*args)
         else:
             # Insert a new record because this association wasn't
             # found.
-            return self.db_new_assoc(server_url, handle, secret, issued,
-                                     lifetime, assoc_type)
+            args = ((server_url, handle, secret, issued, lifetime,
+                     assoc_type) + expires_at)
+            return self.db_new_assoc(*args)
 
     new_assoc_sql = ('INSERT INTO %(associations)s '
-                     'VALUES (%%s, %%s, %%s, %%s, %%s, %%s);')
+                     '(server_url, handle, secret, issued, lifetime, '
+                     'assoc_type, expires_at) '
+                     'VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s);')
+    new_assoc_unmigrated_sql = ('INSERT INTO %(associations)s '
+                                '(server_url, handle, secret, issued, '
+                                'lifetime, assoc_type) '
+                                'VALUES (%%s, %%s, %%s, %%s, %%s, %%s);')
     update_assoc_sql = ('UPDATE %(associations)s SET '
                         'secret = %%s, issued = %%s, '
-                        'lifetime = %%s, assoc_type = %%s '
+                        'lifetime = %%s, assoc_type = %%s, expires_at = %%s '
                         'WHERE server_url = %%s AND handle = %%s;')
+    update_assoc_unmigrated_sql = ('UPDATE %(associations)s SET '
+                                   'secret = %%s, issued = %%s, '
+                                   'lifetime = %%s, assoc_type = %%s '
+                                   'WHERE server_url = %%s AND handle = %%s;')
     get_assocs_sql = ('SELECT handle, secret, issued, lifetime, assoc_type'
                       ' FROM %(associations)s WHERE server_url = %%s;')
     get_expired_sql = ('SELECT server_url '
@@ -530,11 +1058,45 @@ class PostgreSQLStore(SQLStore):
     remove_assoc_sql = ('DELETE FROM %(associations)s '
                         'WHERE server_url = %%s AND handle = %%s;')
 
-    clean_assoc_sql = 'DELETE FROM %(associations)s WHERE issued + lifetime < %%s;'
+    # PostgreSQL has no DELETE ... LIMIT, so these delete a limited
+    # number of rows by their physical locations.
+    clean_assoc_sql = ('DELETE FROM %(associations)s WHERE ctid IN '
+                       '(SELECT ctid FROM %(associations)s '
+                       'WHERE expires_at < %%s OR (expires_at IS NULL AND '
+                       'issued + lifetime < %%s) LIMIT %%s);')
+    clean_assoc_unmigrated_sql = ('DELETE FROM %(associations)s '
+                                  'WHERE ctid IN '
+                                  '(SELECT ctid FROM %(associations)s '
+                                  'WHERE issued + lifetime < %%s LIMIT %%s);')
 
     add_nonce_sql = 'INSERT INTO %(nonces)s VALUES (%%s, %%s, %%s);'
 
-    clean_nonce_sql = 'DELETE FROM %(nonces)s WHERE timestamp < %%s;'
+    clean_nonce_sql = ('DELETE FROM %(nonces)s WHERE ctid IN '
+                       '(SELECT ctid FROM %(nonces)s '
+                       'WHERE timestamp < %%s LIMIT %%s);')
+
+    def db_set_negotiation(self, server_url, assoc_type, session_type):
+        """
+        Remember a negotiation.  This is implemented as a method for
+        the same reason as C{L{db_set_assoc}}.
+        """
+        self.db_update_negotiation(assoc_type, session_type, server_url)
+        if self.cur.rowcount <= 0:
+            return self.db_new_negotiation(server_url, assoc_type,
+                                           session_type)
+
+    new_negotiation_sql = ('INSERT INTO %(negotiations)s '
+                           'VALUES (%%s, %%s, %%s);')
+    update_negotiation_sql = ('UPDATE %(negotiations)s SET '
+                              'assoc_type = %%s, session_type = %%s '
+                              'WHERE server_url = %%s;')
+    get_negotiation_sql = ('SELECT assoc_type, session_type '
+                           'FROM %(negotiations)s WHERE server_url = %%s;')
+
+    # PostgreSQL aborts the whole transaction when a statement fails.
+    savepoint_sql = 'SAVEPOINT oid_store;'
+    release_savepoint_sql = 'RELEASE SAVEPOINT oid_store;'
+    rollback_savepoint_sql = 'ROLLBACK TO SAVEPOINT oid_store;'
 
     def blobEncode(self, blob):
         try:
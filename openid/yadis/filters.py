@@ -26,12 +26,26 @@ class BasicServiceEndpoint(object):
     The simplest kind of filter you can write implements
     fromBasicServiceEndpoint, which takes one of these objects.
     """
+    __slots__ = ('type_uris', 'yadis_url', 'uri', 'service_element')
+
     def __init__(self, yadis_url, type_uris, uri, service_element):
         self.type_uris = type_uris
         self.yadis_url = yadis_url
         self.uri = uri
         self.service_element = service_element
 
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', ()))
+        for name in BasicServiceEndpoint.__slots__:
+            state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        # Also takes the __dict__ of an endpoint pickled before this
+        # class had __slots__.
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
     def matchTypes(self, type_uris):
         """Query this endpoint to see if it has any of the given type
         URIs. This is useful for implementing other endpoint classes
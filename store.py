@@ -25,6 +25,7 @@ For more, see openid/store/interface.py in that library.
 """
 
 import datetime
+import hashlib
 
 from openid.association import Association as OpenIDAssociation
 from openid.store.interface import OpenIDStore
@@ -40,7 +41,10 @@ class Association(db.Model):
   """
   url = db.LinkProperty()
   handle = db.StringProperty()
+  # KV form. Only associations stored before serialized was added have it.
   association = db.TextProperty()
+  # the binary form from OpenIDAssociation.serialize('3')
+  serialized = db.BlobProperty()
   created = db.DateTimeProperty(auto_now_add=True)
 
 
@@ -52,6 +56,16 @@ class UsedNonce(db.Model):
   salt = db.StringProperty()
 
 
+class Negotiation(db.Model):
+  """The association and session type an OpenID server last accepted.
+
+  The key name is the SHA-1 hex digest of the server URL.
+  """
+  url = db.LinkProperty()
+  assoc_type = db.StringProperty()
+  session_type = db.StringProperty()
+
+
 class DatastoreStore(OpenIDStore):
   """An OpenIDStore implementation that uses the datastore. See
   openid/store/interface.py for in-depth descriptions of the methods.
@@ -67,7 +81,7 @@ class DatastoreStore(OpenIDStore):
     """
     assoc = Association(url=server_url,
                         handle=association.handle,
-                        association=association.serialize())
+                        serialized=db.Blob(association.serialize('3')))
     assoc.put()
 
   def getAssociation(self, server_url, handle=None):
@@ -85,10 +99,15 @@ class DatastoreStore(OpenIDStore):
     query = Association.all().filter('url', server_url)
     if handle:
       query.filter('handle', handle)
+    else:
+      # newest first, so that renewed associations (see
+      # openid.consumer.warmer) take over from the ones they replace.
+      query.order('-created')
 
     results = query.fetch(1)
     if results:
-      association = OpenIDAssociation.deserialize(results[0].association)
+      assoc_s = results[0].serialized or results[0].association
+      association = OpenIDAssociation.deserialize(assoc_s)
       if association.getExpiresIn() > 0:
         # hasn't expired yet
         return association
@@ -104,6 +123,27 @@ class DatastoreStore(OpenIDStore):
                             server_url, handle)
     return self._delete_first(query)
 
+  def storeNegotiation(self, server_url, assoc_type, session_type):
+    """
+    This method remembers the association and session type that the server
+    accepted, for the next association negotiated with it.
+    """
+    Negotiation(key_name=self._negotiation_key_name(server_url),
+                url=server_url,
+                assoc_type=assoc_type,
+                session_type=session_type).put()
+
+  def getNegotiation(self, server_url):
+    """
+    This method returns the (association type, session type) pair that the
+    server last accepted, or None.
+    """
+    negotiation = Negotiation.get_by_key_name(
+      self._negotiation_key_name(server_url))
+    if negotiation:
+      return negotiation.assoc_type, negotiation.session_type
+    return None
+
   def useNonce(self, server_url, timestamp, salt):
     """Called when using a nonce.
 
@@ -211,6 +251,11 @@ class DatastoreStore(OpenIDStore):
 
     return len(to_delete)
 
+  def _negotiation_key_name(self, server_url):
+    """Returns the Negotiation key name for the given server URL.
+    """
+    return hashlib.sha1(server_url).hexdigest()
+
   def _expiration_datetime(self):
     """Returns the current expiration date for nonces and associations.
     """